@@ -0,0 +1,246 @@
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Handler for server-side benchmarks.
+
+Unlike benchmark_helper_wsh.py and bench_wsh.py, this handler measures how
+long the server spends sending and receiving each message, and reports the
+statistics on request. Messages are sent from buffers built once for each
+size and fragment size. Requires RFC 6455.
+
+Commands are text messages of space separated words:
+
+send <size> <count> [<fragment_size> [compress|nocompress]]
+    Sends <count> binary messages of <size> 'a's, then a text message
+    "sent". If <fragment_size> is positive, each message is sent as frames
+    of at most <fragment_size> bytes. compress and nocompress enable and
+    disable compression of outgoing messages when permessage-deflate or
+    deflate-frame has been negotiated. Compression is enabled by default.
+receive <count> [verify]
+    Receives <count> binary messages, then sends a text message
+    "received <total size>". If verify is given, checks that each message
+    consists of 'a's only.
+stats
+    Sends a JSON text with the statistics of the messages sent and received
+    since the connection was opened or the last reset command. See
+    _Statistics.to_dict() for the keys.
+reset
+    Clears the statistics, then sends a text message "reset".
+
+Times are taken by mod_pywebsocket.tracing.get_timestamp(), which is
+monotonic where available. The time to receive a message includes the time
+waiting for its first byte, so send messages right after the receive
+command to measure the server.
+"""
+
+
+import json
+
+from mod_pywebsocket import tracing
+
+
+_PAYLOAD_CHARACTER = 'a'
+
+_PERCENTILES = (50, 90, 99)
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1,
+                int(len(sorted_values) * percent / 100.0))
+    return sorted_values[index]
+
+
+class _Statistics(object):
+    """Durations and sizes of messages sent or received."""
+
+    def __init__(self):
+        self._durations = []
+        self._bytes = 0
+
+    def add(self, size, duration):
+        self._durations.append(duration)
+        self._bytes += size
+
+    def to_dict(self):
+        """Returns count, bytes, total_sec, mb_per_sec and the min, mean,
+        p50, p90, p99 and max of the durations in microseconds.
+        """
+
+        durations = sorted(self._durations)
+        total = sum(durations)
+        result = {
+            'count': len(durations),
+            'bytes': self._bytes,
+            'total_sec': total,
+            'mb_per_sec': total and self._bytes / total / 1000 / 1000,
+            'min_usec': durations and durations[0] * 1000000 or 0,
+            'mean_usec': durations and total / len(durations) * 1000000 or 0,
+            'max_usec': durations and durations[-1] * 1000000 or 0,
+        }
+        for percent in _PERCENTILES:
+            result['p%d_usec' % percent] = (
+                _percentile(durations, percent) * 1000000)
+        return result
+
+
+class _BufferCache(object):
+    """Builds payloads once for each size and fragment size."""
+
+    def __init__(self):
+        self._messages = {}
+        self._fragments = {}
+
+    def get_message(self, size):
+        message = self._messages.get(size)
+        if message is None:
+            message = _PAYLOAD_CHARACTER * size
+            self._messages[size] = message
+        return message
+
+    def get_fragments(self, size, fragment_size):
+        """Returns a list of strs to send as the frames of a message."""
+
+        key = (size, fragment_size)
+        fragments = self._fragments.get(key)
+        if fragments is None:
+            message = self.get_message(size)
+            fragments = [message[i:i + fragment_size]
+                         for i in xrange(0, size, fragment_size)] or ['']
+            self._fragments[key] = fragments
+        return fragments
+
+
+def _set_outgoing_compression(request, enabled):
+    for processor in request.ws_extension_processors:
+        if not hasattr(processor, 'enable_outgoing_compression'):
+            continue
+        if enabled:
+            processor.enable_outgoing_compression()
+        else:
+            processor.disable_outgoing_compression()
+
+
+def _send(request, buffers, stats, size, count, fragment_size):
+    stream = request.ws_stream
+    get_timestamp = tracing.get_timestamp
+    if fragment_size > 0 and fragment_size < size:
+        fragments = buffers.get_fragments(size, fragment_size)
+        last_fragment = fragments[-1]
+        fragments = fragments[:-1]
+        for unused_i in xrange(count):
+            start = get_timestamp()
+            for fragment in fragments:
+                stream.send_message(fragment, end=False, binary=True)
+            stream.send_message(last_fragment, end=True, binary=True)
+            stats.add(size, get_timestamp() - start)
+    else:
+        message = buffers.get_message(size)
+        for unused_i in xrange(count):
+            start = get_timestamp()
+            stream.send_message(message, binary=True)
+            stats.add(size, get_timestamp() - start)
+    stream.send_message(u'sent')
+
+
+def _receive(request, stats, count, verify):
+    stream = request.ws_stream
+    get_timestamp = tracing.get_timestamp
+    total_size = 0
+    for unused_i in xrange(count):
+        start = get_timestamp()
+        message = stream.receive_message()
+        duration = get_timestamp() - start
+        if message is None:
+            raise ValueError('Payload not received')
+        size = len(message)
+        if verify and message.count(_PAYLOAD_CHARACTER) != size:
+            raise ValueError('Payload verification failed')
+        stats.add(size, duration)
+        total_size += size
+    stream.send_message(u'received %d' % total_size)
+
+
+def web_socket_do_extra_handshake(request):
+    pass  # Always accept.
+
+
+def web_socket_transfer_data(request):
+    buffers = _BufferCache()
+    send_stats = _Statistics()
+    receive_stats = _Statistics()
+
+    while True:
+        command = request.ws_stream.receive_message()
+        if command is None:
+            return
+
+        if not isinstance(command, unicode):
+            raise ValueError('Invalid command data: %r' % command)
+        args = command.split(' ')
+
+        if args[0] == 'send':
+            if len(args) < 3 or len(args) > 5:
+                raise ValueError(
+                    'Illegal number of arguments for send command: ' + command)
+            fragment_size = 0
+            if len(args) >= 4:
+                fragment_size = int(args[3])
+            if len(args) == 5:
+                if args[4] not in ('compress', 'nocompress'):
+                    raise ValueError('Invalid compression: ' + args[4])
+                _set_outgoing_compression(request, args[4] == 'compress')
+            _send(request, buffers, send_stats,
+                  int(args[1]), int(args[2]), fragment_size)
+        elif args[0] == 'receive':
+            if len(args) < 2 or len(args) > 3:
+                raise ValueError(
+                    'Illegal number of arguments for receive command: ' +
+                    command)
+            if len(args) == 3 and args[2] != 'verify':
+                raise ValueError('Invalid option: ' + args[2])
+            _receive(request, receive_stats,
+                     int(args[1]), len(args) == 3)
+        elif args[0] == 'stats':
+            request.ws_stream.send_message(unicode(json.dumps({
+                'send': send_stats.to_dict(),
+                'receive': receive_stats.to_dict(),
+            })))
+        elif args[0] == 'reset':
+            send_stats = _Statistics()
+            receive_stats = _Statistics()
+            request.ws_stream.send_message(u'reset')
+        else:
+            raise ValueError('Invalid command: ' + args[0])
+
+
+# vi:sts=4 sw=4 et
@@ -404,6 +404,12 @@ class ClientHandshakeProcessor(ClientHandshakeBase):
             ClientHandshakeError: handshake failed.
         """
 
+        self.send_request()
+        self.receive_response()
+
+    def send_request(self):
+        """Sends the opening handshake request."""
+
         request_line = _build_method_line(self._options.resource)
         self._logger.debug('Client\'s opening handshake Request-Line: %r',
                            request_line)
@@ -474,6 +480,16 @@ class ClientHandshakeProcessor(ClientHandshakeBase):
 
         self._logger.debug('Sent client\'s opening handshake headers: %r',
                            fields)
+
+    def receive_response(self):
+        """Receives and validates the opening handshake response. Reads
+        from the socket only by recv(), so this can be retried from the
+        start on a socket replaying the bytes received so far.
+
+        Raises:
+            ClientHandshakeError: handshake failed.
+        """
+
         self._logger.debug('Start reading Status-Line')
 
         status_line = ''
@@ -625,6 +641,12 @@ class ClientHandshakeProcessorHybi00(ClientHandshakeBase):
             ClientHandshakeError: handshake failed.
         """
 
+        self.send_request()
+        self.receive_response()
+
+    def send_request(self):
+        """Sends the opening handshake request."""
+
         # 4.1 5. send request line.
         self._socket.sendall(_build_method_line(self._options.resource))
         # 4.1 6. Let /fields/ be an empty list of strings.
@@ -676,6 +698,15 @@ class ClientHandshakeProcessorHybi00(ClientHandshakeBase):
 
         self._logger.info('Sent handshake')
 
+    def receive_response(self):
+        """Receives and validates the opening handshake response. Reads
+        from the socket only by recv(), so this can be retried from the
+        start on a socket replaying the bytes received so far.
+
+        Raises:
+            ClientHandshakeError: handshake failed.
+        """
+
         # 4.1 28. Read bytes from the server until either the connection
         # closes, or a 0x0A byte is read. let /field/ be these bytes, including
         # the 0x0A bytes.
@@ -0,0 +1,793 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Headless load generator for WebSocket servers built on echo_client.
+
+Opens many concurrent WebSocket connections from one process, drives them
+with a message profile via non-blocking sockets and reports the throughput
+and the latency percentiles. mod_pywebsocket directory must be in
+PYTHONPATH.
+
+Example Usage:
+
+# server setup
+ % cd $pywebsocket
+ % PYTHONPATH=$cwd/src python ./mod_pywebsocket/standalone.py -p 8880 \
+    -d $cwd/src/example
+
+# 1000 connections each sending a 128 byte message to /echo 10 times a
+# second for 30 seconds
+ % PYTHONPATH=$cwd/src python ./src/example/load_client.py -p 8880 \
+     -c 1000 --profile echo --message-size 128 --rate 10 -d 30
+
+Profiles:
+
+echo: Each connection sends a binary message to /echo every 1/--rate
+    seconds without waiting for the echo (open loop). Latency is the time
+    from sending a message to receiving its echo.
+request: Each connection sends a binary message to /echo and waits for the
+    echo before sending the next one (closed loop). --rate limits the number
+    of requests per second of each connection. 0 means no limit.
+push: Each connection asks /bench (bench_wsh.py) to push a message every
+    1/--rate seconds for the duration. Latency is the time from when a
+    message was scheduled to be pushed to when it's received. It includes
+    the scheduling drift of the handler.
+
+All the connections are opened before the load starts so that the opening
+handshake rate can be reported separately. Up to --concurrent-handshakes
+connections connect and shake hands at a time on non-blocking sockets. Raise
+the limit on open files (ulimit -n) to open thousands of connections. For
+the hybi00 protocol, text messages are sent instead of binary ones.
+
+Masking large messages takes most of the CPU time of this client unless the
+fast_masking module is available. If fewer messages than expected are sent,
+the client is the bottleneck. Run more processes in that case.
+"""
+
+
+import copy
+import errno
+import heapq
+import logging
+from optparse import OptionParser
+import os
+import socket
+import sys
+import time
+from collections import deque
+
+import echo_client
+from mod_pywebsocket import common
+from mod_pywebsocket.eventloop import _EventLoopConnection
+from mod_pywebsocket.eventloop import _NeedMoreData
+from mod_pywebsocket.eventloop import _Poller
+from mod_pywebsocket.stream import Stream
+from mod_pywebsocket.stream import StreamHixie75
+from mod_pywebsocket.stream import StreamOptions
+from mod_pywebsocket import util
+
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+_PROFILE_ECHO = 'echo'
+_PROFILE_REQUEST = 'request'
+_PROFILE_PUSH = 'push'
+
+_DEFAULT_RESOURCES = {
+    _PROFILE_ECHO: '/echo',
+    _PROFILE_REQUEST: '/echo',
+    _PROFILE_PUSH: '/bench',
+}
+
+# Time to wait for the acks of closing handshakes after the load.
+_CLOSE_TIMEOUT_SEC = 5
+
+# States of _OpeningConnection.
+_STATE_CONNECTING = 0
+_STATE_TLS_HANDSHAKE = 1
+_STATE_OPENING_HANDSHAKE = 2
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1,
+                int(len(sorted_values) * percent / 100.0))
+    return sorted_values[index]
+
+
+class _NonBlockingTLSSocket(object):
+    """Wraps a socket returned by ssl.wrap_socket so that reads and writes
+    which would block raise socket.error with EAGAIN like a plain
+    non-blocking socket does.
+    """
+
+    def __init__(self, tls_socket):
+        self._socket = tls_socket
+
+    def setblocking(self, flag):
+        self._socket.setblocking(flag)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def recv(self, size):
+        try:
+            data = self._socket.recv(size)
+            # Bytes already decrypted by the ssl module don't make the socket
+            # readable. Read them now.
+            while data and self._socket.pending():
+                data += self._socket.recv(self._socket.pending())
+            return data
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                             ssl.SSL_ERROR_WANT_WRITE):
+                raise socket.error(errno.EAGAIN, 'Would block')
+            raise
+
+    def send(self, data):
+        try:
+            return self._socket.send(data)
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                             ssl.SSL_ERROR_WANT_WRITE):
+                raise socket.error(errno.EAGAIN, 'Would block')
+            raise
+
+    def shutdown(self, how):
+        self._socket.shutdown(how)
+
+    def close(self):
+        self._socket.close()
+
+
+class _HandshakeSocket(object):
+    """Provides the socket interface the handshake processors of echo_client
+    use on top of _EventLoopConnection. recv() raises _NeedMoreData until
+    the requested bytes have been received.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def sendall(self, data):
+        self._connection.write(data)
+
+    def recv(self, size):
+        return self._connection.read(size)
+
+
+class _OpeningConnection(object):
+    """Connects and performs the opening handshake on a non-blocking socket.
+    Each resume() call makes as much progress as the socket allows.
+    """
+
+    def __init__(self, options, deadline):
+        """Starts connecting.
+
+        Args:
+            options: options of the connection. The handshake processors
+                replace the extension options with the negotiated framers.
+            deadline: time by when the handshake must be done.
+        """
+
+        self.options = options
+        self.deadline = deadline
+        self.start = time.time()
+        self.connection = None
+        # Whether to wait for the socket to get writable in addition to
+        # readable before calling resume() again.
+        self.wants_write = True
+
+        self._state = _STATE_CONNECTING
+        self._handshake = None
+
+        self.socket = socket.socket()
+        self.socket.setblocking(0)
+        error = self.socket.connect_ex(
+            (options.server_host, options.server_port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.socket.close()
+            raise socket.error(error, os.strerror(error))
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def resume(self):
+        """Returns True when the opening handshake is done.
+
+        Raises:
+            socket.error, ssl.SSLError, echo_client.ClientHandshakeError,
+            IOError: failed to open the connection.
+        """
+
+        if self._state == _STATE_CONNECTING:
+            error = self.socket.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            if self.options.use_tls:
+                self.socket = ssl.wrap_socket(
+                    self.socket, ssl_version=ssl.PROTOCOL_SSLv23,
+                    do_handshake_on_connect=False)
+                self._state = _STATE_TLS_HANDSHAKE
+            else:
+                self._send_request()
+
+        if self._state == _STATE_TLS_HANDSHAKE:
+            try:
+                self.socket.do_handshake()
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    self.wants_write = False
+                    return False
+                if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                    self.wants_write = True
+                    return False
+                raise
+            self.socket = _NonBlockingTLSSocket(self.socket)
+            self._send_request()
+
+        connection = self.connection
+        connection.flush()
+        self.wants_write = bool(connection.get_write_buffered_amount())
+        connection.fill()
+        # The response is parsed again from the start until all of it has
+        # been received.
+        connection.mark()
+        try:
+            self._handshake.receive_response()
+        except _NeedMoreData:
+            connection.rewind()
+            return False
+        return True
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        else:
+            self.socket.close()
+
+    def _send_request(self):
+        options = self.options
+        self.connection = _EventLoopConnection(
+            self.socket, '', None, (options.server_host, options.server_port))
+        if options.protocol_version == echo_client._PROTOCOL_VERSION_HYBI00:
+            self._handshake = echo_client.ClientHandshakeProcessorHybi00(
+                _HandshakeSocket(self.connection), options)
+        else:
+            self._handshake = echo_client.ClientHandshakeProcessor(
+                _HandshakeSocket(self.connection), options)
+        self._handshake.send_request()
+        self._state = _STATE_OPENING_HANDSHAKE
+
+
+class _LoadConnection(object):
+    """State of a connection opened by LoadClient."""
+
+    def __init__(self, request, stream):
+        self.request = request
+        self.stream = stream
+        self.connection = request.connection
+        # Times when the messages waiting for a response were sent.
+        self.send_times = deque()
+        # Time when the push command was sent, and the number of messages
+        # pushed so far.
+        self.push_started_at = None
+        self.pushed = 0
+        self.wants_write = False
+        self.closed = False
+
+
+class LoadClient(object):
+    """Opens connections and drives them with a load profile."""
+
+    def __init__(self, options):
+        self._options = options
+        self._logger = util.get_class_logger(self)
+
+        self._connections = []
+        self._poller = _Poller()
+        self._connections_by_fd = {}
+        self._message = None
+        # Heap of (time, sequence number, _LoadConnection) to send a message
+        # on.
+        self._send_schedule = []
+        self._send_sequence = 0
+
+        self._setup_times = []
+        self._setup_elapsed = 0
+        self._transfer_elapsed = 0
+        self._connect_failures = 0
+        self._latencies = []
+        self._sent_messages = 0
+        self._received_messages = 0
+        self._received_bytes = 0
+        self._errors = 0
+
+    def run(self):
+        """Runs the load and returns the result as a dict."""
+
+        self.open_connections()
+        self.transfer()
+        self.close_connections()
+        return self.get_result()
+
+    def open_connections(self):
+        """Opens the connections, up to --concurrent-handshakes at a time."""
+
+        options = self._options
+        if options.protocol_version == echo_client._PROTOCOL_VERSION_HYBI00:
+            self._message = u'x' * options.message_size
+        else:
+            self._message = 'x' * options.message_size
+
+        setup_start = time.time()
+        # Map from file descriptors to _OpeningConnections.
+        opening = {}
+        remaining = options.connections
+        while remaining or opening:
+            while remaining and len(opening) < options.concurrent_handshakes:
+                remaining -= 1
+                self._start_connection(opening)
+            if not opening:
+                continue
+
+            now = time.time()
+            next_deadline = min(opening_connection.deadline
+                                for opening_connection in opening.values())
+            for fd, unused_readable, unused_writable in self._poller.poll(
+                max(0, next_deadline - now)):
+                opening_connection = opening.get(fd)
+                if opening_connection is None:
+                    continue
+                try:
+                    if not opening_connection.resume():
+                        self._poller.register(fd, True,
+                                              opening_connection.wants_write)
+                        continue
+                except Exception, e:
+                    self._fail_connection(opening, opening_connection, e)
+                    continue
+                del opening[fd]
+                self._add_connection(opening_connection)
+
+            now = time.time()
+            for opening_connection in opening.values():
+                if opening_connection.deadline <= now:
+                    self._fail_connection(
+                        opening, opening_connection,
+                        'Timed out during opening handshake')
+        self._setup_elapsed = time.time() - setup_start
+        self._logger.info('Opened %d connections in %.3f sec',
+                          len(self._connections), self._setup_elapsed)
+
+    def transfer(self):
+        """Drives the connections with the profile for the duration."""
+
+        transfer_start = time.time()
+        self._transfer(transfer_start + self._options.duration)
+        self._transfer_elapsed = time.time() - transfer_start
+
+    def get_result(self):
+        """Returns the result as a dict."""
+
+        setup_times = sorted(self._setup_times)
+        latencies = sorted(self._latencies)
+        setup_elapsed = self._setup_elapsed
+        transfer_elapsed = self._transfer_elapsed
+        result = {
+            'profile': self._options.profile,
+            'connections': len(self._connections),
+            'connect_failures': self._connect_failures,
+            'connections_per_sec':
+                setup_elapsed and len(setup_times) / setup_elapsed,
+            'sent_messages': self._sent_messages,
+            'received_messages': self._received_messages,
+            'errors': self._errors,
+        }
+        if transfer_elapsed:
+            result['messages_per_sec'] = (
+                self._received_messages / transfer_elapsed)
+            result['mb_per_sec'] = (
+                self._received_bytes / transfer_elapsed / 1000 / 1000)
+        else:
+            result['messages_per_sec'] = 0
+            result['mb_per_sec'] = 0
+        for name, values in (('handshake', setup_times),
+                             ('latency', latencies)):
+            for percent in (50, 90, 99):
+                result['%s_p%d_ms' % (name, percent)] = (
+                    _percentile(values, percent) * 1000)
+            result['%s_max_ms' % name] = (values and values[-1] or 0) * 1000
+        return result
+
+    def _start_connection(self, opening):
+        options = self._options
+        try:
+            # The handshake processors replace the extension options with
+            # the negotiated framers.
+            opening_connection = _OpeningConnection(
+                copy.copy(options), time.time() + options.socket_timeout)
+        except Exception, e:
+            self._log_connect_failure(e)
+            return
+        fd = opening_connection.fileno()
+        opening[fd] = opening_connection
+        self._poller.register(fd, True, opening_connection.wants_write)
+
+    def _fail_connection(self, opening, opening_connection, reason):
+        self._log_connect_failure(reason)
+        fd = opening_connection.fileno()
+        self._poller.unregister(fd)
+        del opening[fd]
+        opening_connection.close()
+
+    def _log_connect_failure(self, reason):
+        if not self._connect_failures:
+            self._logger.warning('Failed to open connection: %s', reason)
+        else:
+            self._logger.debug('Failed to open connection: %s', reason)
+        self._connect_failures += 1
+
+    def _add_connection(self, opening_connection):
+        self._setup_times.append(time.time() - opening_connection.start)
+
+        connection_options = opening_connection.options
+        connection = opening_connection.connection
+        request = echo_client.ClientRequest(opening_connection.socket)
+        request.connection = connection
+
+        if connection_options.protocol_version == (
+            echo_client._PROTOCOL_VERSION_HYBI00):
+            request.ws_version = common.VERSION_HYBI00
+            stream = StreamHixie75(request, True)
+        else:
+            request.ws_version = common.VERSION_HYBI_LATEST
+            stream_options = StreamOptions()
+            stream_options.mask_send = True
+            stream_options.unmask_receive = False
+            if connection_options.deflate_frame is not False:
+                connection_options.deflate_frame.setup_stream_options(
+                    stream_options)
+            if connection_options.use_permessage_deflate is not False:
+                connection_options.use_permessage_deflate.setup_stream_options(
+                    stream_options)
+            stream = Stream(request, stream_options)
+
+            # Remember where each frame starts so that a frame which hasn't
+            # been fully received can be parsed again from the start.
+            stream.set_frame_start_listener(connection.mark)
+
+        load_connection = _LoadConnection(request, stream)
+        self._connections.append(load_connection)
+        self._connections_by_fd[connection.fileno()] = load_connection
+        self._poller.register(connection.fileno(), True, False)
+
+    def _transfer(self, deadline):
+        options = self._options
+        now = time.time()
+        for load_connection in self._connections:
+            if options.profile == _PROFILE_PUSH:
+                load_connection.push_started_at = now
+                self._send(load_connection,
+                           u'%f %d %s' % (1.0 / options.rate,
+                                          int(options.rate * options.duration),
+                                          self._message),
+                           now)
+            else:
+                self._schedule_send(load_connection, now)
+
+        while True:
+            now = time.time()
+            if now >= deadline:
+                break
+            while self._send_schedule and self._send_schedule[0][0] <= now:
+                unused_time, unused_seq, load_connection = heapq.heappop(
+                    self._send_schedule)
+                if load_connection.closed:
+                    continue
+                self._send(load_connection, self._message, now)
+                if options.profile == _PROFILE_ECHO:
+                    self._schedule_send(
+                        load_connection, now + 1.0 / options.rate)
+            next_wakeup = deadline
+            if self._send_schedule:
+                next_wakeup = min(next_wakeup, self._send_schedule[0][0])
+            self._poll(max(0, next_wakeup - now))
+
+    def _schedule_send(self, load_connection, when):
+        self._send_sequence += 1
+        heapq.heappush(self._send_schedule,
+                       (when, self._send_sequence, load_connection))
+
+    def close_connections(self):
+        """Starts closing handshakes and waits for the acks."""
+
+        for load_connection in self._connections:
+            if load_connection.closed:
+                continue
+            try:
+                if isinstance(load_connection.stream, StreamHixie75):
+                    load_connection.stream._send_closing_handshake()
+                else:
+                    load_connection.stream.close_connection(
+                        wait_response=False)
+            except Exception, e:
+                self._logger.debug('Failed to send close frame: %s', e)
+                self._close(load_connection)
+                continue
+            self._update_write_interest(load_connection)
+
+        deadline = time.time() + _CLOSE_TIMEOUT_SEC
+        while True:
+            now = time.time()
+            if now >= deadline:
+                break
+            if not self._connections_by_fd:
+                break
+            self._poll(deadline - now)
+
+        for load_connection in self._connections:
+            if not load_connection.closed:
+                self._logger.debug('Didn\'t receive ack for closing handshake')
+                self._close(load_connection)
+
+    def _poll(self, timeout):
+        for fd, readable, writable in self._poller.poll(timeout):
+            load_connection = self._connections_by_fd.get(fd)
+            if load_connection is None:
+                continue
+            if writable:
+                try:
+                    load_connection.connection.flush()
+                except socket.error, e:
+                    self._logger.debug('Failed to write: %s', e)
+                    self._errors += 1
+                    self._close(load_connection)
+                    continue
+                self._update_write_interest(load_connection)
+            if readable:
+                load_connection.connection.fill()
+                self._receive_messages(load_connection)
+
+    def _receive_messages(self, load_connection):
+        connection = load_connection.connection
+        stream = load_connection.stream
+        hixie = isinstance(stream, StreamHixie75)
+        while not load_connection.closed:
+            if hixie:
+                connection.mark()
+            try:
+                message = stream.receive_message()
+            except _NeedMoreData:
+                connection.rewind()
+                return
+            except Exception, e:
+                if not load_connection.request.server_terminated:
+                    self._logger.debug('Failed to receive: %s', e)
+                    self._errors += 1
+                self._close(load_connection)
+                return
+            if message is None:
+                # Closing handshake is done. Stream has sent the ack if the
+                # server initiated it.
+                self._update_write_interest(load_connection)
+                self._close(load_connection)
+                return
+            if not load_connection.request.server_terminated:
+                self._on_message(load_connection, message, time.time())
+
+    def _on_message(self, load_connection, message, now):
+        self._received_messages += 1
+        self._received_bytes += len(message)
+        options = self._options
+        if options.profile == _PROFILE_PUSH:
+            scheduled_at = (load_connection.push_started_at +
+                            load_connection.pushed / options.rate)
+            load_connection.pushed += 1
+            self._latencies.append(now - scheduled_at)
+            return
+
+        if not load_connection.send_times:
+            self._logger.debug('Received unexpected message')
+            self._errors += 1
+            return
+        sent_at = load_connection.send_times.popleft()
+        self._latencies.append(now - sent_at)
+        if options.profile == _PROFILE_REQUEST:
+            if options.rate:
+                self._schedule_send(load_connection,
+                                    max(now, sent_at + 1.0 / options.rate))
+            else:
+                self._send(load_connection, self._message, now)
+
+    def _send(self, load_connection, message, now):
+        try:
+            load_connection.stream.send_message(
+                message, binary=isinstance(message, str) and
+                not isinstance(load_connection.stream, StreamHixie75))
+        except Exception, e:
+            self._logger.debug('Failed to send: %s', e)
+            self._errors += 1
+            self._close(load_connection)
+            return
+        self._sent_messages += 1
+        load_connection.send_times.append(now)
+        self._update_write_interest(load_connection)
+
+    def _update_write_interest(self, load_connection):
+        if load_connection.closed:
+            return
+        wants_write = bool(
+            load_connection.connection.get_write_buffered_amount())
+        if wants_write != load_connection.wants_write:
+            load_connection.wants_write = wants_write
+            self._poller.register(load_connection.connection.fileno(),
+                                  True, wants_write)
+
+    def _close(self, load_connection):
+        if load_connection.closed:
+            return
+        load_connection.closed = True
+        fd = load_connection.connection.fileno()
+        self._poller.unregister(fd)
+        del self._connections_by_fd[fd]
+        try:
+            load_connection.connection.flush()
+        except socket.error, e:
+            pass
+        load_connection.connection.close()
+
+
+def _format_result(result):
+    return '\n'.join([
+        'connections: %(connections)d opened, %(connect_failures)d failed, '
+        '%(connections_per_sec).1f conn/s' % result,
+        'handshake: p50 %(handshake_p50_ms).2f ms, '
+        'p90 %(handshake_p90_ms).2f ms, p99 %(handshake_p99_ms).2f ms' %
+        result,
+        'messages: %(sent_messages)d sent, %(received_messages)d received, '
+        '%(errors)d errors' % result,
+        'throughput: %(messages_per_sec).1f msg/s, '
+        '%(mb_per_sec).3f MB/s' % result,
+        'latency: p50 %(latency_p50_ms).2f ms, p90 %(latency_p90_ms).2f ms, '
+        'p99 %(latency_p99_ms).2f ms, max %(latency_max_ms).2f ms' % result,
+    ])
+
+
+def main():
+    parser = OptionParser()
+    # We accept --command_line_flag style flags which is the same as Google
+    # gflags in addition to common --command-line-flag style flags.
+    parser.add_option('-s', '--server-host', '--server_host',
+                      dest='server_host', type='string',
+                      default='localhost', help='server host')
+    parser.add_option('-p', '--server-port', '--server_port',
+                      dest='server_port', type='int',
+                      default=echo_client._UNDEFINED_PORT,
+                      help='server port')
+    parser.add_option('-o', '--origin', dest='origin', type='string',
+                      default=None, help='origin')
+    parser.add_option('-r', '--resource', dest='resource', type='string',
+                      default=None,
+                      help='resource path. Defaults to /echo, or /bench for '
+                      'the push profile')
+    parser.add_option('-t', '--tls', dest='use_tls', action='store_true',
+                      default=False, help='use TLS (wss://) by ssl module')
+    parser.add_option('-k', '--socket-timeout', '--socket_timeout',
+                      dest='socket_timeout', type='int',
+                      default=echo_client._TIMEOUT_SEC,
+                      help='Timeout(sec) for sockets during opening handshake')
+    parser.add_option('--concurrent-handshakes', '--concurrent_handshakes',
+                      dest='concurrent_handshakes', type='int', default=100,
+                      help='maximum number of connections to connect and '
+                      'shake hands at a time')
+    parser.add_option('--protocol-version', '--protocol_version',
+                      dest='protocol_version', type='choice',
+                      default=echo_client._PROTOCOL_VERSION_HYBI13,
+                      choices=[echo_client._PROTOCOL_VERSION_HYBI13,
+                               echo_client._PROTOCOL_VERSION_HYBI08,
+                               echo_client._PROTOCOL_VERSION_HYBI00],
+                      help='WebSocket protocol version to use.')
+    parser.add_option('--version-header', '--version_header',
+                      dest='version_header',
+                      type='int', default=-1,
+                      help='Specify Sec-WebSocket-Version header value')
+    parser.add_option('--deflate-frame', '--deflate_frame',
+                      dest='deflate_frame',
+                      action='store_true', default=False,
+                      help='Use the deflate-frame extension.')
+    parser.add_option('--use-permessage-deflate', '--use_permessage_deflate',
+                      dest='use_permessage_deflate',
+                      action='store_true', default=False,
+                      help='Use the permessage-deflate extension.')
+    parser.add_option('-c', '--connections', dest='connections', type='int',
+                      default=100, help='number of concurrent connections')
+    parser.add_option('--profile', dest='profile', type='choice',
+                      default=_PROFILE_ECHO,
+                      choices=[_PROFILE_ECHO, _PROFILE_REQUEST, _PROFILE_PUSH],
+                      help='load profile. See the usage above.')
+    parser.add_option('--message-size', '--message_size',
+                      dest='message_size', type='int', default=128,
+                      help='size of each message in bytes')
+    parser.add_option('--rate', dest='rate', type='float', default=1,
+                      help='messages per second of each connection')
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+                      default=10, help='duration(sec) of the load')
+    parser.add_option('--log-level', '--log_level', type='choice',
+                      dest='log_level', default='warn',
+                      choices=['debug', 'info', 'warn', 'error', 'critical'],
+                      help='Log level.')
+
+    (options, unused_args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.getLevelName(options.log_level.upper()))
+
+    if options.rate <= 0 and options.profile != _PROFILE_REQUEST:
+        logging.critical('--rate must be positive for the %s profile',
+                         options.profile)
+        sys.exit(1)
+    if options.message_size < 1 and options.profile == _PROFILE_PUSH:
+        logging.critical('--message-size must be positive for the push '
+                         'profile')
+        sys.exit(1)
+
+    if (options.protocol_version == echo_client._PROTOCOL_VERSION_HYBI00 and
+        options.origin is None):
+        logging.critical('Specify the origin of the connection by --origin '
+                         'flag for the hybi00 protocol')
+        sys.exit(1)
+
+    if options.use_tls and ssl is None:
+        logging.critical('TLS support requires ssl module.')
+        sys.exit(1)
+
+    if options.server_port == echo_client._UNDEFINED_PORT:
+        if options.use_tls:
+            options.server_port = common.DEFAULT_WEB_SOCKET_SECURE_PORT
+        else:
+            options.server_port = common.DEFAULT_WEB_SOCKET_PORT
+    if options.resource is None:
+        options.resource = _DEFAULT_RESOURCES[options.profile]
+
+    print _format_result(LoadClient(options).run())
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vi:sts=4 sw=4 et
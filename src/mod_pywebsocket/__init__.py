@@ -67,6 +67,28 @@ Installation
 
        PythonOption mod_pywebsocket.allow_handlers_outside_root_dir On
 
+   If you have many handlers and want to shorten startup time, configure as
+   follows to source each handler on the first request for its resource
+   instead of on startup, and to cache compiled handlers in <cache_dir>:
+
+       PythonOption mod_pywebsocket.lazy_handler_loading On
+       PythonOption mod_pywebsocket.handler_bytecode_cache_dir <cache_dir>
+
+   To record counters and histograms of WebSocket connections (see the
+   Metrics section below), configure as follows:
+
+       PythonOption mod_pywebsocket.metrics On
+
+   To send pings on connections from which nothing has been received for
+   <interval> seconds, abort connections from which nothing has been
+   received for <timeout> seconds after a ping, and close connections
+   exchanging no message for <idle> seconds (see the Keepalive section
+   below), configure as follows:
+
+       PythonOption mod_pywebsocket.keepalive_ping_interval <interval>
+       PythonOption mod_pywebsocket.keepalive_pong_timeout <timeout>
+       PythonOption mod_pywebsocket.idle_timeout <idle>
+
    Example snippet of httpd.conf:
    (mod_pywebsocket is in /websock_lib, WebSocket handlers are in
    /websock_handlers, port is 80 for ws, 443 for wss.)
@@ -118,9 +140,16 @@ extra handshake (web_socket_do_extra_handshake):
 - ws_location (HyBi 00 only)
 - ws_extensions (HyBi 06 and later)
 - ws_deflate (HyBi 06 and later)
+- ws_resource_params
 - ws_protocol
 - ws_requested_protocols (HyBi 06 and later)
 
+ws_resource_params is a dict of the parameters captured when ws_resource
+matched a resource path pattern registered by
+Dispatcher.add_resource_path_pattern (e.g. {'room_id': '123'} for /room/123
+matching /room/{room_id}). It's empty when ws_resource matched a handler
+exactly.
+
 The last two are a bit tricky. See the next subsection.
 
 
@@ -164,6 +193,15 @@ You can send a message by the following statement.
 
     request.ws_stream.send_message(message)
 
+msgutil.MessageReceiver and msgutil.MessageSender receive/send messages on a
+thread of their own. msgutil.PooledMessageReceiver and
+msgutil.PooledMessageSender do the same on a thread pool shared by many
+connections (msgutil.MessageWorkerPool) with bounded queues.
+msgutil.OutboundMessageQueue sends messages on the pool too, and discards
+them or aborts the connection when a slow client lets too much data queue
+up. It also aborts the connection when sending a message takes longer than
+its send timeout.
+
 
 Closing Connection
 ------------------
@@ -186,6 +224,31 @@ use in web_socket_passive_closing_handshake.
 - ws_close_reason
 
 
+Coroutine Handlers
+------------------
+
+web_socket_transfer_data can also be written as a generator function. Such
+a handler waits for the next message by a yield expression instead of
+calling receive_message(). The yield expression evaluates to None on
+receiving client-initiated closing handshake.
+
+    def web_socket_transfer_data(request):
+        while True:
+            message = yield
+            if message is None:
+                return
+            request.ws_stream.send_message(message)
+
+Yield mod_pywebsocket.eventloop.DRAIN to wait until the data sent so far is
+written to the socket. Exceptions raised on receiving a message are raised
+at the yield expression.
+
+On standalone.py without TLS, connections of coroutine handlers for RFC 6455
+are served by a single event loop thread after the opening handshake, so
+they must not block. Otherwise, coroutine handlers run in the thread
+serving the request like normal handlers. See eventloop.py for details.
+
+
 Threading
 ---------
 
@@ -193,6 +256,61 @@ A WebSocket handler must be thread-safe if the server (Apache or
 standalone.py) is configured to use threads.
 
 
+Metrics
+-------
+
+When metrics are enabled (mod_pywebsocket.metrics PythonOption or --metrics
+option of standalone.py), the dispatcher has a metrics.MetricsRegistry
+counting messages, frames, close codes and handshake failures, and
+request.ws_metrics is the metrics.ConnectionMetrics of the connection. Call
+snapshot() of the registry returned by Dispatcher.get_metrics_registry() to
+read the metrics of all connections. See metrics.py for the list of metrics.
+
+
+Keepalive
+---------
+
+When a keepalive scheduler is set (Dispatcher.set_keepalive_scheduler, the
+PythonOptions above or the --keepalive-ping-interval,
+--keepalive-pong-timeout and --idle-timeout options of standalone.py), a
+single thread sends pings on quiet connections, aborts connections whose
+peer stopped responding, and closes idle connections with status code 1001.
+Handlers see the closing handshake as if it were initiated by the client.
+See keepalive.py.
+
+
+Round-Trip Time
+---------------
+
+request.ws_stream measures the time from sending a ping (by send_ping() or
+the keepalive scheduler) to receiving the pong answering it.
+get_round_trip_time(), get_smoothed_round_trip_time() and
+get_min_round_trip_time() of request.ws_stream return the last one, their
+exponentially weighted moving average and their minimum in seconds. If
+request has on_round_trip_time_handler, it's called as
+on_round_trip_time_handler(request, seconds) on each measurement. They are
+also recorded to the round_trip_seconds histogram of metrics.
+
+
+Tracing
+-------
+
+Install a subclass of tracing.Tracer by tracing.set_tracer to be called back
+on events such as handshake start/end, frame parsed, message reassembled,
+compression by extensions and write completed. See tracing.py.
+
+
+Memory
+------
+
+memory.estimate_connection_memory(request) estimates the memory used by a
+connection per component (extension processors including zlib streams,
+stream, memorized handshake lines and the rest of the request). When a
+memory.MemorySampler is set (Dispatcher.set_memory_sampler or the
+--memory-sample-size option of standalone.py), the estimates of a random
+sample of connections are kept. See memory.py.
+
+
 Configuring WebSocket Extension Processors
 ------------------------------------------
 
@@ -41,6 +41,7 @@
 
 import socket
 
+from mod_pywebsocket import tracing
 from mod_pywebsocket import util
 
 
@@ -92,6 +93,8 @@ class InvalidUTF8Exception(Exception):
 class StreamBase(object):
     """Base stream class."""
 
+    __slots__ = ('_logger', '_request', '_tracer')
+
     def __init__(self, request):
         """Construct an instance.
 
@@ -103,6 +106,8 @@ class StreamBase(object):
 
         self._request = request
 
+        self._tracer = tracing.get_tracer()
+
     def _read(self, length):
         """Reads length bytes from connection. In case we catch any exception,
         prepends remote address to the exception message and raise again.
@@ -137,6 +142,9 @@ class StreamBase(object):
         prepends remote address to the exception message and raise again.
         """
 
+        tracer = self._tracer
+        if tracer is not None:
+            write_start = tracing.get_timestamp()
         try:
             self._request.connection.write(bytes_to_write)
         except Exception, e:
@@ -145,6 +153,10 @@ class StreamBase(object):
                             (self._request.connection.remote_addr,),
                     e)
             raise
+        if tracer is not None:
+            tracer.on_write_completed(
+                self._request, len(bytes_to_write), write_start,
+                tracing.get_timestamp())
 
     def receive_bytes(self, length):
         """Receives multiple bytes. Retries read when we couldn't receive the
@@ -51,6 +51,8 @@ class StreamHixie75(StreamBase):
     HyBi 00 and Hixie 75.
     """
 
+    __slots__ = ('_enable_closing_handshake',)
+
     def __init__(self, request, enable_closing_handshake=False):
         """Construct an instance.
 
@@ -40,9 +40,12 @@ from collections import deque
 import logging
 import os
 import struct
+import threading
 import time
 
 from mod_pywebsocket import common
+from mod_pywebsocket import metrics
+from mod_pywebsocket import tracing
 from mod_pywebsocket import util
 from mod_pywebsocket._stream_base import BadOperationException
 from mod_pywebsocket._stream_base import ConnectionTerminatedException
@@ -57,6 +60,8 @@ _NOOP_MASKER = util.NoopMasker()
 
 class Frame(object):
 
+    __slots__ = ('fin', 'rsv1', 'rsv2', 'rsv3', 'opcode', 'payload')
+
     def __init__(self, fin=1, rsv1=0, rsv2=0, rsv3=0,
                  opcode=None, payload=''):
         self.fin = fin
@@ -136,6 +141,20 @@ def _build_frame(header, body, mask):
     return header + masking_nonce + masker.mask(body)
 
 
+def _parse_header_of_built_frame(frame):
+    """Returns the opcode, FIN bit and payload length of a frame built by
+    this module.
+    """
+
+    first_byte = ord(frame[0])
+    payload_length = ord(frame[1]) & 0x7f
+    if payload_length == 126:
+        payload_length = struct.unpack('!H', frame[2:4])[0]
+    elif payload_length == 127:
+        payload_length = struct.unpack('!Q', frame[2:10])[0]
+    return first_byte & 0xf, first_byte >> 7, payload_length
+
+
 def _filter_and_format_frame_object(frame, mask, frame_filters):
     for frame_filter in frame_filters:
         frame_filter.filter(frame)
@@ -165,7 +184,7 @@ def create_text_frame(
 
 def parse_frame(receive_bytes, logger=None,
                 ws_version=common.VERSION_HYBI_LATEST,
-                unmask_receive=True):
+                unmask_receive=True, fine_log_enabled=None):
     """Parses a frame. Returns a tuple containing each header field and
     payload.
 
@@ -178,6 +197,9 @@ def parse_frame(receive_bytes, logger=None,
         ws_version: the version of WebSocket protocol.
         unmask_receive: unmask received frames. When received unmasked
             frame, raises InvalidFrameException.
+        fine_log_enabled: whether logger is enabled for
+            common.LOGLEVEL_FINE. Callers parsing many frames pass a cached
+            value (see util.LogLevelCache). If None, logger is asked once.
 
     Raises:
         ConnectionTerminatedException: when receive_bytes raises it.
@@ -186,8 +208,12 @@ def parse_frame(receive_bytes, logger=None,
 
     if not logger:
         logger = logging.getLogger()
+    if fine_log_enabled is None:
+        fine_log_enabled = logger.isEnabledFor(common.LOGLEVEL_FINE)
 
-    logger.log(common.LOGLEVEL_FINE, 'Receive the first 2 octets of a frame')
+    if fine_log_enabled:
+        logger.log(common.LOGLEVEL_FINE,
+                   'Receive the first 2 octets of a frame')
 
     received = receive_bytes(2)
 
@@ -202,10 +228,11 @@ def parse_frame(receive_bytes, logger=None,
     mask = (second_byte >> 7) & 1
     payload_length = second_byte & 0x7f
 
-    logger.log(common.LOGLEVEL_FINE,
-               'FIN=%s, RSV1=%s, RSV2=%s, RSV3=%s, opcode=%s, '
-               'Mask=%s, Payload_length=%s',
-               fin, rsv1, rsv2, rsv3, opcode, mask, payload_length)
+    if fine_log_enabled:
+        logger.log(common.LOGLEVEL_FINE,
+                   'FIN=%s, RSV1=%s, RSV2=%s, RSV3=%s, opcode=%s, '
+                   'Mask=%s, Payload_length=%s',
+                   fin, rsv1, rsv2, rsv3, opcode, mask, payload_length)
 
     if (mask == 1) != unmask_receive:
         raise InvalidFrameException(
@@ -218,8 +245,9 @@ def parse_frame(receive_bytes, logger=None,
     valid_length_encoding = True
     length_encoding_bytes = 1
     if payload_length == 127:
-        logger.log(common.LOGLEVEL_FINE,
-                   'Receive 8-octet extended payload length')
+        if fine_log_enabled:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Receive 8-octet extended payload length')
 
         extended_payload_length = receive_bytes(8)
         payload_length = struct.unpack(
@@ -231,11 +259,13 @@ def parse_frame(receive_bytes, logger=None,
             valid_length_encoding = False
             length_encoding_bytes = 8
 
-        logger.log(common.LOGLEVEL_FINE,
-                   'Decoded_payload_length=%s', payload_length)
+        if fine_log_enabled:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Decoded_payload_length=%s', payload_length)
     elif payload_length == 126:
-        logger.log(common.LOGLEVEL_FINE,
-                   'Receive 2-octet extended payload length')
+        if fine_log_enabled:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Receive 2-octet extended payload length')
 
         extended_payload_length = receive_bytes(2)
         payload_length = struct.unpack(
@@ -244,8 +274,9 @@ def parse_frame(receive_bytes, logger=None,
             valid_length_encoding = False
             length_encoding_bytes = 2
 
-        logger.log(common.LOGLEVEL_FINE,
-                   'Decoded_payload_length=%s', payload_length)
+        if fine_log_enabled:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Decoded_payload_length=%s', payload_length)
 
     if not valid_length_encoding:
         logger.warning(
@@ -255,34 +286,34 @@ def parse_frame(receive_bytes, logger=None,
             length_encoding_bytes)
 
     if mask == 1:
-        logger.log(common.LOGLEVEL_FINE, 'Receive mask')
+        if fine_log_enabled:
+            logger.log(common.LOGLEVEL_FINE, 'Receive mask')
 
         masking_nonce = receive_bytes(4)
         masker = util.RepeatedXorMasker(masking_nonce)
 
-        logger.log(common.LOGLEVEL_FINE, 'Mask=%r', masking_nonce)
+        if fine_log_enabled:
+            logger.log(common.LOGLEVEL_FINE, 'Mask=%r', masking_nonce)
     else:
         masker = _NOOP_MASKER
 
-    logger.log(common.LOGLEVEL_FINE, 'Receive payload data')
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+    if fine_log_enabled:
+        logger.log(common.LOGLEVEL_FINE, 'Receive payload data')
         receive_start = time.time()
 
     raw_payload_bytes = receive_bytes(payload_length)
 
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+    if fine_log_enabled:
         logger.log(
             common.LOGLEVEL_FINE,
             'Done receiving payload data at %s MB/s',
             payload_length / (time.time() - receive_start) / 1000 / 1000)
-    logger.log(common.LOGLEVEL_FINE, 'Unmask payload data')
-
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+        logger.log(common.LOGLEVEL_FINE, 'Unmask payload data')
         unmask_start = time.time()
 
     unmasked_bytes = masker.mask(raw_payload_bytes)
 
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+    if fine_log_enabled:
         logger.log(
             common.LOGLEVEL_FINE,
             'Done unmasking payload data at %s MB/s',
@@ -383,9 +414,18 @@ def create_closing_handshake_body(code, reason):
     return body
 
 
+# Weight of a new sample in the smoothed round-trip time. Same as the one for
+# SRTT of TCP (RFC 6298).
+_ROUND_TRIP_TIME_SMOOTHING_FACTOR = 0.125
+
+
 class StreamOptions(object):
     """Holds option values to configure Stream objects."""
 
+    __slots__ = ('outgoing_frame_filters', 'incoming_frame_filters',
+                 'outgoing_message_filters', 'incoming_message_filters',
+                 'encode_text_message_to_utf8', 'mask_send', 'unmask_receive')
+
     def __init__(self):
         """Constructs StreamOptions."""
 
@@ -407,6 +447,12 @@ class Stream(StreamBase):
     (RFC 6455).
     """
 
+    __slots__ = ('_fine_log_cache', '_options', '_received_fragments',
+                 '_original_opcode', '_writer', '_ping_queue',
+                 '_last_round_trip_time', '_smoothed_round_trip_time',
+                 '_min_round_trip_time', '_metrics', '_keepalive',
+                 '_write_lock', '_frame_start_listener', '_ping_queue_lock')
+
     def __init__(self, request, options):
         """Constructs an instance.
 
@@ -417,6 +463,8 @@ class Stream(StreamBase):
         StreamBase.__init__(self, request)
 
         self._logger = util.get_class_logger(self)
+        self._fine_log_cache = util.LogLevelCache(
+            self._logger, common.LOGLEVEL_FINE)
 
         self._options = options
 
@@ -432,7 +480,66 @@ class Stream(StreamBase):
             self._options.mask_send, self._options.outgoing_frame_filters,
             self._options.encode_text_message_to_utf8)
 
+        # Holds tuples of the body and the time of sending of pings not
+        # answered yet.
         self._ping_queue = deque()
+        # Guards _ping_queue which is updated by the thread sending pings
+        # (e.g. the keepalive scheduler) and the thread receiving pongs.
+        self._ping_queue_lock = threading.Lock()
+
+        # Round-trip times in seconds measured by matching pongs to pings.
+        # None until a ping is answered.
+        self._last_round_trip_time = None
+        self._smoothed_round_trip_time = None
+        self._min_round_trip_time = None
+
+        # metrics.ConnectionMetrics set by the opening handshake, if any.
+        self._metrics = getattr(request, 'ws_metrics', None)
+
+        # keepalive.ConnectionKeepalive set by the opening handshake, if any.
+        self._keepalive = getattr(request, 'ws_keepalive', None)
+        # Serializes writes of the thread running the handler and the
+        # keepalive scheduler.
+        self._write_lock = None
+        if self._keepalive is not None:
+            self._write_lock = threading.Lock()
+
+        # Called before receiving each frame if set. eventloop uses this to
+        # remember where each frame starts.
+        self._frame_start_listener = None
+
+    def set_frame_start_listener(self, listener):
+        """Sets a callable invoked with no arguments before receiving each
+        frame, or None to unset it. Readers of non-blocking connections use
+        this to remember where each frame starts so that a frame which
+        hasn't been fully received can be parsed again from the start.
+        """
+
+        self._frame_start_listener = listener
+
+    def _write_frame_without_lock(self, frame):
+        if self._metrics is not None:
+            opcode, fin, payload_length = _parse_header_of_built_frame(frame)
+            self._metrics.add_frame(
+                metrics.DIRECTION_OUT, opcode, fin, payload_length)
+        self._write(frame)
+
+    def _write_frame(self, frame, blocking=True):
+        """Writes a frame. Returns False without writing iff blocking is
+        False and another thread is writing to the connection.
+        """
+
+        write_lock = self._write_lock
+        if write_lock is None:
+            self._write_frame_without_lock(frame)
+            return True
+        if not write_lock.acquire(blocking):
+            return False
+        try:
+            self._write_frame_without_lock(frame)
+        finally:
+            write_lock.release()
+        return True
 
     def _receive_frame(self):
         """Receives a frame and return data in the frame as a tuple containing
@@ -444,13 +551,17 @@ class Stream(StreamBase):
             InvalidFrameException: when the frame contains invalid data.
         """
 
+        if self._frame_start_listener is not None:
+            self._frame_start_listener()
+
         def _receive_bytes(length):
             return self.receive_bytes(length)
 
         return parse_frame(receive_bytes=_receive_bytes,
                            logger=self._logger,
                            ws_version=self._request.ws_version,
-                           unmask_receive=self._options.unmask_receive)
+                           unmask_receive=self._options.unmask_receive,
+                           fine_log_enabled=self._fine_log_cache.is_enabled())
 
     def _receive_frame_as_frame_object(self):
         opcode, unmasked_bytes, fin, rsv1, rsv2, rsv3 = self._receive_frame()
@@ -505,6 +616,9 @@ class Stream(StreamBase):
             raise BadOperationException(
                 'Message for binary frame must be instance of str')
 
+        if self._keepalive is not None:
+            self._keepalive.last_activity = time.time()
+
         for message_filter in self._options.outgoing_message_filters:
             message = message_filter.filter(message, end, binary)
 
@@ -514,7 +628,7 @@ class Stream(StreamBase):
             MAX_PAYLOAD_DATA_SIZE = -1
 
             if MAX_PAYLOAD_DATA_SIZE <= 0:
-                self._write(self._writer.build(message, end, binary))
+                self._write_frame(self._writer.build(message, end, binary))
                 return
 
             bytes_written = 0
@@ -530,7 +644,7 @@ class Stream(StreamBase):
                     message[bytes_written:bytes_written + bytes_to_write],
                     end_for_this_frame,
                     binary)
-                self._write(frame)
+                self._write_frame(frame)
 
                 bytes_written += bytes_to_write
 
@@ -541,6 +655,58 @@ class Stream(StreamBase):
         except ValueError, e:
             raise BadOperationException(e)
 
+    def send_messages(self, messages, binary=False):
+        """Send messages with a single write to the connection. Each message
+        is sent as an unfragmented frame.
+
+        Args:
+            messages: list of text in unicode or binary in str to send.
+            binary: send messages as binary frames.
+
+        Raises:
+            BadOperationException: when called on a server-terminated
+                connection or called with inconsistent message type or
+                binary parameter.
+        """
+
+        if self._request.server_terminated:
+            raise BadOperationException(
+                'Requested send_messages after sending out a closing '
+                'handshake')
+
+        frames = []
+        try:
+            for message in messages:
+                if binary and isinstance(message, unicode):
+                    raise BadOperationException(
+                        'Message for binary frame must be instance of str')
+
+                for message_filter in self._options.outgoing_message_filters:
+                    message = message_filter.filter(message, True, binary)
+
+                frames.append(self._writer.build(message, True, binary))
+        except ValueError, e:
+            raise BadOperationException(e)
+
+        if self._metrics is not None:
+            for frame in frames:
+                opcode, fin, payload_length = (
+                    _parse_header_of_built_frame(frame))
+                self._metrics.add_frame(
+                    metrics.DIRECTION_OUT, opcode, fin, payload_length)
+
+        if self._keepalive is not None:
+            self._keepalive.last_activity = time.time()
+
+        write_lock = self._write_lock
+        if write_lock is not None:
+            write_lock.acquire()
+        try:
+            self._write(''.join(frames))
+        finally:
+            if write_lock is not None:
+                write_lock.release()
+
     def _get_message_from_frame(self, frame):
         """Gets a message from frame. If the message is composed of fragmented
         frames and the frame is not the last fragmented frame, this method
@@ -636,6 +802,10 @@ class Stream(StreamBase):
                 self._request.ws_close_code,
                 self._request.ws_close_reason)
 
+        if self._metrics is not None:
+            self._metrics.add_close_code(
+                metrics.DIRECTION_IN, self._request.ws_close_code)
+
         # As we've received a close frame, no more data is coming over the
         # socket. We can now safely close the socket without worrying about
         # RST sending.
@@ -690,26 +860,35 @@ class Stream(StreamBase):
 
         # TODO(tyoshino): Add ping timeout handling.
 
-        inflight_pings = deque()
+        received_at = tracing.get_timestamp()
+        sent_at = None
+        ignored_pings = 0
 
-        while True:
-            try:
-                expected_body = self._ping_queue.popleft()
+        self._ping_queue_lock.acquire()
+        try:
+            for i, (expected_body, ping_sent_at) in enumerate(
+                    self._ping_queue):
                 if expected_body == message:
-                    # inflight_pings contains pings ignored by the
-                    # other peer. Just forget them.
-                    self._logger.debug(
-                        'Ping %r is acked (%d pings were ignored)',
-                        expected_body, len(inflight_pings))
+                    sent_at = ping_sent_at
+                    ignored_pings = i
                     break
-                else:
-                    inflight_pings.append(expected_body)
-            except IndexError, e:
-                # The received pong was unsolicited pong. Keep the
-                # ping queue as is.
-                self._ping_queue = inflight_pings
-                self._logger.debug('Received a unsolicited pong')
-                break
+            if sent_at is not None:
+                # Pings queued before the acked one were ignored by the
+                # other peer. Just forget them.
+                for i in xrange(ignored_pings + 1):
+                    self._ping_queue.popleft()
+        finally:
+            self._ping_queue_lock.release()
+
+        if sent_at is None:
+            # The received pong was unsolicited pong. The ping queue is
+            # kept as is.
+            self._logger.debug('Received a unsolicited pong')
+        else:
+            self._logger.debug(
+                'Ping %r is acked (%d pings were ignored)',
+                message, ignored_pings)
+            self._add_round_trip_time(received_at - sent_at)
 
         try:
             handler = self._request.on_pong_handler
@@ -718,6 +897,25 @@ class Stream(StreamBase):
         except AttributeError, e:
             pass
 
+    def _add_round_trip_time(self, round_trip_time):
+        self._last_round_trip_time = round_trip_time
+        if self._smoothed_round_trip_time is None:
+            self._smoothed_round_trip_time = round_trip_time
+        else:
+            self._smoothed_round_trip_time += (
+                _ROUND_TRIP_TIME_SMOOTHING_FACTOR *
+                (round_trip_time - self._smoothed_round_trip_time))
+        if (self._min_round_trip_time is None or
+            round_trip_time < self._min_round_trip_time):
+            self._min_round_trip_time = round_trip_time
+
+        if self._metrics is not None:
+            self._metrics.add_round_trip_time(round_trip_time)
+
+        handler = getattr(self._request, 'on_round_trip_time_handler', None)
+        if handler:
+            handler(self._request, round_trip_time)
+
     def receive_message(self):
         """Receive a WebSocket frame and return its payload as a text in
         unicode or a binary in str.
@@ -750,6 +948,20 @@ class Stream(StreamBase):
 
             frame = self._receive_frame_as_frame_object()
 
+            if self._keepalive is not None:
+                now = time.time()
+                self._keepalive.last_received = now
+                if not common.is_control_opcode(frame.opcode):
+                    self._keepalive.last_activity = now
+            if self._metrics is not None:
+                self._metrics.add_frame(
+                    metrics.DIRECTION_IN, frame.opcode, frame.fin,
+                    len(frame.payload))
+            if self._tracer is not None:
+                self._tracer.on_frame_parsed(
+                    self._request, frame.opcode, frame.fin,
+                    len(frame.payload), tracing.get_timestamp())
+
             # Check the constraint on the payload size for control frames
             # before extension processes the frame.
             # See also http://tools.ietf.org/html/rfc6455#section-5.5
@@ -774,6 +986,11 @@ class Stream(StreamBase):
             for message_filter in self._options.incoming_message_filters:
                 message = message_filter.filter(message)
 
+            if self._tracer is not None:
+                self._tracer.on_message_reassembled(
+                    self._request, self._original_opcode, len(message),
+                    tracing.get_timestamp())
+
             if self._original_opcode == common.OPCODE_TEXT:
                 # The WebSocket protocol section 4.4 specifies that invalid
                 # characters must be replaced with U+fffd REPLACEMENT
@@ -795,15 +1012,60 @@ class Stream(StreamBase):
                 raise UnsupportedFrameException(
                     'Opcode %d is not supported' % self._original_opcode)
 
-    def _send_closing_handshake(self, code, reason):
+    def _send_closing_handshake(self, code, reason, blocking=True):
+        """Sends a close frame. Returns False without sending iff blocking is
+        False and another thread is writing to the connection.
+        """
+
         body = create_closing_handshake_body(code, reason)
         frame = create_close_frame(
             body, mask=self._options.mask_send,
             frame_filters=self._options.outgoing_frame_filters)
 
-        self._request.server_terminated = True
+        write_lock = self._write_lock
+        if write_lock is not None and not write_lock.acquire(blocking):
+            return False
+        try:
+            self._request.server_terminated = True
+
+            if self._metrics is not None:
+                self._metrics.add_close_code(metrics.DIRECTION_OUT, code)
+            self._write_frame_without_lock(frame)
+        finally:
+            if write_lock is not None:
+                write_lock.release()
+        return True
+
+    def _send_closing_handshake_nonblocking(self, code, reason):
+        """Sends a close frame only as far as the connection accepts it
+        without blocking. Used before aborting a connection whose writes may
+        be blocked. Returns True iff the whole frame has been written.
+        Nothing is written if another thread is writing to the connection or
+        the connection doesn't have write_nonblocking().
+        """
 
-        self._write(frame)
+        write_nonblocking = getattr(
+            self._request.connection, 'write_nonblocking', None)
+        if write_nonblocking is None:
+            return False
+
+        body = create_closing_handshake_body(code, reason)
+        frame = create_close_frame(
+            body, mask=self._options.mask_send,
+            frame_filters=self._options.outgoing_frame_filters)
+
+        write_lock = self._write_lock
+        if write_lock is not None and not write_lock.acquire(False):
+            return False
+        try:
+            self._request.server_terminated = True
+
+            if self._metrics is not None:
+                self._metrics.add_close_code(metrics.DIRECTION_OUT, code)
+            return write_nonblocking(frame) == len(frame)
+        finally:
+            if write_lock is not None:
+                write_lock.release()
 
     def close_connection(self, code=common.STATUS_NORMAL_CLOSURE, reason='',
                          wait_response=True):
@@ -859,21 +1121,63 @@ class Stream(StreamBase):
         # TODO: 3. close the WebSocket connection.
         # note: mod_python Connection (mp_conn) doesn't have close method.
 
-    def send_ping(self, body=''):
+    def send_ping(self, body='', blocking=True):
+        """Sends a ping. Returns False without sending iff blocking is False
+        and another thread is writing to the connection.
+        """
+
         frame = create_ping_frame(
             body,
             self._options.mask_send,
             self._options.outgoing_frame_filters)
-        self._write(frame)
-
-        self._ping_queue.append(body)
+        # Queue the body first so that the pong isn't taken as unsolicited
+        # when it's processed by another thread before this returns.
+        ping = (body, tracing.get_timestamp())
+        self._ping_queue_lock.acquire()
+        try:
+            self._ping_queue.append(ping)
+        finally:
+            self._ping_queue_lock.release()
+        if not self._write_frame(frame, blocking):
+            # Pings sent by other threads may have been queued after this
+            # one meanwhile. Remove exactly this one.
+            self._ping_queue_lock.acquire()
+            try:
+                self._ping_queue.remove(ping)
+            except ValueError, e:
+                pass
+            finally:
+                self._ping_queue_lock.release()
+            return False
+        return True
 
     def _send_pong(self, body):
         frame = create_pong_frame(
             body,
             self._options.mask_send,
             self._options.outgoing_frame_filters)
-        self._write(frame)
+        self._write_frame(frame)
+
+    def get_round_trip_time(self):
+        """Returns the time in seconds from sending the last ping answered by
+        a pong to receiving the pong, or None if no ping has been answered.
+        """
+
+        return self._last_round_trip_time
+
+    def get_smoothed_round_trip_time(self):
+        """Returns the exponentially weighted moving average of round-trip
+        times, or None if no ping has been answered.
+        """
+
+        return self._smoothed_round_trip_time
+
+    def get_min_round_trip_time(self):
+        """Returns the minimum of round-trip times, or None if no ping has
+        been answered.
+        """
+
+        return self._min_round_trip_time
 
     def get_last_received_opcode(self):
         """Returns the opcode of the WebSocket message which the last received
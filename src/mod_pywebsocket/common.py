@@ -128,6 +128,7 @@ STATUS_POLICY_VIOLATION = 1008
 STATUS_MESSAGE_TOO_BIG = 1009
 STATUS_MANDATORY_EXTENSION = 1010
 STATUS_INTERNAL_ENDPOINT_ERROR = 1011
+STATUS_TRY_AGAIN_LATER = 1013
 STATUS_TLS_HANDSHAKE = 1015
 STATUS_USER_REGISTERED_BASE = 3000
 STATUS_USER_REGISTERED_MAX = 3999
@@ -146,6 +147,7 @@ STATUS_MANDATORY_EXT = STATUS_MANDATORY_EXTENSION
 HTTP_STATUS_BAD_REQUEST = 400
 HTTP_STATUS_FORBIDDEN = 403
 HTTP_STATUS_NOT_FOUND = 404
+HTTP_STATUS_SERVICE_UNAVAILABLE = 503
 
 
 def is_control_opcode(opcode):
@@ -157,6 +159,8 @@ class ExtensionParameter(object):
     negotiation in opening handshake.
     """
 
+    __slots__ = ('_name', '_parameters')
+
     def __init__(self, name):
         self._name = name
         # TODO(tyoshino): Change the data structure to more efficient one such
@@ -32,11 +32,16 @@
 """
 
 
+import imp
 import logging
+import marshal
 import os
 import re
+import threading
+import types
 
 from mod_pywebsocket import common
+from mod_pywebsocket import eventloop
 from mod_pywebsocket import handshake
 from mod_pywebsocket import msgutil
 from mod_pywebsocket import mux
@@ -50,6 +55,14 @@ _DO_EXTRA_HANDSHAKE_HANDLER_NAME = 'web_socket_do_extra_handshake'
 _TRANSFER_DATA_HANDLER_NAME = 'web_socket_transfer_data'
 _PASSIVE_CLOSING_HANDSHAKE_HANDLER_NAME = (
     'web_socket_passive_closing_handshake')
+# Suffix of files in the handler bytecode cache directory.
+_BYTECODE_CACHE_SUFFIX = '.wshc'
+# A segment of a resource path pattern which matches any one non-empty
+# segment and captures it under the name in braces.
+_PATH_PARAMETER_SEGMENT_PATTERN = re.compile(r'^\{([A-Za-z_][A-Za-z0-9_]*)\}$')
+# The last segment of a resource path pattern which matches any remaining
+# segments.
+_PREFIX_WILDCARD_SEGMENT = '*'
 
 
 class DispatchException(Exception):
@@ -133,12 +146,85 @@ class _HandlerSuite(object):
         self.passive_closing_handshake = passive_closing_handshake
 
 
+def _compile_handler_file(path, bytecode_cache_dir=None):
+    """Compile a handler definition file into a code object.
+
+    If bytecode_cache_dir is given, the compiled code is stored there and
+    reused as long as the modification time and the size of the handler file
+    don't change.
+
+    Args:
+        path: the path to the handler definition file.
+        bytecode_cache_dir: the directory to cache compiled code in, or None.
+
+    Raises:
+        DispatchException: when the file cannot be read or compiled.
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError, e:
+        raise DispatchException('Failed to stat handler: %s' % e)
+    key = (imp.get_magic(), stat.st_mtime, stat.st_size)
+
+    cache_path = None
+    if bytecode_cache_dir is not None:
+        cache_path = os.path.join(
+            bytecode_cache_dir,
+            util.sha1_hash(os.path.realpath(path)).hexdigest() +
+            _BYTECODE_CACHE_SUFFIX)
+        try:
+            f = open(cache_path, 'rb')
+            try:
+                cached_key, code = marshal.load(f)
+            finally:
+                f.close()
+            if cached_key == key:
+                return code
+        except (IOError, EOFError, ValueError, TypeError):
+            # Missing, stale or broken cache entry. Just recompile.
+            pass
+
+    try:
+        f = open(path)
+        try:
+            handler_definition = f.read()
+        finally:
+            f.close()
+        code = compile(handler_definition, path, 'exec')
+    except Exception:
+        raise DispatchException('Error in sourcing handler:' +
+                                util.get_stack_trace())
+
+    if cache_path is not None:
+        # Write to a temporary file and rename it so that other processes
+        # sharing the cache never see a partially written entry.
+        temporary_path = '%s.%d' % (cache_path, os.getpid())
+        try:
+            f = open(temporary_path, 'wb')
+            try:
+                marshal.dump((key, code), f)
+            finally:
+                f.close()
+            os.rename(temporary_path, cache_path)
+        except (IOError, OSError), e:
+            logging.getLogger(__name__).debug(
+                'Failed to write bytecode cache %s: %s', cache_path, e)
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+
+    return code
+
+
 def _source_handler_file(handler_definition):
     """Source a handler definition string.
 
     Args:
         handler_definition: a string containing Python statements that define
-                            handler functions.
+                            handler functions, or a code object compiled from
+                            such a string.
     """
 
     global_dic = {}
@@ -173,6 +259,177 @@ def _extract_handler(dic, name):
     return handler
 
 
+class _LazyHandlerSuite(object):
+    """A placeholder for a handler suite whose definition file has been found
+    but not sourced yet. The file is sourced on the first call of resolve().
+    """
+
+    def __init__(self, path, bytecode_cache_dir):
+        self._path = path
+        self._bytecode_cache_dir = bytecode_cache_dir
+        self._lock = threading.Lock()
+        self._resolved = False
+        self._handler_suite = None
+        self._error = None
+
+    def resolve(self):
+        """Sources the handler definition file if not yet and returns the
+        resulting _HandlerSuite.
+
+        Raises:
+            DispatchException: when sourcing failed. The same exception is
+                               raised for all the subsequent calls.
+        """
+
+        self._lock.acquire()
+        try:
+            if not self._resolved:
+                try:
+                    self._handler_suite = _source_handler_file(
+                        _compile_handler_file(
+                            self._path, self._bytecode_cache_dir))
+                except DispatchException, e:
+                    self._error = e
+                self._resolved = True
+        finally:
+            self._lock.release()
+
+        if self._error is not None:
+            raise self._error
+        return self._handler_suite
+
+    def path(self):
+        return self._path
+
+
+def is_resource_path_pattern(path):
+    """Returns True if the given resource path contains path parameter
+    segments or a prefix wildcard, i.e. it must be registered by
+    Dispatcher.add_resource_path_pattern rather than
+    Dispatcher.add_resource_path_alias.
+    """
+
+    return '{' in path or path.endswith('/' + _PREFIX_WILDCARD_SEGMENT)
+
+
+class _ResourcePatternNode(object):
+    """A node of _ResourcePatternTrie. Corresponds to a path segment."""
+
+    def __init__(self):
+        # Map from literal segment to child node.
+        self.children = {}
+        # Child node for a path parameter segment and the parameter name.
+        self.parameter_child = None
+        self.parameter_name = None
+        # Handler suite for patterns ending at this node.
+        self.handler_suite = None
+        # Handler suite for patterns ending with the prefix wildcard just
+        # after this node.
+        self.prefix_handler_suite = None
+
+
+class _ResourcePatternTrie(object):
+    """Matches resources against resource path patterns.
+
+    Patterns are split into '/' separated segments and stored in a trie so
+    that the cost of matching depends on the number of segments in the
+    resource rather than the number of registered patterns. A segment is
+    either a literal, {name} which matches any non-empty segment and captures
+    it as a parameter, or * as the last segment which matches any remaining
+    segments. Literal segments take precedence over parameters, and
+    parameters over the wildcard.
+    """
+
+    def __init__(self):
+        self._root = _ResourcePatternNode()
+
+    def add(self, pattern, handler_suite):
+        """Adds a pattern.
+
+        Raises:
+            DispatchException: when the pattern is malformed or conflicts
+                               with an existing one.
+        """
+
+        if not pattern.startswith('/'):
+            raise DispatchException(
+                'Resource path pattern must start with /: %r' % pattern)
+
+        segments = pattern.split('/')[1:]
+        node = self._root
+        for index, segment in enumerate(segments):
+            if segment == _PREFIX_WILDCARD_SEGMENT:
+                if index != len(segments) - 1:
+                    raise DispatchException(
+                        '%s must be the last segment: %r' %
+                        (_PREFIX_WILDCARD_SEGMENT, pattern))
+                if node.prefix_handler_suite is not None:
+                    raise DispatchException(
+                        'Resource path pattern is already registered: %r' %
+                        pattern)
+                node.prefix_handler_suite = handler_suite
+                return
+
+            match = _PATH_PARAMETER_SEGMENT_PATTERN.match(segment)
+            if match:
+                name = match.group(1)
+                if node.parameter_child is None:
+                    node.parameter_child = _ResourcePatternNode()
+                    node.parameter_name = name
+                elif node.parameter_name != name:
+                    raise DispatchException(
+                        'Parameter {%s} conflicts with {%s} registered for '
+                        'the same position: %r' %
+                        (name, node.parameter_name, pattern))
+                node = node.parameter_child
+            elif ('{' in segment or '}' in segment or
+                  _PREFIX_WILDCARD_SEGMENT in segment):
+                raise DispatchException(
+                    'Invalid segment %r in resource path pattern: %r' %
+                    (segment, pattern))
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = _ResourcePatternNode()
+                    node.children[segment] = child
+                node = child
+        if node.handler_suite is not None:
+            raise DispatchException(
+                'Resource path pattern is already registered: %r' % pattern)
+        node.handler_suite = handler_suite
+
+    def match(self, resource):
+        """Returns a tuple of the handler suite and a dict of captured
+        parameters for the given resource, or (None, None) if no pattern
+        matches.
+        """
+
+        parameters = {}
+        handler_suite = self._match(
+            self._root, resource.split('/')[1:], 0, parameters)
+        if handler_suite is None:
+            return None, None
+        return handler_suite, parameters
+
+    def _match(self, node, segments, index, parameters):
+        if index == len(segments):
+            return node.handler_suite
+
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child is not None:
+            handler_suite = self._match(child, segments, index + 1, parameters)
+            if handler_suite is not None:
+                return handler_suite
+        if node.parameter_child is not None and segment:
+            handler_suite = self._match(
+                node.parameter_child, segments, index + 1, parameters)
+            if handler_suite is not None:
+                parameters[node.parameter_name] = segment
+                return handler_suite
+        return node.prefix_handler_suite
+
+
 class Dispatcher(object):
     """Dispatches WebSocket requests.
 
@@ -181,7 +438,8 @@ class Dispatcher(object):
 
     def __init__(
         self, root_dir, scan_dir=None,
-        allow_handlers_outside_root_dir=True):
+        allow_handlers_outside_root_dir=True, lazy_load=False,
+        bytecode_cache_dir=None):
         """Construct an instance.
 
         Args:
@@ -195,12 +453,30 @@ class Dispatcher(object):
                       subdirectories.
             allow_handlers_outside_root_dir: Scans handler files even if their
                       canonical path is not under root_dir.
+            lazy_load: If True, handler files are only indexed here and each
+                      of them is sourced on the first request for its
+                      resource. Errors in sourcing are then reported via
+                      source_warnings() after the first request, not at
+                      construction time.
+            bytecode_cache_dir: The directory where compiled handler files are
+                      cached. If None, handler files are compiled every time
+                      they are sourced.
         """
 
         self._logger = util.get_class_logger(self)
 
         self._handler_suite_map = {}
+        self._resource_patterns = _ResourcePatternTrie()
         self._source_warnings = []
+        # Protects _source_warnings against concurrent lazy loading.
+        self._source_warnings_lock = threading.Lock()
+        self._lazy_load = lazy_load
+        self._bytecode_cache_dir = bytecode_cache_dir
+        self._mux_worker_pool = None
+        self._mux_receive_window_budget = None
+        self._metrics_registry = None
+        self._keepalive_scheduler = None
+        self._memory_sampler = None
         if scan_dir is None:
             scan_dir = root_dir
         if not os.path.realpath(scan_dir).startswith(
@@ -210,6 +486,74 @@ class Dispatcher(object):
         self._source_handler_files_in_dir(
             root_dir, scan_dir, allow_handlers_outside_root_dir)
 
+    def set_mux_worker_pool(self, worker_pool):
+        """Set the pool to run handlers of multiplexed logical channels on.
+
+        Args:
+            worker_pool: msgutil.MessageWorkerPool instance. If None, each
+                logical channel runs on a thread of its own.
+        """
+
+        self._mux_worker_pool = worker_pool
+
+    def get_mux_worker_pool(self):
+        return self._mux_worker_pool
+
+    def set_mux_receive_window_budget(self, budget):
+        """Set the number of octets multiplexed logical channels on a
+        physical connection may buffer in total.
+
+        Args:
+            budget: If not None, receive windows of logical channels are
+                adjusted to how fast their handlers consume data within
+                budget. If None, they're fixed to the initial quota.
+        """
+
+        self._mux_receive_window_budget = budget
+
+    def get_mux_receive_window_budget(self):
+        return self._mux_receive_window_budget
+
+    def set_metrics_registry(self, registry):
+        """Set the registry to record metrics of connections to.
+
+        Args:
+            registry: metrics.MetricsRegistry instance. If None, metrics are
+                not recorded.
+        """
+
+        self._metrics_registry = registry
+
+    def get_metrics_registry(self):
+        return self._metrics_registry
+
+    def set_keepalive_scheduler(self, scheduler):
+        """Set the scheduler to send keepalive pings and close idle
+        connections by.
+
+        Args:
+            scheduler: keepalive.KeepaliveScheduler instance. If None,
+                connections are left as they are.
+        """
+
+        self._keepalive_scheduler = scheduler
+
+    def get_keepalive_scheduler(self):
+        return self._keepalive_scheduler
+
+    def set_memory_sampler(self, sampler):
+        """Set the sampler to estimate memory of connections by.
+
+        Args:
+            sampler: memory.MemorySampler instance. If None, memory of
+                connections is not estimated.
+        """
+
+        self._memory_sampler = sampler
+
+    def get_memory_sampler(self):
+        return self._memory_sampler
+
     def add_resource_path_alias(self,
                                 alias_resource_path, existing_resource_path):
         """Add resource path alias.
@@ -228,6 +572,29 @@ class Dispatcher(object):
             raise DispatchException('No handler for: %r' %
                                     existing_resource_path)
 
+    def add_resource_path_pattern(self, pattern, existing_resource_path):
+        """Add resource path pattern.
+
+        Once added, requests to resources matching pattern would be handled
+        by handler registered for existing_resource_path, unless there's a
+        handler or an alias registered for the exact resource. Segments of
+        the form {name} match any non-empty segment and the matched values
+        are set to request.ws_resource_params. A trailing * matches any
+        remaining segments. E.g. /room/{room_id} matches /room/123 with
+        {'room_id': '123'}, and /static/* matches /static/a/b.
+
+        Args:
+            pattern: resource path pattern
+            existing_resource_path: existing resource path
+        """
+
+        try:
+            handler_suite = self._handler_suite_map[existing_resource_path]
+        except KeyError:
+            raise DispatchException('No handler for: %r' %
+                                    existing_resource_path)
+        self._resource_patterns.add(pattern, handler_suite)
+
     def source_warnings(self):
         """Return warnings in sourcing handlers."""
 
@@ -248,7 +615,8 @@ class Dispatcher(object):
             HandshakeException: when opening handshake failed
         """
 
-        handler_suite = self.get_handler_suite(request.ws_resource)
+        handler_suite, request.ws_resource_params = (
+            self._get_handler_suite_and_params(request.ws_resource))
         if handler_suite is None:
             raise DispatchException('No handler for: %r' % request.ws_resource)
         do_extra_handshake_ = handler_suite.do_extra_handshake
@@ -271,7 +639,8 @@ class Dispatcher(object):
         """Let a handler transfer_data with a WebSocket client.
 
         Select a handler based on request.ws_resource and call its
-        web_socket_transfer_data function.
+        web_socket_transfer_data function. If it's a coroutine handler, run
+        it by eventloop.run_coroutine_handler.
 
         Args:
             request: mod_python request.
@@ -281,17 +650,51 @@ class Dispatcher(object):
             AbortedByUserException: when user handler abort connection
         """
 
+        # Keepalive is done only for RFC 6455 connections without
+        # multiplexing. Logical channels don't have ws_keepalive.
+        keepalive = getattr(request, 'ws_keepalive', None)
+        if (keepalive is not None and
+            (not isinstance(request.ws_stream, stream.Stream) or
+             mux.use_mux(request))):
+            keepalive = None
+        if keepalive is not None:
+            keepalive.start()
+
+        if self._memory_sampler is not None:
+            self._memory_sampler.add(request, (self,))
+
+        handed_over = False
+        try:
+            handed_over = self._transfer_data(request)
+        finally:
+            if not handed_over:
+                if keepalive is not None:
+                    keepalive.stop()
+                metrics = getattr(request, 'ws_metrics', None)
+                if metrics is not None:
+                    metrics.close()
+
+    def _transfer_data(self, request):
+        """Runs the handler for transfer_data. Returns True iff the
+        connection has been handed over to an event loop.
+        """
+
         # TODO(tyoshino): Terminate underlying TCP connection if possible.
         try:
             if mux.use_mux(request):
                 mux.start(request, self)
             else:
-                handler_suite = self.get_handler_suite(request.ws_resource)
+                handler_suite, request.ws_resource_params = (
+                    self._get_handler_suite_and_params(request.ws_resource))
                 if handler_suite is None:
                     raise DispatchException('No handler for: %r' %
                                             request.ws_resource)
                 transfer_data_ = handler_suite.transfer_data
-                transfer_data_(request)
+                result = transfer_data_(request)
+                if (isinstance(result, types.GeneratorType) and
+                    eventloop.run_coroutine_handler(request, result)):
+                    # The connection has been handed over to an event loop.
+                    return True
 
             if not request.server_terminated:
                 request.ws_stream.close_connection()
@@ -325,6 +728,7 @@ class Dispatcher(object):
                     _TRANSFER_DATA_HANDLER_NAME, request.ws_resource),
                 e)
             raise
+        return False
 
     def passive_closing_handshake(self, request):
         """Prepare code and reason for responding client initiated closing
@@ -341,17 +745,31 @@ class Dispatcher(object):
         for data transfer) for the given request as a HandlerSuite object.
         """
 
+        return self._get_handler_suite_and_params(resource)[0]
+
+    def _get_handler_suite_and_params(self, resource):
+        """Retrieves the handler suite for the given resource and a dict of
+        parameters captured by the resource path pattern it matched. The
+        dict is empty if the resource matched exactly.
+        """
+
         fragment = None
         if '#' in resource:
             resource, fragment = resource.split('#', 1)
         if '?' in resource:
             resource = resource.split('?', 1)[0]
         handler_suite = self._handler_suite_map.get(resource)
+        params = {}
+        if handler_suite is None:
+            handler_suite, params = self._resource_patterns.match(resource)
+        if isinstance(handler_suite, _LazyHandlerSuite):
+            handler_suite = self._resolve_lazy_handler_suite(
+                resource, handler_suite)
         if handler_suite and fragment:
             raise DispatchException('Fragment identifiers MUST NOT be used on '
                                     'WebSocket URIs',
                                     common.HTTP_STATUS_BAD_REQUEST)
-        return handler_suite
+        return handler_suite, params
 
     def _source_handler_files_in_dir(
         self, root_dir, scan_dir, allow_handlers_outside_root_dir):
@@ -377,11 +795,16 @@ class Dispatcher(object):
                     'Canonical path of %s is not under root directory' %
                     path)
                 continue
-            try:
-                handler_suite = _source_handler_file(open(path).read())
-            except DispatchException, e:
-                self._source_warnings.append('%s: %s' % (path, e))
-                continue
+            if self._lazy_load:
+                handler_suite = _LazyHandlerSuite(
+                    path, self._bytecode_cache_dir)
+            else:
+                try:
+                    handler_suite = _source_handler_file(
+                        _compile_handler_file(path, self._bytecode_cache_dir))
+                except DispatchException, e:
+                    self._source_warnings.append('%s: %s' % (path, e))
+                    continue
             resource = convert(path)
             if resource is None:
                 self._logger.debug(
@@ -389,5 +812,27 @@ class Dispatcher(object):
             else:
                 self._handler_suite_map[convert(path)] = handler_suite
 
+    def _resolve_lazy_handler_suite(self, resource, lazy_handler_suite):
+        """Sources the handler file for a lazily loaded resource. Returns the
+        handler suite, or None if sourcing failed.
+        """
+
+        try:
+            handler_suite = lazy_handler_suite.resolve()
+        except DispatchException, e:
+            warning = '%s: %s' % (lazy_handler_suite.path(), e)
+            self._source_warnings_lock.acquire()
+            try:
+                if warning in self._source_warnings:
+                    return None
+                self._source_warnings.append(warning)
+            finally:
+                self._source_warnings_lock.release()
+            self._logger.warning('Warning in source loading: %s', warning)
+            return None
+        self._logger.debug('Sourced handler for %r on first request',
+                           resource)
+        return handler_suite
+
 
 # vi:sts=4 sw=4 et
@@ -0,0 +1,854 @@
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Event loop for coroutine WebSocket handlers.
+
+A coroutine handler is a web_socket_transfer_data written as a generator
+function. Instead of blocking in request.ws_stream.receive_message(), it
+suspends at a yield expression and is resumed with the next message, or None
+on receiving client-initiated closing handshake:
+
+    def web_socket_transfer_data(request):
+        while True:
+            message = yield
+            if message is None:
+                return
+            request.ws_stream.send_message(message)
+
+Yielding DRAIN suspends the handler until all data sent so far is written to
+the socket.
+
+standalone.py hands connections handled by coroutine handlers over to an
+EventLoop once the opening handshake is done. An EventLoop multiplexes all of
+them on a single thread, so idle connections don't occupy a thread each.
+Everywhere else (mod_python, logical channels of the multiplexing extension,
+TLS and protocols older than RFC 6455), run_coroutine_handler drives the
+coroutine in the calling thread using the blocking receive_message().
+"""
+
+
+from collections import deque
+import errno
+import heapq
+import select
+import socket
+import sys
+import threading
+import time
+
+from mod_pywebsocket import common
+from mod_pywebsocket._stream_base import BadOperationException
+from mod_pywebsocket._stream_base import ConnectionTerminatedException
+from mod_pywebsocket._stream_base import InvalidFrameException
+from mod_pywebsocket._stream_base import InvalidUTF8Exception
+from mod_pywebsocket._stream_base import UnsupportedFrameException
+from mod_pywebsocket._stream_hybi import Stream
+from mod_pywebsocket import util
+
+
+class _Drain(object):
+    def __repr__(self):
+        return 'DRAIN'
+
+
+# Yield this from a coroutine handler to wait until the data sent so far is
+# flushed to the socket.
+DRAIN = _Drain()
+
+_RECEIVE_SIZE = 64 * 1024
+
+_WOULD_BLOCK_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Status code of the close frame sent when receive_message raised an exception
+# which the coroutine handler didn't catch. Same as Dispatcher.transfer_data.
+_CLOSE_STATUS_FOR_EXCEPTIONS = [
+    (BadOperationException, common.STATUS_INTERNAL_ENDPOINT_ERROR),
+    (InvalidFrameException, common.STATUS_PROTOCOL_ERROR),
+    (UnsupportedFrameException, common.STATUS_UNSUPPORTED_DATA),
+    (InvalidUTF8Exception, common.STATUS_INVALID_FRAME_PAYLOAD_DATA),
+]
+
+# States of _HandlerTask.
+_STATE_RECEIVING = 1  # The coroutine waits for a message.
+_STATE_DRAINING = 2  # The coroutine waits for the write buffer to be flushed.
+_STATE_CLOSING = 3  # Waiting for the ack of closing handshake.
+_STATE_CLOSED = 4
+
+
+class _NeedMoreData(Exception):
+    """Raised by _EventLoopConnection.read when the bytes requested haven't
+    arrived yet.
+    """
+
+    pass
+
+
+class _RewindableReadBuffer(object):
+    """Buffer of received bytes which can be read again from the last mark.
+
+    Received chunks are kept in a list and joined only when a read needs
+    them, so receiving a large frame in many chunks copies each byte once.
+    When a read runs short, the number of bytes it needs since the last mark
+    is recorded and has_needed_data() tells whether retrying can succeed,
+    so a frame isn't parsed again for every chunk of its payload.
+    """
+
+    def __init__(self, data=''):
+        self._read_buffer = data
+        self._read_chunks = []
+        self._read_chunks_length = 0
+        self._read_position = 0
+        self._read_mark = 0
+        self._needed_length = 0
+        self._eof = False
+
+    def _append(self, data):
+        self._read_chunks.append(data)
+        self._read_chunks_length += len(data)
+
+    def _get_available_length(self):
+        return (len(self._read_buffer) - self._read_position +
+                self._read_chunks_length)
+
+    def _read_buffered(self, length):
+        """Returns length bytes from the buffer, or None after recording the
+        needed length if they haven't been received yet.
+        """
+
+        if len(self._read_buffer) - self._read_position < length:
+            if self._get_available_length() < length:
+                self._needed_length = (
+                    self._read_position - self._read_mark + length)
+                return None
+            # Drop the bytes which can never be rewound to.
+            self._read_chunks.insert(0, self._read_buffer[self._read_mark:])
+            self._read_buffer = ''.join(self._read_chunks)
+            self._read_chunks = []
+            self._read_chunks_length = 0
+            self._read_position -= self._read_mark
+            self._read_mark = 0
+        start = self._read_position
+        self._read_position += length
+        return self._read_buffer[start:self._read_position]
+
+    def mark(self):
+        self._read_mark = self._read_position
+        self._needed_length = 0
+        if self._read_position == len(self._read_buffer):
+            # Release the bytes consumed so far.
+            self._read_buffer = ''
+            self._read_position = 0
+            self._read_mark = 0
+
+    def rewind(self):
+        self._read_position = self._read_mark
+
+    def is_eof(self):
+        return self._eof
+
+    def has_needed_data(self):
+        """Returns False iff the bytes buffered since the last mark are
+        known to be too few for the last read which ran short.
+        """
+
+        return (self._eof or
+                (len(self._read_buffer) - self._read_mark +
+                 self._read_chunks_length) >= self._needed_length)
+
+
+def run_coroutine_handler(request, coroutine):
+    """Runs a coroutine handler returned by web_socket_transfer_data.
+
+    If the request has an EventLoop, the connection is handed over to it and
+    this function returns True immediately. The caller must not touch the
+    connection after that. Otherwise, drives the coroutine in the calling
+    thread and returns False when it finishes. Exceptions the coroutine
+    doesn't catch are propagated to the caller.
+
+    Args:
+        request: mod_python request.
+        coroutine: generator returned by web_socket_transfer_data.
+    """
+
+    event_loop = getattr(request, '_event_loop', None)
+    if event_loop is not None and isinstance(request.ws_stream, Stream):
+        event_loop.adopt(request, coroutine)
+        return True
+
+    try:
+        value = coroutine.next()
+        while True:
+            if value is DRAIN:
+                # Writes are blocking here. Nothing to wait for.
+                value = coroutine.send(None)
+            elif value is not None:
+                value = coroutine.throw(BadOperationException(
+                    'Coroutine handler yielded %r' % (value,)))
+            else:
+                try:
+                    message = request.ws_stream.receive_message()
+                except Exception:
+                    value = coroutine.throw(*sys.exc_info())
+                else:
+                    value = coroutine.send(message)
+    except StopIteration:
+        return False
+
+
+class _EventLoopConnection(_RewindableReadBuffer):
+    """Mimics mod_python mp_conn on top of a non-blocking socket.
+
+    read() never blocks. It raises _NeedMoreData if the requested bytes
+    haven't been received yet. The bytes consumed since the last mark() call
+    can be pushed back by rewind(). write() buffers the data the socket
+    couldn't accept.
+    """
+
+    def __init__(self, socket_, buffered_data, local_addr, remote_addr):
+        """Constructs an instance.
+
+        Args:
+            socket_: socket detached from the request handler.
+            buffered_data: bytes already read from socket_ but not consumed.
+            local_addr: mimics mp_conn.local_addr.
+            remote_addr: mimics mp_conn.remote_addr.
+        """
+
+        _RewindableReadBuffer.__init__(self, buffered_data)
+
+        self._socket = socket_
+        self._socket.setblocking(0)
+        self._write_buffer = deque()
+        self._write_buffered_amount = 0
+        self._write_listener = None
+        self._closed = False
+
+        self.local_addr = local_addr
+        self.remote_addr = remote_addr
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def read(self, length):
+        """Mimics mp_conn.read()."""
+
+        data = self._read_buffered(length)
+        if data is None:
+            if self._eof:
+                # StreamBase raises ConnectionTerminatedException for this.
+                return ''
+            raise _NeedMoreData()
+        return data
+
+    def fill(self):
+        """Appends bytes available on the socket to the read buffer."""
+
+        try:
+            data = self._socket.recv(_RECEIVE_SIZE)
+        except socket.error, e:
+            if e.args[0] in _WOULD_BLOCK_ERRORS:
+                return
+            data = ''
+        if not data:
+            self._eof = True
+            return
+        self._append(data)
+
+    def write(self, data):
+        """Mimics mp_conn.write()."""
+
+        if self._closed:
+            raise socket.error(errno.EBADF, 'Connection is already closed')
+        if not data:
+            return
+        was_empty = self._write_buffered_amount == 0
+        self._write_buffer.append(data)
+        self._write_buffered_amount += len(data)
+        self.flush()
+        if (was_empty and self._write_buffered_amount and
+            self._write_listener is not None):
+            self._write_listener()
+
+    def flush(self):
+        """Writes buffered data as much as the socket accepts.
+
+        Raises:
+            socket.error: when the socket is broken.
+        """
+
+        while self._write_buffer:
+            data = self._write_buffer[0]
+            try:
+                sent = self._socket.send(data)
+            except socket.error, e:
+                if e.args[0] in _WOULD_BLOCK_ERRORS:
+                    return
+                raise
+            self._write_buffered_amount -= sent
+            if sent < len(data):
+                self._write_buffer[0] = data[sent:]
+                return
+            self._write_buffer.popleft()
+
+    def set_write_listener(self, listener):
+        """Sets a function to be called when the write buffer becomes
+        non-empty.
+        """
+
+        self._write_listener = listener
+
+    def get_write_buffered_amount(self):
+        """Returns the number of bytes waiting to be written."""
+
+        return self._write_buffered_amount
+
+    def shutdown(self):
+        """Shuts down the socket so that the loop sees EOF. Thread-safe."""
+
+        self._socket.shutdown(socket.SHUT_RDWR)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._write_buffer.clear()
+        self._write_buffered_amount = 0
+        self._socket.close()
+
+    def is_closed(self):
+        return self._closed
+
+
+class _HandlerTask(object):
+    """Runs the coroutine handler of a connection adopted by an EventLoop."""
+
+    def __init__(self, request, coroutine, connection):
+        self._logger = util.get_class_logger(self)
+
+        self._request = request
+        self._coroutine = coroutine
+        self._connection = connection
+        self._state = None
+        # Kept to unregister the socket after closing it.
+        self._fileno = connection.fileno()
+
+    def fileno(self):
+        return self._fileno
+
+    def wants_read(self):
+        return self._state in (_STATE_RECEIVING, _STATE_CLOSING)
+
+    def wants_write(self):
+        return self._connection.get_write_buffered_amount() > 0
+
+    def is_done(self):
+        return self._connection.is_closed()
+
+    def start(self):
+        self._resume(self._coroutine.next)
+        self._process_messages()
+
+    def on_readable(self):
+        self._connection.fill()
+        if self._connection.is_eof() and not self.wants_read():
+            self._logger.debug('Peer closed connection while draining')
+            self._close_socket()
+            return
+        if not self._connection.has_needed_data():
+            # The frame being received is still incomplete.
+            return
+        self._process_messages()
+
+    def on_writable(self):
+        try:
+            self._connection.flush()
+        except socket.error, e:
+            self._logger.debug('Failed to write: %s', e)
+            self._close_socket()
+            return
+        if self._connection.get_write_buffered_amount():
+            return
+        if self._state == _STATE_DRAINING:
+            self._resume(self._coroutine.send, None)
+            self._process_messages()
+        elif self._state == _STATE_CLOSED:
+            self._connection.close()
+
+    def abandon(self):
+        """Closes the connection without closing handshake."""
+
+        self._close_socket()
+        self._connection.close()
+
+    def _process_messages(self):
+        stream = self._request.ws_stream
+        while self._state in (_STATE_RECEIVING, _STATE_CLOSING):
+            try:
+                message = stream.receive_message()
+            except _NeedMoreData:
+                self._connection.rewind()
+                return
+            except Exception, e:
+                if self._state == _STATE_CLOSING:
+                    self._logger.debug('%s', e)
+                    self._close_socket()
+                    return
+                self._resume(self._coroutine.throw, *sys.exc_info())
+                continue
+
+            if self._state == _STATE_CLOSING:
+                if message is not None:
+                    self._logger.debug(
+                        'Didn\'t receive valid ack for closing handshake')
+                self._close_socket()
+                return
+            self._resume(self._coroutine.send, message)
+
+    def _resume(self, method, *args):
+        """Resumes the coroutine by method(*args) and updates the state based
+        on what it yields.
+        """
+
+        while True:
+            try:
+                value = method(*args)
+            except StopIteration:
+                self._close(common.STATUS_NORMAL_CLOSURE)
+                return
+            except Exception, e:
+                self._abort(e)
+                return
+
+            if value is DRAIN:
+                if self._connection.get_write_buffered_amount():
+                    self._state = _STATE_DRAINING
+                    return
+                method, args = self._coroutine.send, (None,)
+            elif value is not None:
+                method, args = self._coroutine.throw, (BadOperationException(
+                    'Coroutine handler yielded %r' % (value,)),)
+            else:
+                self._state = _STATE_RECEIVING
+                return
+
+    def _close(self, code):
+        """Starts closing handshake if not yet, and waits for the ack."""
+
+        request = self._request
+        try:
+            if not request.server_terminated:
+                request.ws_stream.close_connection(code, wait_response=False)
+        except Exception, e:
+            self._logger.debug('Failed to send close frame: %s', e)
+            self._close_socket()
+            return
+
+        if request.client_terminated or code == common.STATUS_PROTOCOL_ERROR:
+            self._close_socket()
+            return
+        self._state = _STATE_CLOSING
+        self._process_messages()
+
+    def _abort(self, e):
+        for exception_class, code in _CLOSE_STATUS_FOR_EXCEPTIONS:
+            if isinstance(e, exception_class):
+                self._logger.debug('%s', e)
+                self._close(code)
+                return
+        if isinstance(e, ConnectionTerminatedException):
+            self._logger.debug('%s', e)
+        else:
+            self._logger.error(
+                'Coroutine handler raised exception for %s:\n%s',
+                self._request.ws_resource, util.get_stack_trace())
+        self._close_socket()
+
+    def _close_socket(self):
+        """Closes the socket once the write buffer is flushed."""
+
+        if self._state != _STATE_CLOSED:
+            self._state = _STATE_CLOSED
+            try:
+                # Let the coroutine run its finally clauses if suspended.
+                self._coroutine.close()
+            except Exception, e:
+                self._logger.debug('%s', e)
+            keepalive = getattr(self._request, 'ws_keepalive', None)
+            if keepalive is not None:
+                keepalive.stop()
+            metrics = getattr(self._request, 'ws_metrics', None)
+            if metrics is not None:
+                metrics.close()
+        if (self._connection.is_eof() or
+            not self._connection.get_write_buffered_amount()):
+            self._connection.close()
+
+
+class _Poller(object):
+    """Wraps select.poll, or select.select where poll isn't available."""
+
+    def __init__(self):
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+        else:
+            self._poll = None
+            self._readers = set()
+            self._writers = set()
+
+    def register(self, fd, read, write):
+        """Registers fd or updates the events to watch."""
+
+        if self._poll is not None:
+            mask = 0
+            if read:
+                mask |= select.POLLIN
+            if write:
+                mask |= select.POLLOUT
+            self._poll.register(fd, mask)
+            return
+        for fds, watch in ((self._readers, read), (self._writers, write)):
+            if watch:
+                fds.add(fd)
+            else:
+                fds.discard(fd)
+
+    def unregister(self, fd):
+        if self._poll is not None:
+            try:
+                self._poll.unregister(fd)
+            except KeyError, e:
+                # fd has never been registered.
+                pass
+            return
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+    def poll(self, timeout):
+        """Returns a list of (fd, readable, writable) tuples.
+
+        Args:
+            timeout: timeout in seconds, or None to wait forever.
+        """
+
+        if self._poll is not None:
+            if timeout is not None:
+                timeout *= 1000
+            error_mask = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            return [(fd,
+                     bool(mask & (select.POLLIN | error_mask)),
+                     bool(mask & (select.POLLOUT | error_mask)))
+                    for fd, mask in self._poll.poll(timeout)]
+
+        readable, writable, unused_errored = select.select(
+            list(self._readers), list(self._writers), [], timeout)
+        readable = set(readable)
+        writable = set(writable)
+        return [(fd, fd in readable, fd in writable)
+                for fd in readable | writable]
+
+
+class EventLoop(threading.Thread):
+    """Thread which runs coroutine handlers of many connections.
+
+    The thread is started on the first adopt() or watch_readable() call. All
+    the coroutine handlers run on this thread, so they must not block.
+    Streams of adopted connections must be used only from coroutine handlers
+    or callbacks scheduled by call_soon().
+    """
+
+    # Used to pick up callbacks when the platform doesn't provide a way to
+    # wake up a thread waiting on select.
+    _FALLBACK_POLL_INTERVAL_IN_SEC = 0.05
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='WebSocketEventLoop')
+        self.setDaemon(True)
+
+        self._logger = util.get_class_logger(self)
+
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._stopped = False
+
+        self._tasks = {}
+        self._touched_tasks = set()
+        self._readers = {}
+        # Heap of (due, sequence number, callback, args) scheduled by
+        # call_later(). The sequence number keeps callbacks from being
+        # compared.
+        self._timers = []
+        self._timer_sequence = 0
+        self._poller = None
+
+        self._wakeup_receiver = None
+        self._wakeup_sender = None
+        if hasattr(socket, 'socketpair'):
+            self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+            self._wakeup_receiver.setblocking(0)
+            self._wakeup_sender.setblocking(0)
+
+    def adopt(self, request, coroutine):
+        """Takes over the connection of request and runs coroutine on it.
+        Thread-safe.
+
+        request.connection must have detach() which returns the underlying
+        socket and the bytes already read from it but not consumed.
+        """
+
+        socket_, buffered_data = request.connection.detach()
+        original_connection = request.connection
+        connection = _EventLoopConnection(socket_,
+                                          buffered_data,
+                                          original_connection.local_addr,
+                                          original_connection.remote_addr)
+        request.connection = connection
+
+        # Remember where each frame starts so that a frame which hasn't been
+        # fully received can be parsed again from the start.
+        request.ws_stream.set_frame_start_listener(connection.mark)
+
+        task = _HandlerTask(request, coroutine, connection)
+
+        # Let the keepalive scheduler send frames on this thread.
+        keepalive = getattr(request, 'ws_keepalive', None)
+        if keepalive is not None:
+            keepalive.set_executor(self.call_soon)
+
+        def _on_write_buffered():
+            self._touched_tasks.add(task)
+        connection.set_write_listener(_on_write_buffered)
+
+        if not self._ensure_started():
+            self._logger.debug('Adopted a connection after stop')
+            task.abandon()
+            return
+
+        self._logger.debug('Adopted connection from %r',
+                           (original_connection.remote_addr,))
+        self.call_soon(self._start_task, task)
+
+    def watch_readable(self, fd, callback):
+        """Calls callback() on the loop thread once fd becomes readable.
+        Thread-safe.
+        """
+
+        if self._ensure_started():
+            self.call_soon(self._add_reader, fd, callback)
+
+    def unwatch_readable(self, fd):
+        """Cancels watch_readable for fd. Thread-safe."""
+
+        self.call_soon(self._remove_reader, fd)
+
+    def call_soon(self, callback, *args):
+        """Schedules callback(*args) on the loop thread. Thread-safe."""
+
+        self._lock.acquire()
+        try:
+            self._callbacks.append((callback, args))
+        finally:
+            self._lock.release()
+        self._wake_up()
+
+    def call_later(self, delay, callback, *args):
+        """Schedules callback(*args) on the loop thread after delay seconds.
+        Thread-safe.
+        """
+
+        if self._ensure_started():
+            self.call_soon(self._add_timer, time.time() + delay, callback,
+                           args)
+
+    def stop(self):
+        """Stops the loop and closes all adopted connections. Waits for the
+        thread to finish unless called on it.
+        """
+
+        self._lock.acquire()
+        try:
+            self._stopped = True
+        finally:
+            self._lock.release()
+        self._wake_up()
+        if self.isAlive() and threading.currentThread() is not self:
+            self.join()
+
+    def get_connection_count(self):
+        return len(self._tasks)
+
+    def _ensure_started(self):
+        """Starts the thread if not yet. Returns False if stopped."""
+
+        self._lock.acquire()
+        try:
+            if self._stopped:
+                return False
+            if not self.isAlive():
+                self.start()
+            return True
+        finally:
+            self._lock.release()
+
+    def _add_reader(self, fd, callback):
+        self._readers[fd] = callback
+        self._poller.register(fd, True, False)
+
+    def _remove_reader(self, fd):
+        if self._readers.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def _add_timer(self, due, callback, args):
+        heapq.heappush(self._timers,
+                       (due, self._timer_sequence, callback, args))
+        self._timer_sequence += 1
+
+    def _run_timers(self, timeout):
+        """Runs the callbacks which are due. Returns the timeout to poll
+        with until the next one gets due.
+        """
+
+        while self._timers:
+            now = time.time()
+            due = self._timers[0][0]
+            if due > now:
+                if timeout is None or due - now < timeout:
+                    return due - now
+                return timeout
+            unused_due, unused_sequence, callback, args = heapq.heappop(
+                self._timers)
+            self._run_callback(callback, args)
+        return timeout
+
+    def _wake_up(self):
+        if self._wakeup_sender is None:
+            return
+        try:
+            self._wakeup_sender.send('x')
+        except socket.error, e:
+            # The buffer is full. The loop is going to wake up anyway.
+            pass
+
+    def _start_task(self, task):
+        self._tasks[task.fileno()] = task
+        task.start()
+        self._task_called(task)
+
+    def _task_called(self, task):
+        """Unregisters task if its connection got closed. Otherwise, marks
+        task to update the events to watch.
+
+        This must be done right after calling a method of task, before fd of
+        the closed socket gets reused by a newly adopted connection.
+        """
+
+        if task.is_done():
+            self._touched_tasks.discard(task)
+            if self._tasks.get(task.fileno()) is task:
+                del self._tasks[task.fileno()]
+                self._poller.unregister(task.fileno())
+        else:
+            self._touched_tasks.add(task)
+
+    def _run_callbacks(self):
+        self._lock.acquire()
+        try:
+            callbacks = self._callbacks
+            self._callbacks = []
+            stopped = self._stopped
+        finally:
+            self._lock.release()
+
+        for callback, args in callbacks:
+            self._run_callback(callback, args)
+        return not stopped
+
+    def _run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception, e:
+            self._logger.error('Callback raised exception:\n%s',
+                               util.get_stack_trace())
+
+    def _update_touched_tasks(self):
+        while self._touched_tasks:
+            task = self._touched_tasks.pop()
+            self._poller.register(
+                task.fileno(), task.wants_read(), task.wants_write())
+
+    def run(self):
+        self._poller = _Poller()
+        timeout = None
+        if self._wakeup_receiver is not None:
+            self._poller.register(self._wakeup_receiver.fileno(), True, False)
+        else:
+            timeout = self._FALLBACK_POLL_INTERVAL_IN_SEC
+
+        try:
+            while self._run_callbacks():
+                poll_timeout = self._run_timers(timeout)
+                self._update_touched_tasks()
+                try:
+                    events = self._poller.poll(poll_timeout)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, readable, writable in events:
+                    if (self._wakeup_receiver is not None and
+                        fd == self._wakeup_receiver.fileno()):
+                        self._drain_wakeup_receiver()
+                        continue
+                    if fd in self._readers:
+                        callback = self._readers.pop(fd)
+                        self._poller.unregister(fd)
+                        self._run_callback(callback, ())
+                        continue
+                    task = self._tasks.get(fd)
+                    if task is None:
+                        continue
+                    if writable:
+                        task.on_writable()
+                    if readable and not task.is_done():
+                        task.on_readable()
+                    self._task_called(task)
+        finally:
+            for task in self._tasks.values():
+                task.abandon()
+            self._tasks.clear()
+
+    def _drain_wakeup_receiver(self):
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except socket.error, e:
+            pass
+
+
+# vi:sts=4 sw=4 et
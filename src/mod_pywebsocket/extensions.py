@@ -28,7 +28,11 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import logging
+
 from mod_pywebsocket import common
+from mod_pywebsocket import metrics
+from mod_pywebsocket import tracing
 from mod_pywebsocket import util
 from mod_pywebsocket.http_header_util import quote_if_necessary
 
@@ -46,6 +50,10 @@ class ExtensionProcessorInterface(object):
         self._request = request
         self._active = True
 
+        self._tracer = tracing.get_tracer()
+        # mod_python request of the connection, passed to the tracer.
+        self._websocket_request = None
+
     def request(self):
         return self._request
 
@@ -81,6 +89,22 @@ class ExtensionProcessorInterface(object):
         if self._active:
             self._setup_stream_options_internal(stream_options)
 
+    def set_metrics(self, connection_metrics):
+        """Lets the processor record metrics of the connection to
+        connection_metrics (metrics.ConnectionMetrics). Called after
+        get_extension_response.
+        """
+
+        pass
+
+    def set_websocket_request(self, request):
+        """Sets the mod_python request of the connection using the processor.
+        It identifies the connection to the tracer. Called after
+        get_extension_response.
+        """
+
+        self._websocket_request = request
+
 
 def _log_outgoing_compression_ratio(
         logger, original_bytes, filtered_bytes, average_ratio):
@@ -131,11 +155,26 @@ class _AverageRatioCalculator(object):
         self._total_original_bytes = 0
         self._total_result_bytes = 0
 
+        self._metrics = None
+        self._direction = None
+
+    def set_metrics(self, connection_metrics, direction):
+        """Also records the bytes to connection_metrics as compression of
+        data in direction.
+        """
+
+        self._metrics = connection_metrics
+        self._direction = direction
+
     def add_original_bytes(self, value):
         self._total_original_bytes += value
+        if self._metrics is not None:
+            self._metrics.add_compression(self._direction, value, 0)
 
     def add_result_bytes(self, value):
         self._total_result_bytes += value
+        if self._metrics is not None:
+            self._metrics.add_compression(self._direction, 0, value)
 
     def get_average_ratio(self):
         if self._total_original_bytes != 0:
@@ -158,6 +197,8 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
     def __init__(self, request):
         ExtensionProcessorInterface.__init__(self, request)
         self._logger = util.get_class_logger(self)
+        self._debug_log_cache = util.LogLevelCache(
+            self._logger, logging.DEBUG)
 
         self._response_window_bits = None
         self._response_no_context_takeover = False
@@ -246,6 +287,12 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
         stream_options.incoming_frame_filters.insert(
             0, _IncomingFilter(self))
 
+    def set_metrics(self, connection_metrics):
+        self._outgoing_average_ratio_calculator.set_metrics(
+            connection_metrics, metrics.DIRECTION_OUT)
+        self._incoming_average_ratio_calculator.set_metrics(
+            connection_metrics, metrics.DIRECTION_IN)
+
     def set_response_window_bits(self, value):
         self._response_window_bits = value
 
@@ -276,15 +323,25 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
                     original_payload_size)
             return
 
+        if self._tracer is not None:
+            filter_start = tracing.get_timestamp()
+
         frame.payload = self._rfc1979_deflater.filter(
             frame.payload, bfinal=self._bfinal)
         frame.rsv1 = 1
 
         filtered_payload_size = len(frame.payload)
+        if self._tracer is not None:
+            self._tracer.on_filter_applied(
+                self._websocket_request,
+                common.DEFLATE_FRAME_EXTENSION, metrics.DIRECTION_OUT,
+                original_payload_size, filtered_payload_size, filter_start,
+                tracing.get_timestamp())
         self._outgoing_average_ratio_calculator.add_result_bytes(
                 filtered_payload_size)
 
-        _log_outgoing_compression_ratio(
+        if self._debug_log_cache.is_enabled():
+            _log_outgoing_compression_ratio(
                 self._logger,
                 original_payload_size,
                 filtered_payload_size,
@@ -304,14 +361,24 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
                     received_payload_size)
             return
 
+        if self._tracer is not None:
+            filter_start = tracing.get_timestamp()
+
         frame.payload = self._rfc1979_inflater.filter(frame.payload)
         frame.rsv1 = 0
 
         filtered_payload_size = len(frame.payload)
+        if self._tracer is not None:
+            self._tracer.on_filter_applied(
+                self._websocket_request,
+                common.DEFLATE_FRAME_EXTENSION, metrics.DIRECTION_IN,
+                received_payload_size, filtered_payload_size, filter_start,
+                tracing.get_timestamp())
         self._incoming_average_ratio_calculator.add_original_bytes(
                 filtered_payload_size)
 
-        _log_incoming_compression_ratio(
+        if self._debug_log_cache.is_enabled():
+            _log_incoming_compression_ratio(
                 self._logger,
                 received_payload_size,
                 filtered_payload_size,
@@ -414,6 +481,14 @@ class CompressionExtensionProcessorBase(ExtensionProcessorInterface):
             return
         self._compression_processor.setup_stream_options(stream_options)
 
+    def set_metrics(self, connection_metrics):
+        if self._compression_processor is not None:
+            self._compression_processor.set_metrics(connection_metrics)
+
+    def set_websocket_request(self, request):
+        if self._compression_processor is not None:
+            self._compression_processor.set_websocket_request(request)
+
     def set_compression_processor_hook(self, hook):
         self._compression_processor_hook = hook
 
@@ -507,11 +582,9 @@ class PerMessageDeflateExtensionProcessor(ExtensionProcessorInterface):
         self._rfc1979_deflater = util._RFC1979Deflater(
             server_max_window_bits, server_no_context_takeover)
 
-        # Note that we prepare for incoming messages compressed with window
-        # bits upto 15 regardless of the client_max_window_bits value to be
-        # sent to the client.
-        self._rfc1979_inflater = util._RFC1979Inflater()
-
+        # Note that the framer prepares for incoming messages compressed with
+        # window bits upto 15 regardless of the client_max_window_bits value
+        # to be sent to the client.
         self._framer = _PerMessageDeflateFramer(
             server_max_window_bits, server_no_context_takeover)
         self._framer.set_bfinal(False)
@@ -559,6 +632,12 @@ class PerMessageDeflateExtensionProcessor(ExtensionProcessorInterface):
     def _setup_stream_options_internal(self, stream_options):
         self._framer.setup_stream_options(stream_options)
 
+    def set_metrics(self, connection_metrics):
+        self._framer.set_metrics(connection_metrics)
+
+    def set_websocket_request(self, request):
+        self._framer.set_websocket_request(request)
+
     def set_client_max_window_bits(self, value):
         """If this option is specified, this class adds the
         client_max_window_bits extension parameter to the handshake response,
@@ -601,6 +680,8 @@ class _PerMessageDeflateFramer(object):
 
     def __init__(self, deflate_max_window_bits, deflate_no_context_takeover):
         self._logger = util.get_class_logger(self)
+        self._debug_log_cache = util.LogLevelCache(
+            self._logger, logging.DEBUG)
 
         self._rfc1979_deflater = util._RFC1979Deflater(
             deflate_max_window_bits, deflate_no_context_takeover)
@@ -609,6 +690,9 @@ class _PerMessageDeflateFramer(object):
 
         self._bfinal = False
 
+        self._tracer = tracing.get_tracer()
+        self._websocket_request = None
+
         self._compress_outgoing_enabled = False
 
         # True if a message is fragmented and compression is ongoing.
@@ -630,6 +714,15 @@ class _PerMessageDeflateFramer(object):
     def set_compress_outgoing_enabled(self, value):
         self._compress_outgoing_enabled = value
 
+    def set_websocket_request(self, request):
+        self._websocket_request = request
+
+    def set_metrics(self, connection_metrics):
+        self._outgoing_average_ratio_calculator.set_metrics(
+            connection_metrics, metrics.DIRECTION_OUT)
+        self._incoming_average_ratio_calculator.set_metrics(
+            connection_metrics, metrics.DIRECTION_IN)
+
     def _process_incoming_message(self, message, decompress):
         if not decompress:
             return message
@@ -638,13 +731,23 @@ class _PerMessageDeflateFramer(object):
         self._incoming_average_ratio_calculator.add_result_bytes(
                 received_payload_size)
 
+        if self._tracer is not None:
+            filter_start = tracing.get_timestamp()
+
         message = self._rfc1979_inflater.filter(message)
 
         filtered_payload_size = len(message)
+        if self._tracer is not None:
+            self._tracer.on_filter_applied(
+                self._websocket_request,
+                common.PERMESSAGE_DEFLATE_EXTENSION, metrics.DIRECTION_IN,
+                received_payload_size, filtered_payload_size, filter_start,
+                tracing.get_timestamp())
         self._incoming_average_ratio_calculator.add_original_bytes(
                 filtered_payload_size)
 
-        _log_incoming_compression_ratio(
+        if self._debug_log_cache.is_enabled():
+            _log_incoming_compression_ratio(
                 self._logger,
                 received_payload_size,
                 filtered_payload_size,
@@ -663,14 +766,24 @@ class _PerMessageDeflateFramer(object):
         self._outgoing_average_ratio_calculator.add_original_bytes(
             original_payload_size)
 
+        if self._tracer is not None:
+            filter_start = tracing.get_timestamp()
+
         message = self._rfc1979_deflater.filter(
             message, end=end, bfinal=self._bfinal)
 
         filtered_payload_size = len(message)
+        if self._tracer is not None:
+            self._tracer.on_filter_applied(
+                self._websocket_request,
+                common.PERMESSAGE_DEFLATE_EXTENSION, metrics.DIRECTION_OUT,
+                original_payload_size, filtered_payload_size, filter_start,
+                tracing.get_timestamp())
         self._outgoing_average_ratio_calculator.add_result_bytes(
             filtered_payload_size)
 
-        _log_outgoing_compression_ratio(
+        if self._debug_log_cache.is_enabled():
+            _log_outgoing_compression_ratio(
                 self._logger,
                 original_payload_size,
                 filtered_payload_size,
@@ -37,6 +37,8 @@ successfully established.
 import logging
 
 from mod_pywebsocket import common
+from mod_pywebsocket import metrics
+from mod_pywebsocket import tracing
 from mod_pywebsocket.handshake import hybi00
 from mod_pywebsocket.handshake import hybi
 # Export AbortedByUserException, HandshakeException, and VersionException
@@ -59,9 +61,60 @@ def do_handshake(request, dispatcher, allowDraft75=False, strict=False):
         strict: obsolete argument. ignored.
 
     Handshaker will add attributes such as ws_resource in performing
-    handshake.
+    handshake. If the dispatcher has a metrics registry, request.ws_metrics
+    is set to a metrics.ConnectionMetrics for the connection. Otherwise,
+    it's set to None. Likewise, request.ws_keepalive is set to a
+    keepalive.ConnectionKeepalive if the dispatcher has a keepalive
+    scheduler.
     """
 
+    keepalive_scheduler = dispatcher.get_keepalive_scheduler()
+    request.ws_keepalive = None
+    if keepalive_scheduler is not None:
+        request.ws_keepalive = (
+            keepalive_scheduler.create_connection_keepalive(request))
+
+    registry = dispatcher.get_metrics_registry()
+    tracer = tracing.get_tracer()
+    request.ws_metrics = None
+    if registry is None and tracer is None:
+        _do_handshake(request, dispatcher)
+        return
+
+    if registry is not None:
+        request.ws_metrics = registry.create_connection_metrics()
+    handshake_start = tracing.get_timestamp()
+    if tracer is not None:
+        tracer.on_handshake_start(request, handshake_start)
+    try:
+        _do_handshake(request, dispatcher)
+    except Exception, e:
+        if tracer is not None:
+            tracer.on_handshake_end(request, tracing.get_timestamp(), e)
+        if registry is not None:
+            registry.increment(
+                'handshake_failures', reason=_get_handshake_failure_reason(e))
+        raise
+    handshake_end = tracing.get_timestamp()
+    if tracer is not None:
+        tracer.on_handshake_end(request, handshake_end, None)
+    if registry is not None:
+        registry.observe('handshake_seconds', handshake_end - handshake_start,
+                         metrics.HANDSHAKE_SECONDS_BOUNDS)
+        request.ws_metrics.open(request.ws_resource)
+
+
+def _get_handshake_failure_reason(e):
+    if isinstance(e, VersionException):
+        return 'version'
+    if isinstance(e, AbortedByUserException):
+        return 'aborted'
+    if isinstance(e, HandshakeException) and e.status:
+        return 'http_%d' % e.status
+    return e.__class__.__name__
+
+
+def _do_handshake(request, dispatcher):
     _LOGGER.debug('Client\'s opening handshake resource: %r', request.uri)
     # To print mimetools.Message as escaped one-line string, we converts
     # headers_in to dict object. Without conversion, if we use %r, it just
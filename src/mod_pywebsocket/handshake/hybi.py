@@ -60,6 +60,7 @@ from mod_pywebsocket.handshake._base import validate_subprotocol
 from mod_pywebsocket.handshake._base import VersionException
 from mod_pywebsocket.stream import Stream
 from mod_pywebsocket.stream import StreamOptions
+from mod_pywebsocket import tracing
 from mod_pywebsocket import util
 
 
@@ -224,6 +225,8 @@ class Handshaker(object):
                                     processors)
 
             stream_options = StreamOptions()
+            # Set by handshake.do_handshake when metrics are enabled.
+            connection_metrics = getattr(self._request, 'ws_metrics', None)
 
             for index, processor in enumerate(processors):
                 if not processor.is_active():
@@ -236,6 +239,9 @@ class Handshaker(object):
 
                 accepted_extensions.append(extension_response)
 
+                if connection_metrics is not None:
+                    processor.set_metrics(connection_metrics)
+                processor.set_websocket_request(self._request)
                 processor.setup_stream_options(stream_options)
 
                 if not is_compression_extension(processor.name()):
@@ -246,6 +252,12 @@ class Handshaker(object):
                     if is_compression_extension(processors[j].name()):
                         processors[j].set_active(False)
 
+            tracer = tracing.get_tracer()
+            if tracer is not None:
+                tracer.on_extensions_negotiated(
+                    self._request, accepted_extensions,
+                    tracing.get_timestamp())
+
             if len(accepted_extensions) > 0:
                 self._request.ws_extensions = accepted_extensions
                 self._logger.debug(
@@ -42,6 +42,8 @@ from mod_python import apache
 from mod_pywebsocket import common
 from mod_pywebsocket import dispatch
 from mod_pywebsocket import handshake
+from mod_pywebsocket import keepalive
+from mod_pywebsocket import metrics
 from mod_pywebsocket import util
 
 
@@ -63,6 +65,31 @@ _PYOPT_ALLOW_HANDLERS_OUTSIDE_ROOT = (
 _PYOPT_ALLOW_HANDLERS_OUTSIDE_ROOT_DEFINITION = {
     'off': False, 'no': False, 'on': True, 'yes': True}
 
+# PythonOption to source handler files on the first request for their
+# resources instead of on startup. Set this option with value of 'on' to
+# enable. It's disabled by default.
+_PYOPT_LAZY_HANDLER_LOADING = 'mod_pywebsocket.lazy_handler_loading'
+# Map from values to their meanings.
+_PYOPT_LAZY_HANDLER_LOADING_DEFINITION = {'off': False, 'on': True}
+
+# PythonOption to specify the directory where compiled handler files are
+# cached. Handler files are compiled every time if not specified.
+_PYOPT_HANDLER_BYTECODE_CACHE_DIR = (
+    'mod_pywebsocket.handler_bytecode_cache_dir')
+
+# PythonOption to record counters and histograms of WebSocket connections.
+# Set this option with value of 'on' to enable. It's disabled by default.
+# Note that each Apache child process has metrics of its own.
+_PYOPT_METRICS = 'mod_pywebsocket.metrics'
+# Map from values to their meanings.
+_PYOPT_METRICS_DEFINITION = {'off': False, 'on': True}
+
+# PythonOptions to send keepalive pings and close idle connections. Specify
+# the number of seconds. See keepalive.py. Disabled by default.
+_PYOPT_KEEPALIVE_PING_INTERVAL = 'mod_pywebsocket.keepalive_ping_interval'
+_PYOPT_KEEPALIVE_PONG_TIMEOUT = 'mod_pywebsocket.keepalive_pong_timeout'
+_PYOPT_IDLE_TIMEOUT = 'mod_pywebsocket.idle_timeout'
+
 # (Obsolete option. Ignored.)
 # PythonOption to specify to allow handshake defined in Hixie 75 version
 # protocol. The default is None (Off)
@@ -146,6 +173,20 @@ def _parse_option(name, value, definition):
     return meaning
 
 
+def _parse_seconds_option(name, value):
+    if value is None:
+        return None
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise Exception('Invalid value for PythonOption %s: %r' %
+                        (name, value))
+    if seconds <= 0:
+        return None
+    return seconds
+
+
 def _create_dispatcher():
     _LOGGER.info('Initializing Dispatcher')
 
@@ -163,8 +204,34 @@ def _create_dispatcher():
         options.get(_PYOPT_ALLOW_HANDLERS_OUTSIDE_ROOT),
         _PYOPT_ALLOW_HANDLERS_OUTSIDE_ROOT_DEFINITION)
 
+    lazy_handler_loading = _parse_option(
+        _PYOPT_LAZY_HANDLER_LOADING,
+        options.get(_PYOPT_LAZY_HANDLER_LOADING),
+        _PYOPT_LAZY_HANDLER_LOADING_DEFINITION)
+
+    handler_bytecode_cache_dir = options.get(
+        _PYOPT_HANDLER_BYTECODE_CACHE_DIR, None)
+
     dispatcher = dispatch.Dispatcher(
-        handler_root, handler_scan, allow_handlers_outside_root)
+        handler_root, handler_scan, allow_handlers_outside_root,
+        lazy_handler_loading, handler_bytecode_cache_dir)
+
+    if _parse_option(_PYOPT_METRICS, options.get(_PYOPT_METRICS),
+                     _PYOPT_METRICS_DEFINITION):
+        dispatcher.set_metrics_registry(metrics.MetricsRegistry())
+
+    keepalive_ping_interval = _parse_seconds_option(
+        _PYOPT_KEEPALIVE_PING_INTERVAL,
+        options.get(_PYOPT_KEEPALIVE_PING_INTERVAL))
+    keepalive_pong_timeout = _parse_seconds_option(
+        _PYOPT_KEEPALIVE_PONG_TIMEOUT,
+        options.get(_PYOPT_KEEPALIVE_PONG_TIMEOUT))
+    idle_timeout = _parse_seconds_option(
+        _PYOPT_IDLE_TIMEOUT, options.get(_PYOPT_IDLE_TIMEOUT))
+    if (keepalive_ping_interval is not None or
+        keepalive_pong_timeout is not None or idle_timeout is not None):
+        dispatcher.set_keepalive_scheduler(keepalive.KeepaliveScheduler(
+            keepalive_ping_interval, keepalive_pong_timeout, idle_timeout))
 
     for warning in dispatcher.source_warnings():
         apache.log_error(
@@ -0,0 +1,356 @@
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Keepalive pings and idle timeout of WebSocket connections.
+
+A KeepaliveScheduler watches all the connections of a server on a single
+thread. For each connection, it
+
+- sends a ping when nothing has been received for ping_interval seconds,
+- aborts the connection (i.e. the peer sees status code 1006) when nothing
+  has been received for pong_timeout seconds after sending a ping or a close
+  frame, and
+- starts the closing handshake with status code 1001 (going away) when no
+  message has been sent or received for idle_timeout seconds.
+
+handshake.do_handshake sets request.ws_keepalive to a ConnectionKeepalive
+when the dispatcher has a KeepaliveScheduler. The stream of the connection
+records activity to it, and Dispatcher.transfer_data starts and stops
+watching the connection.
+
+Aborting shuts down the socket so that blocked reads and writes fail. It
+needs the connection to have shutdown() (standalone.py). On mod_python,
+dead peers are left to the TimeOut directive of Apache.
+"""
+
+
+import heapq
+import socket
+import threading
+import time
+
+from mod_pywebsocket import common
+from mod_pywebsocket import util
+
+
+# Reason of the close frame sent on idle timeout.
+_IDLE_TIMEOUT_REASON = 'Idle timeout'
+
+
+class ConnectionKeepalive(object):
+    """Keepalive state of a connection.
+
+    The stream of the connection updates last_received and last_activity.
+    """
+
+    def __init__(self, scheduler, request):
+        self._logger = util.get_class_logger(self)
+
+        self._scheduler = scheduler
+        self._request = request
+        self._executor = None
+
+        now = time.time()
+        # Time when the last frame was received.
+        self.last_received = now
+        # Time when the last message was sent or received.
+        self.last_activity = now
+
+        # Time when the oldest unanswered ping was sent.
+        self._unanswered_ping_sent_at = None
+        # Time when the last ping was sent. 0 if never.
+        self._last_ping_sent_at = 0
+        # Time when the close frame was sent on idle timeout.
+        self._close_sent_at = None
+
+        # Used by KeepaliveScheduler to discard outdated schedules.
+        self._due = None
+
+    def set_executor(self, executor):
+        """Makes the scheduler send frames by executor(callback) instead of
+        sending them on its thread. EventLoop sets its call_soon() so that
+        streams of connections it adopted are used only on its thread.
+        """
+
+        self._executor = executor
+
+    def start(self):
+        """Starts watching the connection."""
+
+        self._scheduler._add(self)
+
+    def stop(self):
+        """Stops watching the connection. Call this when the connection is
+        closed.
+        """
+
+        self._scheduler._remove(self)
+
+    def _has_unanswered_ping(self):
+        return (self._unanswered_ping_sent_at is not None and
+                self.last_received < self._unanswered_ping_sent_at)
+
+    def _ping(self, now):
+        """Sends a ping. Returns False iff another thread is writing to the
+        connection.
+        """
+
+        if self._executor is not None:
+            self._executor(self._send_ping)
+        elif not self._send_ping():
+            return False
+        if not self._has_unanswered_ping():
+            self._unanswered_ping_sent_at = now
+        self._last_ping_sent_at = now
+        return True
+
+    def _send_ping(self):
+        if self._request.server_terminated:
+            return True
+        try:
+            return self._request.ws_stream.send_ping(blocking=False)
+        except Exception, e:
+            # The thread running the handler will notice the error.
+            self._logger.debug('Failed to send ping: %s', e)
+            return True
+
+    def _close(self, now):
+        """Starts the closing handshake. Returns False iff another thread is
+        writing to the connection.
+        """
+
+        if self._executor is not None:
+            self._executor(self._send_close)
+        elif not self._send_close():
+            return False
+        self._close_sent_at = now
+        return True
+
+    def _send_close(self):
+        if self._request.server_terminated:
+            return True
+        self._logger.debug('Closing idle connection from %r',
+                           (self._request.connection.remote_addr,))
+        try:
+            # The handler sees the ack of the peer as the closing handshake
+            # initiated by the peer. close_connection() can't be used here
+            # since it blocks while the handler is writing.
+            return self._request.ws_stream._send_closing_handshake(
+                common.STATUS_GOING_AWAY, _IDLE_TIMEOUT_REASON,
+                blocking=False)
+        except Exception, e:
+            self._logger.debug('Failed to send close frame: %s', e)
+            return True
+
+    def _abort(self):
+        self._logger.debug('Aborting unresponsive connection from %r',
+                           (self._request.connection.remote_addr,))
+        shutdown = getattr(self._request.connection, 'shutdown', None)
+        if shutdown is None:
+            return
+        try:
+            shutdown()
+        except socket.error, e:
+            self._logger.debug('Failed to shut down socket: %s', e)
+
+
+class KeepaliveScheduler(threading.Thread):
+    """Thread which sends keepalive pings and closes idle or dead
+    connections for all the connections of a server.
+
+    The thread is started on the first ConnectionKeepalive.start() call. All
+    the arguments are in seconds. None disables the corresponding feature.
+    """
+
+    # Interval to retry sending a frame when another thread is writing to
+    # the connection.
+    _RETRY_INTERVAL_IN_SEC = 1
+
+    def __init__(self, ping_interval=None, pong_timeout=None,
+                 idle_timeout=None):
+        threading.Thread.__init__(self, name='WebSocketKeepalive')
+        self.setDaemon(True)
+
+        self._logger = util.get_class_logger(self)
+
+        self._ping_interval = ping_interval
+        self._pong_timeout = pong_timeout
+        self._idle_timeout = idle_timeout
+
+        self._condition = threading.Condition()
+        # Heap of (due, sequence number, ConnectionKeepalive). The sequence
+        # number keeps ConnectionKeepalive instances from being compared.
+        self._queue = []
+        self._sequence = 0
+        self._keepalives = set()
+        self._stopped = False
+
+    def create_connection_keepalive(self, request):
+        return ConnectionKeepalive(self, request)
+
+    def get_connection_count(self):
+        return len(self._keepalives)
+
+    def stop(self):
+        """Stops the thread. Connections are left as they are."""
+
+        self._condition.acquire()
+        try:
+            self._stopped = True
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _add(self, keepalive):
+        self._condition.acquire()
+        try:
+            if self._stopped:
+                return
+            self._keepalives.add(keepalive)
+            self._schedule(keepalive, self._get_due(keepalive, time.time()))
+            if not self.isAlive():
+                self.start()
+        finally:
+            self._condition.release()
+
+    def _remove(self, keepalive):
+        self._condition.acquire()
+        try:
+            # The entry in _queue is discarded when it gets due.
+            self._keepalives.discard(keepalive)
+        finally:
+            self._condition.release()
+
+    def _schedule(self, keepalive, due):
+        """Must be called with _condition acquired."""
+
+        keepalive._due = due
+        if due is None:
+            return
+        heapq.heappush(self._queue, (due, self._sequence, keepalive))
+        self._sequence += 1
+        if self._queue[0][2] is keepalive:
+            self._condition.notify()
+
+    def _get_due(self, keepalive, now):
+        """Returns when keepalive needs to be checked next, or None if
+        never.
+        """
+
+        deadlines = []
+        if self._pong_timeout is not None:
+            if keepalive._has_unanswered_ping():
+                deadlines.append(
+                    keepalive._unanswered_ping_sent_at + self._pong_timeout)
+            if keepalive._close_sent_at is not None:
+                deadlines.append(
+                    keepalive._close_sent_at + self._pong_timeout)
+        if keepalive._close_sent_at is None:
+            if self._idle_timeout is not None:
+                deadlines.append(keepalive.last_activity + self._idle_timeout)
+            if self._ping_interval is not None:
+                deadlines.append(
+                    max(keepalive.last_received,
+                        keepalive._last_ping_sent_at) + self._ping_interval)
+        if not deadlines:
+            return None
+        return min(deadlines)
+
+    def _check(self, keepalive, now):
+        """Sends a ping, closes or aborts the connection as needed. Returns
+        when keepalive needs to be checked next, or None if never.
+        """
+
+        if self._pong_timeout is not None:
+            for sent_at in (keepalive._unanswered_ping_sent_at,
+                            keepalive._close_sent_at):
+                if (sent_at is not None and
+                    keepalive.last_received < sent_at and
+                    now >= sent_at + self._pong_timeout):
+                    keepalive._abort()
+                    return None
+
+        if keepalive._close_sent_at is not None:
+            return self._get_due(keepalive, now)
+
+        if (self._idle_timeout is not None and
+            now >= keepalive.last_activity + self._idle_timeout):
+            if not keepalive._close(now):
+                # The handler has been stuck in writing for idle_timeout.
+                keepalive._abort()
+                return None
+            return self._get_due(keepalive, now)
+
+        if (self._ping_interval is not None and
+            now >= max(keepalive.last_received,
+                       keepalive._last_ping_sent_at) + self._ping_interval):
+            if not keepalive._ping(now):
+                return now + self._RETRY_INTERVAL_IN_SEC
+        return self._get_due(keepalive, now)
+
+    def run(self):
+        self._condition.acquire()
+        try:
+            while not self._stopped:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                now = time.time()
+                due, unused_sequence, keepalive = self._queue[0]
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(self._queue)
+                if (keepalive not in self._keepalives or
+                    keepalive._due != due):
+                    continue
+
+                # Don't block _add() and _remove() while writing frames.
+                self._condition.release()
+                try:
+                    try:
+                        next_due = self._check(keepalive, now)
+                    except Exception, e:
+                        self._logger.error(
+                            'Keepalive check raised exception:\n%s',
+                            util.get_stack_trace())
+                        next_due = None
+                finally:
+                    self._condition.acquire()
+                if next_due is None:
+                    self._keepalives.discard(keepalive)
+                elif keepalive in self._keepalives:
+                    self._schedule(keepalive, next_due)
+        finally:
+            self._condition.release()
+
+
+# vi:sts=4 sw=4 et
@@ -66,7 +66,7 @@ class MemorizingFile(object):
     def __getattribute__(self, name):
         if name in ('_file', '_memorized_lines', '_max_memorized_lines',
                     '_buffered', '_buffered_line', 'readline',
-                    'get_memorized_lines'):
+                    'get_memorized_lines', 'release_memorized_lines'):
             return object.__getattribute__(self, name)
         return self._file.__getattribute__(name)
 
@@ -95,5 +95,11 @@ class MemorizingFile(object):
         """Get lines memorized so far."""
         return self._memorized_lines
 
+    def release_memorized_lines(self):
+        """Discard lines memorized so far and stop memorizing lines."""
+
+        self._memorized_lines = []
+        self._max_memorized_lines = 0
+
 
 # vi:sts=4 sw=4 et
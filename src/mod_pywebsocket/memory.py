@@ -0,0 +1,304 @@
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Estimates memory used by WebSocket connections.
+
+estimate_connection_memory(request) returns a dict mapping the name of each
+component of a connection to the estimated number of bytes it uses:
+
+- handshake_lines: the lines of the opening handshake memorized by
+  MemorizingFile
+- extensions: the extension processors, including zlib streams
+- stream: request.ws_stream, its options and its frame builder
+- request: everything else reachable from the request, e.g. the request
+  handler of standalone.py, the parsed headers and the socket buffers
+
+The size of a component is the sum of sys.getsizeof() of the objects
+reachable from it which aren't counted for the components listed before it.
+Traversal of a component stops at the request and its connection, which
+many objects refer back to, so that they're counted only for the request.
+Objects shared by connections such as modules, classes, functions, loggers,
+threads, servers and the metrics registry aren't followed. zlib allocates
+memory which sys.getsizeof() doesn't see. It's estimated by the formulas in
+zconf.h of zlib, which give upper bounds.
+
+get_thread_stack_size() returns the size of the stack reserved for each
+thread serving a connection. Most of it is usually not resident.
+
+MemorySampler keeps the estimates of a sample of connections. When the
+dispatcher has one (Dispatcher.set_memory_sampler), connections are sampled
+when the handler starts transferring data, i.e. after the opening handshake.
+The estimates are of the memory held for the rest of the connection.
+standalone.py releases the memorized lines before that, so handshake_lines
+of its samples is only the size of an empty list. Call
+estimate_connection_memory() during the handshake to see the size of the
+lines.
+"""
+
+
+import gc
+import logging
+import optparse
+import random
+import SocketServer
+import sys
+import threading
+import types
+
+from mod_pywebsocket import metrics
+from mod_pywebsocket import tracing
+from mod_pywebsocket import util
+
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+
+COMPONENT_EXTENSIONS = 'extensions'
+COMPONENT_STREAM = 'stream'
+COMPONENT_HANDSHAKE_LINES = 'handshake_lines'
+COMPONENT_REQUEST = 'request'
+
+# In the order of counting.
+COMPONENTS = (COMPONENT_HANDSHAKE_LINES, COMPONENT_EXTENSIONS,
+              COMPONENT_STREAM, COMPONENT_REQUEST)
+
+# Instances of these types are shared by connections, or reference objects
+# shared by connections.
+_SHARED_TYPES = (
+    types.ModuleType,
+    type,
+    types.ClassType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.MethodType,
+    logging.Logger,
+    threading.Thread,
+    SocketServer.BaseServer,
+    # The options of standalone.py referenced by its request handlers.
+    optparse.Values,
+    metrics.MetricsRegistry,
+    tracing.Tracer,
+)
+
+# memLevel used by zlib.compressobj() by default.
+_ZLIB_DEFAULT_MEM_LEVEL = 8
+# Size of the state of an inflate stream excluding its window.
+_ZLIB_INFLATE_STATE_SIZE = 7 * 1024
+
+
+def _get_zlib_size(obj):
+    """Returns the memory allocated by zlib for obj."""
+
+    if isinstance(obj, util._Deflater):
+        return ((1 << (obj._window_bits + 2)) +
+                (1 << (_ZLIB_DEFAULT_MEM_LEVEL + 9)))
+    if isinstance(obj, util._Inflater):
+        return (1 << obj._window_bits) + _ZLIB_INFLATE_STATE_SIZE
+    return 0
+
+
+def _get_size(roots, counted_ids, stop_ids):
+    """Returns the total size of the objects reachable from roots without
+    going through objects in counted_ids or stop_ids, and adds their ids to
+    counted_ids.
+    """
+
+    size = 0
+    pending = list(roots)
+    while pending:
+        obj = pending.pop()
+        obj_id = id(obj)
+        if (obj_id in counted_ids or obj_id in stop_ids or
+            isinstance(obj, _SHARED_TYPES)):
+            continue
+        counted_ids.add(obj_id)
+        size += sys.getsizeof(obj, 0) + _get_zlib_size(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def estimate_connection_memory(request, shared_objects=()):
+    """Returns a dict mapping the name of each component of the connection
+    of request to its estimated size in bytes.
+
+    Args:
+        request: mod_python request after the opening handshake.
+        shared_objects: objects reachable from request but shared by
+            connections, e.g. the dispatcher. They're not counted.
+    """
+
+    # Keep the roots alive so that their ids aren't reused during counting.
+    roots = {
+        COMPONENT_EXTENSIONS: [
+            getattr(request, 'ws_extension_processors', None)],
+        COMPONENT_STREAM: [getattr(request, 'ws_stream', None)],
+        COMPONENT_HANDSHAKE_LINES: [],
+        COMPONENT_REQUEST: [request, request.connection],
+    }
+    get_memorized_lines = getattr(
+        request.connection, 'get_memorized_lines', None)
+    if get_memorized_lines is not None:
+        try:
+            roots[COMPONENT_HANDSHAKE_LINES].append(get_memorized_lines())
+        except Exception:
+            # Logical connections of mux don't support this.
+            pass
+
+    shared_ids = set(id(obj) for obj in shared_objects)
+    shared_ids.add(id(None))
+    request_ids = set(id(obj) for obj in roots[COMPONENT_REQUEST])
+    counted_ids = set()
+    result = {}
+    for component in COMPONENTS:
+        if component == COMPONENT_REQUEST:
+            stop_ids = shared_ids
+        else:
+            stop_ids = shared_ids | request_ids
+        result[component] = _get_size(
+            roots[component], counted_ids, stop_ids)
+    return result
+
+
+def get_thread_stack_size():
+    """Returns the size of the stack of new threads in bytes, or None if
+    it's unknown.
+    """
+
+    size = threading.stack_size()
+    if size:
+        return size
+    if resource is None:
+        return None
+    # POSIX threads use the soft limit on the stack size of the process by
+    # default.
+    size = resource.getrlimit(resource.RLIMIT_STACK)[0]
+    if size == resource.RLIM_INFINITY:
+        return None
+    return size
+
+
+class MemorySampler(object):
+    """Keeps the memory estimates of a uniform random sample of
+    connections. Thread-safe.
+    """
+
+    def __init__(self, sample_size, shared_objects=()):
+        """Constructs an instance.
+
+        Args:
+            sample_size: the maximum number of connections to keep the
+                estimates of.
+            shared_objects: objects shared by connections which shouldn't be
+                counted. See estimate_connection_memory().
+        """
+
+        self._sample_size = sample_size
+        self._shared_objects = list(shared_objects)
+        self._lock = threading.Lock()
+        self._seen_count = 0
+        self._samples = []
+
+    def add_shared_object(self, obj):
+        self._lock.acquire()
+        try:
+            self._shared_objects.append(obj)
+        finally:
+            self._lock.release()
+
+    def add(self, request, shared_objects=()):
+        """Considers the connection of request for the sample. Estimates its
+        memory only if it's chosen, so that the cost decreases as more
+        connections are seen.
+
+        Args:
+            request: mod_python request after the opening handshake.
+            shared_objects: objects shared by connections in addition to the
+                ones given to the constructor.
+        """
+
+        self._lock.acquire()
+        try:
+            self._seen_count += 1
+            if len(self._samples) < self._sample_size:
+                index = len(self._samples)
+                self._samples.append(None)
+            else:
+                index = random.randint(0, self._seen_count - 1)
+                if index >= self._sample_size:
+                    return
+            shared_objects = self._shared_objects + list(shared_objects)
+        finally:
+            self._lock.release()
+
+        estimate = estimate_connection_memory(request, shared_objects)
+
+        self._lock.acquire()
+        try:
+            self._samples[index] = estimate
+        finally:
+            self._lock.release()
+
+    def summarize(self):
+        """Returns a dict mapping the name of each component to a tuple of
+        the mean and the maximum of its size in bytes over the sampled
+        connections, or an empty dict if no connection has been sampled.
+        """
+
+        self._lock.acquire()
+        try:
+            samples = [sample for sample in self._samples
+                       if sample is not None]
+        finally:
+            self._lock.release()
+
+        if not samples:
+            return {}
+        result = {}
+        for component in COMPONENTS:
+            sizes = [sample[component] for sample in samples]
+            result[component] = (
+                float(sum(sizes)) / len(sizes), max(sizes))
+        return result
+
+    def get_sample_count(self):
+        self._lock.acquire()
+        try:
+            return len([sample for sample in self._samples
+                        if sample is not None])
+        finally:
+            self._lock.release()
+
+
+# vi:sts=4 sw=4 et
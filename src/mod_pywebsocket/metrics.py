@@ -0,0 +1,613 @@
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Counters and histograms of WebSocket connections.
+
+MetricsRegistry holds the metrics of all the connections served by a
+Dispatcher and ConnectionMetrics those of a single connection. While a
+connection is open, its frames are recorded only to its own
+ConnectionMetrics so that connections don't contend for a lock. The registry
+adds up the metrics of open connections and those of closed connections when
+a snapshot is taken.
+
+A metric is identified by a name and labels. make_key builds the key from
+them, e.g. make_key('messages', direction='in', opcode='text').
+
+Counters:
+- frames (direction, opcode): frames including control frames.
+- fragments (direction): data frames which are not a whole message.
+- messages (direction, opcode): messages. Pings, pongs and close frames are
+  counted here with opcode 'ping', 'pong' and 'close'.
+- message_bytes (direction, opcode): payload octets of messages as they are
+  on the wire, i.e. after compression by extensions.
+- compression_original_bytes, compression_compressed_bytes (direction):
+  octets before and after compression by deflate-frame and permessage-deflate
+  extensions.
+- close_codes (direction, code): status codes of close frames. A connection
+  closed without receiving a close frame is counted as code 1006 in.
+- connections (resource): connections opened.
+- handshake_failures (reason): failed opening handshakes. reason is
+  'version', 'aborted', 'http_<status>' or the name of the exception.
+
+Gauges:
+- active_connections (resource)
+
+Histograms:
+- message_size (direction)
+- handshake_seconds
+- round_trip_seconds: time from sending a ping to receiving its pong.
+
+Multiplexed logical channels are not tracked on their own. Their frames are
+counted as data of the physical connection.
+"""
+
+
+import bisect
+import threading
+
+from mod_pywebsocket import common
+
+
+DIRECTION_IN = 'in'
+DIRECTION_OUT = 'out'
+
+# Upper bounds of the buckets of histograms.
+MESSAGE_SIZE_BOUNDS = (
+    16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+HANDSHAKE_SECONDS_BOUNDS = (
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+ROUND_TRIP_SECONDS_BOUNDS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_OPCODE_NAMES = {
+    common.OPCODE_CONTINUATION: 'continuation',
+    common.OPCODE_TEXT: 'text',
+    common.OPCODE_BINARY: 'binary',
+    common.OPCODE_CLOSE: 'close',
+    common.OPCODE_PING: 'ping',
+    common.OPCODE_PONG: 'pong',
+}
+
+
+def make_key(name, **labels):
+    """Returns the key of the metric with the given name and labels."""
+
+    items = labels.items()
+    items.sort()
+    return (name, tuple(items))
+
+
+def _get_opcode_name(opcode):
+    return _OPCODE_NAMES.get(opcode, str(opcode))
+
+
+def _build_keys(name):
+    """Returns a map from (direction, opcode) to the key of the metric with
+    the given name, so that keys aren't built for each frame.
+    """
+
+    keys = {}
+    for direction in (DIRECTION_IN, DIRECTION_OUT):
+        for opcode, opcode_name in _OPCODE_NAMES.iteritems():
+            keys[(direction, opcode)] = make_key(
+                name, direction=direction, opcode=opcode_name)
+    return keys
+
+
+_FRAME_KEYS = _build_keys('frames')
+_MESSAGE_KEYS = _build_keys('messages')
+_MESSAGE_BYTES_KEYS = _build_keys('message_bytes')
+_FRAGMENT_KEYS = {
+    DIRECTION_IN: make_key('fragments', direction=DIRECTION_IN),
+    DIRECTION_OUT: make_key('fragments', direction=DIRECTION_OUT),
+}
+_COMPRESSION_ORIGINAL_BYTES_KEYS = {
+    DIRECTION_IN: make_key(
+        'compression_original_bytes', direction=DIRECTION_IN),
+    DIRECTION_OUT: make_key(
+        'compression_original_bytes', direction=DIRECTION_OUT),
+}
+_COMPRESSION_COMPRESSED_BYTES_KEYS = {
+    DIRECTION_IN: make_key(
+        'compression_compressed_bytes', direction=DIRECTION_IN),
+    DIRECTION_OUT: make_key(
+        'compression_compressed_bytes', direction=DIRECTION_OUT),
+}
+_MESSAGE_SIZE_KEYS = {
+    DIRECTION_IN: make_key('message_size', direction=DIRECTION_IN),
+    DIRECTION_OUT: make_key('message_size', direction=DIRECTION_OUT),
+}
+_ROUND_TRIP_SECONDS_KEY = make_key('round_trip_seconds')
+
+
+def _get_key(keys, name, direction, opcode):
+    key = keys.get((direction, opcode))
+    if key is None:
+        key = make_key(
+            name, direction=direction, opcode=_get_opcode_name(opcode))
+    return key
+
+
+def _add_counters(counters, other_counters):
+    # items() copies the dict atomically even if another thread is adding
+    # keys to it.
+    for key, value in other_counters.items():
+        counters[key] = counters.get(key, 0) + value
+
+
+def _add_histograms(histograms, other_histograms):
+    for key, histogram in other_histograms.items():
+        if key in histograms:
+            histograms[key].merge(histogram)
+        else:
+            histograms[key] = histogram.copy()
+
+
+class Histogram(object):
+    """Counts observed values in buckets. bucket_counts[i] is the number of
+    values not greater than bounds[i] and greater than bounds[i - 1]. The
+    last bucket counts values greater than all the bounds.
+
+    This class is not thread-safe. Owners guard updates by their locks.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        if self.bounds != other.bounds:
+            raise ValueError('Cannot merge histograms with different bounds')
+        for i in xrange(len(self.bucket_counts)):
+            self.bucket_counts[i] += other.bucket_counts[i]
+        self.count += other.count
+        self.sum += other.sum
+
+    def copy(self):
+        histogram = Histogram(self.bounds)
+        histogram.merge(self)
+        return histogram
+
+    def get_quantile(self, quantile):
+        """Estimates the value at quantile (0 to 1) by linear interpolation
+        within the bucket containing it. Returns None if nothing has been
+        observed. Values in the last bucket are estimated as the largest
+        bound.
+        """
+
+        if self.count == 0:
+            return None
+        rank = quantile * self.count
+        cumulative_count = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            if cumulative_count + bucket_count >= rank and bucket_count:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = 0
+                if i > 0:
+                    lower = self.bounds[i - 1]
+                fraction = float(rank - cumulative_count) / bucket_count
+                return lower + (self.bounds[i] - lower) * fraction
+            cumulative_count += bucket_count
+        return self.bounds[-1]
+
+
+class _MetricsView(object):
+    """Read access to counters and histograms in dicts keyed by make_key."""
+
+    def get_counter(self, name, **labels):
+        return self._get_counters().get(make_key(name, **labels), 0)
+
+    def get_histogram(self, name, **labels):
+        """Returns a copy of the histogram, or None if nothing has been
+        observed.
+        """
+
+        histogram = self._get_histograms().get(make_key(name, **labels))
+        if histogram is None:
+            return None
+        return histogram.copy()
+
+
+class ConnectionMetrics(_MetricsView):
+    """Metrics of a WebSocket connection.
+
+    The methods to record frames can be called from the thread receiving
+    frames and the threads sending frames at the same time. They take a lock
+    owned by this instance only.
+    """
+
+    def __init__(self, registry=None):
+        """Constructs an instance.
+
+        Args:
+            registry: MetricsRegistry to report to on open() and close().
+                Can be None to use this instance alone.
+        """
+
+        self.resource = None
+
+        self._registry = registry
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        # Opcode and length of the message being transferred in each
+        # direction. The opcode is None when no message is being
+        # transferred.
+        self._pending_messages = {
+            DIRECTION_IN: [None, 0], DIRECTION_OUT: [None, 0]}
+        self._close_received = False
+        self._closed = False
+
+    def open(self, resource):
+        """Starts counting this connection as an active connection for
+        resource.
+        """
+
+        self.resource = resource
+        if self._registry is not None:
+            self._registry._add_connection(self)
+
+    def close(self):
+        """Moves the metrics of this connection to the closed connections
+        of the registry. Can be called more than once, even from multiple
+        threads. Calls but the first do nothing.
+        """
+
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            close_received = self._close_received
+        finally:
+            self._lock.release()
+
+        if not close_received:
+            self.add_close_code(DIRECTION_IN, common.STATUS_ABNORMAL_CLOSURE)
+        if self._registry is not None:
+            self._registry._remove_connection(self)
+
+    def add_frame(self, direction, opcode, fin, length):
+        """Records a frame.
+
+        Args:
+            direction: DIRECTION_IN or DIRECTION_OUT.
+            opcode: opcode of the frame.
+            fin: FIN bit of the frame.
+            length: length of the payload of the frame on the wire.
+        """
+
+        self._lock.acquire()
+        try:
+            counters = self._counters
+            key = _get_key(_FRAME_KEYS, 'frames', direction, opcode)
+            counters[key] = counters.get(key, 0) + 1
+
+            if common.is_control_opcode(opcode):
+                self._add_message(direction, opcode, length)
+                return
+
+            pending_message = self._pending_messages[direction]
+            if opcode != common.OPCODE_CONTINUATION:
+                pending_message[0] = opcode
+                pending_message[1] = 0
+            if not fin or opcode == common.OPCODE_CONTINUATION:
+                key = _FRAGMENT_KEYS[direction]
+                counters[key] = counters.get(key, 0) + 1
+            pending_message[1] += length
+            if fin and pending_message[0] is not None:
+                self._add_message(
+                    direction, pending_message[0], pending_message[1])
+                pending_message[0] = None
+        finally:
+            self._lock.release()
+
+    def _add_message(self, direction, opcode, length):
+        counters = self._counters
+
+        key = _get_key(_MESSAGE_KEYS, 'messages', direction, opcode)
+        counters[key] = counters.get(key, 0) + 1
+        key = _get_key(_MESSAGE_BYTES_KEYS, 'message_bytes', direction, opcode)
+        counters[key] = counters.get(key, 0) + length
+
+        key = _MESSAGE_SIZE_KEYS[direction]
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = Histogram(MESSAGE_SIZE_BOUNDS)
+            self._histograms[key] = histogram
+        histogram.observe(length)
+
+    def add_compression(self, direction, original_bytes, compressed_bytes):
+        """Records the size of data before and after compression by an
+        extension.
+
+        Args:
+            direction: DIRECTION_IN or DIRECTION_OUT.
+            original_bytes: size of the uncompressed data.
+            compressed_bytes: size of the compressed data.
+        """
+
+        original_key = _COMPRESSION_ORIGINAL_BYTES_KEYS[direction]
+        compressed_key = _COMPRESSION_COMPRESSED_BYTES_KEYS[direction]
+
+        self._lock.acquire()
+        try:
+            counters = self._counters
+            counters[original_key] = (
+                counters.get(original_key, 0) + original_bytes)
+            counters[compressed_key] = (
+                counters.get(compressed_key, 0) + compressed_bytes)
+        finally:
+            self._lock.release()
+
+    def add_round_trip_time(self, seconds):
+        """Records the time from sending a ping to receiving its pong."""
+
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(_ROUND_TRIP_SECONDS_KEY)
+            if histogram is None:
+                histogram = Histogram(ROUND_TRIP_SECONDS_BOUNDS)
+                self._histograms[_ROUND_TRIP_SECONDS_KEY] = histogram
+            histogram.observe(seconds)
+        finally:
+            self._lock.release()
+
+    def add_close_code(self, direction, code):
+        """Records the status code of a close frame.
+
+        Args:
+            direction: DIRECTION_IN or DIRECTION_OUT.
+            code: status code. None for a close frame without body.
+        """
+
+        if code is None:
+            code = common.STATUS_NO_STATUS_RECEIVED
+        key = make_key('close_codes', direction=direction, code=str(code))
+
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            if direction == DIRECTION_IN:
+                self._close_received = True
+        finally:
+            self._lock.release()
+
+    def _merge_into(self, counters, histograms):
+        # Doesn't take the lock so that taking a snapshot never blocks the
+        # threads transferring data. A histogram may be read in the middle
+        # of an update, which is fine for monitoring.
+        _add_counters(counters, self._counters)
+        _add_histograms(histograms, self._histograms)
+
+    def _get_counters(self):
+        counters = {}
+        self._merge_into(counters, {})
+        return counters
+
+    def _get_histograms(self):
+        histograms = {}
+        self._merge_into({}, histograms)
+        return histograms
+
+
+class MetricsSnapshot(_MetricsView):
+    """Metrics of all connections at a point of time."""
+
+    def __init__(self, counters, gauges, histograms):
+        self.counters = counters
+        self.gauges = gauges
+        self.histograms = histograms
+
+    def get_gauge(self, name, **labels):
+        return self.gauges.get(make_key(name, **labels), 0)
+
+    def _get_counters(self):
+        return self.counters
+
+    def _get_histograms(self):
+        return self.histograms
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        ['%s="%s"' % (name, _escape_label_value(value))
+         for name, value in labels])
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_text(snapshot, prefix='pywebsocket_'):
+    """Formats snapshot in the text exposition format of Prometheus.
+    Counters get the suffix _total.
+
+    Args:
+        snapshot: MetricsSnapshot instance.
+        prefix: string prepended to the names of metrics.
+    """
+
+    lines = []
+
+    for metric_type, values, suffix in (
+        ('counter', snapshot.counters, '_total'),
+        ('gauge', snapshot.gauges, '')):
+        last_name = None
+        for (name, labels), value in sorted(values.items()):
+            full_name = prefix + name + suffix
+            if name != last_name:
+                lines.append('# TYPE %s %s' % (full_name, metric_type))
+                last_name = name
+            lines.append('%s%s %s' % (
+                full_name, _format_labels(labels), _format_value(value)))
+
+    last_name = None
+    for (name, labels), histogram in sorted(snapshot.histograms.items()):
+        full_name = prefix + name
+        if name != last_name:
+            lines.append('# TYPE %s histogram' % full_name)
+            last_name = name
+        cumulative_count = 0
+        for bound, bucket_count in zip(
+            list(histogram.bounds) + [float('inf')],
+            histogram.bucket_counts):
+            cumulative_count += bucket_count
+            lines.append('%s_bucket%s %d' % (
+                full_name,
+                _format_labels(labels + (('le', _format_value(bound)),)),
+                cumulative_count))
+        lines.append('%s_sum%s %s' % (
+            full_name, _format_labels(labels), _format_value(histogram.sum)))
+        lines.append('%s_count%s %d' % (
+            full_name, _format_labels(labels), histogram.count))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRegistry(object):
+    """Metrics of all connections served by a Dispatcher. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = set()
+        # Server-wide metrics and metrics of closed connections.
+        self._counters = {}
+        self._histograms = {}
+
+    def create_connection_metrics(self):
+        """Returns a ConnectionMetrics reporting to this registry."""
+
+        return ConnectionMetrics(self)
+
+    def increment(self, name, amount=1, **labels):
+        """Adds amount to the server-wide counter."""
+
+        key = make_key(name, **labels)
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, bounds, **labels):
+        """Records value to the server-wide histogram with bounds."""
+
+        key = make_key(name, **labels)
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(bounds)
+                self._histograms[key] = histogram
+            histogram.observe(value)
+        finally:
+            self._lock.release()
+
+    def get_active_connection_count(self, resource=None):
+        """Returns the number of open connections for resource, or for all
+        resources if resource is None.
+        """
+
+        self._lock.acquire()
+        try:
+            if resource is None:
+                return len(self._connections)
+            count = 0
+            for connection in self._connections:
+                if connection.resource == resource:
+                    count += 1
+            return count
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns a MetricsSnapshot adding up metrics of the open and the
+        closed connections.
+        """
+
+        counters = {}
+        gauges = {}
+        histograms = {}
+
+        self._lock.acquire()
+        try:
+            _add_counters(counters, self._counters)
+            _add_histograms(histograms, self._histograms)
+            for connection in self._connections:
+                connection._merge_into(counters, histograms)
+                key = make_key(
+                    'active_connections', resource=connection.resource)
+                gauges[key] = gauges.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+        return MetricsSnapshot(counters, gauges, histograms)
+
+    def _add_connection(self, connection):
+        key = make_key('connections', resource=connection.resource)
+        self._lock.acquire()
+        try:
+            self._connections.add(connection)
+            self._counters[key] = self._counters.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+    def _remove_connection(self, connection):
+        self._lock.acquire()
+        try:
+            if connection not in self._connections:
+                return
+            self._connections.remove(connection)
+            connection._merge_into(self._counters, self._histograms)
+        finally:
+            self._lock.release()
+
+
+# vi:sts=4 sw=4 et
@@ -38,8 +38,11 @@ bytes writing/reading.
 """
 
 
+from collections import deque
 import Queue
+import socket
 import threading
+import time
 
 
 # Export Exception symbols from msgutil for backward compatibility
@@ -47,6 +50,38 @@ from mod_pywebsocket._stream_base import ConnectionTerminatedException
 from mod_pywebsocket._stream_base import InvalidFrameException
 from mod_pywebsocket._stream_base import BadOperationException
 from mod_pywebsocket._stream_base import UnsupportedFrameException
+from mod_pywebsocket._stream_hybi import Stream
+from mod_pywebsocket import common
+from mod_pywebsocket import eventloop
+from mod_pywebsocket import util
+
+
+_DEFAULT_POOL_SIZE = 8
+_DEFAULT_MAX_QUEUED_MESSAGES = 256
+# The number of messages PooledMessageSender sends before yielding the worker
+# to other connections.
+_MAX_MESSAGES_PER_SEND_TURN = 16
+_DEFAULT_HIGH_WATER_MARK = 1024 * 1024
+# Seconds OutboundMessageQueue waits for a message to be sent before aborting
+# the connection.
+_DEFAULT_SEND_TIMEOUT = 30
+# The maximum number of bytes PooledMessageReceiver reads from a socket at a
+# time.
+_RECEIVE_SIZE = 64 * 1024
+
+# Overflow policies of OutboundMessageQueue.
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_CLOSE_POLICY_VIOLATION = 'close_policy_violation'
+OVERFLOW_CLOSE_TRY_AGAIN_LATER = 'close_try_again_later'
+
+# Status codes of the close frames the close policies try to send before
+# aborting the connection.
+_OVERFLOW_CLOSE_CODES = {
+    OVERFLOW_CLOSE_POLICY_VIOLATION: common.STATUS_POLICY_VIOLATION,
+    OVERFLOW_CLOSE_TRY_AGAIN_LATER: common.STATUS_TRY_AGAIN_LATER,
+}
+_OVERFLOW_CLOSE_REASON = 'Send queue overflow'
 
 
 # An API for handler to send/receive WebSocket messages.
@@ -216,4 +251,865 @@ class MessageSender(threading.Thread):
         self._queue.put((message, threading.Condition()))
 
 
+class MessageWorkerPool(object):
+    """A bounded pool of threads which services PooledMessageReceiver and
+    PooledMessageSender instances of many connections.
+
+    Receivers don't occupy a worker while waiting for a message. An EventLoop
+    watches their sockets and a worker is assigned when one becomes readable.
+    """
+
+    def __init__(self, size=_DEFAULT_POOL_SIZE):
+        """Construct an instance.
+
+        Args:
+            size: the number of worker threads. They are started on demand.
+        """
+
+        self._logger = util.get_class_logger(self)
+
+        self._size = size
+        self._tasks = Queue.Queue()
+        self._workers = []
+        # The number of idle workers minus the number of queued tasks.
+        self._idle_worker_count = 0
+        self._lock = threading.Lock()
+        self._event_loop = eventloop.EventLoop()
+
+    def submit(self, task):
+        """Run task() on a worker thread. If all the workers are busy, task
+        waits for one of them.
+        """
+
+        self._submit(task, True)
+
+    def try_submit(self, task):
+        """Run task() on a worker thread if one is idle or can be started.
+
+        Returns:
+            True if task has been submitted, False if all the workers are
+            busy.
+        """
+
+        return self._submit(task, False)
+
+    def try_reserve(self):
+        """Reserve a worker thread for a task to be passed to
+        submit_reserved() later. The reservation must be released by
+        cancel_reservation() if no task is submitted.
+
+        Returns:
+            True if a worker has been reserved, False if all the workers are
+            busy.
+        """
+
+        self._lock.acquire()
+        try:
+            return self._reserve(False)
+        finally:
+            self._lock.release()
+
+    def submit_reserved(self, task):
+        """Run task() on the worker thread reserved by try_reserve()."""
+
+        if task is None:
+            raise ValueError('task must not be None')
+
+        self._tasks.put(task)
+
+    def cancel_reservation(self):
+        """Release the worker thread reserved by try_reserve()."""
+
+        self._on_task_done()
+
+    def _submit(self, task, wait_if_busy):
+        if task is None:
+            raise ValueError('task must not be None')
+
+        self._lock.acquire()
+        try:
+            if not self._reserve(wait_if_busy):
+                return False
+            self._tasks.put(task)
+            return True
+        finally:
+            self._lock.release()
+
+    def _reserve(self, wait_if_busy):
+        if self._idle_worker_count <= 0:
+            if len(self._workers) < self._size:
+                worker = _MessageWorker(self._tasks, self._on_task_done)
+                self._workers.append(worker)
+                worker.start()
+                self._idle_worker_count += 1
+            elif not wait_if_busy:
+                return False
+        self._idle_worker_count -= 1
+        return True
+
+    def _on_task_done(self):
+        self._lock.acquire()
+        try:
+            self._idle_worker_count += 1
+        finally:
+            self._lock.release()
+
+    def watch_readable(self, fd, task):
+        """Run task() on a worker thread once fd becomes readable."""
+
+        def _on_readable():
+            self.submit(task)
+        self._event_loop.watch_readable(fd, _on_readable)
+
+    def unwatch_readable(self, fd):
+        self._event_loop.unwatch_readable(fd)
+
+    def call_later(self, delay, callback):
+        """Call callback() after delay seconds on the thread watching
+        sockets, not on a worker thread, so that it runs even while all the
+        workers are blocked. callback must not block.
+        """
+
+        self._event_loop.call_later(delay, callback)
+
+    def get_worker_count(self):
+        return len(self._workers)
+
+    def get_queued_task_count(self):
+        """Returns the number of tasks waiting for a worker. Reads the queue
+        without taking its lock, so the value may be slightly stale.
+        """
+
+        return len(self._tasks.queue)
+
+    def stop(self):
+        """Stop watching sockets and stop the worker threads once queued
+        tasks are done. Waits for the threads to finish.
+        """
+
+        self._event_loop.stop()
+        self._lock.acquire()
+        try:
+            workers = self._workers
+            self._workers = []
+            for unused_worker in workers:
+                self._tasks.put(None)
+        finally:
+            self._lock.release()
+        for worker in workers:
+            if worker is not threading.currentThread():
+                worker.join()
+
+
+class _MessageWorker(threading.Thread):
+    """Worker thread of MessageWorkerPool."""
+
+    def __init__(self, tasks, on_task_done):
+        threading.Thread.__init__(self)
+        self._logger = util.get_class_logger(self)
+        self._tasks = tasks
+        self._on_task_done = on_task_done
+        self.setDaemon(True)
+
+    def run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            try:
+                task()
+            except Exception, e:
+                self._logger.error('Task raised exception:\n%s',
+                                   util.get_stack_trace())
+            self._on_task_done()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_worker_pool():
+    """Returns the MessageWorkerPool shared by PooledMessageReceiver and
+    PooledMessageSender instances constructed without a pool.
+    """
+
+    global _default_pool
+
+    _default_pool_lock.acquire()
+    try:
+        if _default_pool is None:
+            _default_pool = MessageWorkerPool()
+        return _default_pool
+    finally:
+        _default_pool_lock.release()
+
+
+class _NonBlockingReadConnection(eventloop._RewindableReadBuffer):
+    """Wraps mp_conn of a connection serviced by PooledMessageReceiver.
+
+    Until set_blocking() is called, read() never blocks. It's served from the
+    bytes received by fill() and raises eventloop._NeedMoreData if they run
+    short. The bytes consumed since the last mark() call can be pushed back
+    by rewind(). Other attributes are those of the wrapped connection.
+    """
+
+    def __init__(self, connection):
+        eventloop._RewindableReadBuffer.__init__(self)
+
+        self._connection = connection
+        self._blocking = False
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def read(self, length):
+        """Mimics mp_conn.read()."""
+
+        data = self._read_buffered(length)
+        if data is None:
+            if self._eof:
+                # StreamBase raises ConnectionTerminatedException for this.
+                return ''
+            if not self._blocking:
+                raise eventloop._NeedMoreData()
+            available = self._get_available_length()
+            data = (self._read_buffered(available) +
+                    self._connection.read(length - available))
+        return data
+
+    def fill(self):
+        """Appends bytes which can be read from the wrapped connection
+        without blocking to the read buffer.
+        """
+
+        try:
+            data = self._connection.read_nonblocking(_RECEIVE_SIZE)
+        except Exception, e:
+            data = ''
+        if data is None:
+            return
+        if not data:
+            self._eof = True
+            return
+        self._append(data)
+
+    def set_blocking(self):
+        """Makes read() wait for the bytes requested on the wrapped
+        connection once the read buffer runs out.
+        """
+
+        self._blocking = True
+
+
+class PooledMessageReceiver(object):
+    """MessageReceiver serviced by a MessageWorkerPool instead of a thread
+    of its own.
+
+    Messages are received by a worker of the pool when the socket becomes
+    readable. The worker parses only the bytes already received and
+    returns to the pool when a frame is incomplete, so a peer sending a
+    frame slowly doesn't occupy a worker. This requires
+    request.connection.read_nonblocking() and an RFC 6455 stream.
+    Connections without them (mod_python, logical channels of the
+    multiplexing extension, TLS, HyBi 00) fall back to a dedicated thread.
+
+    When the queue is full, receiving is suspended until a message is taken
+    out from it.
+
+    Note: This class should not be used with the standalone server for wss
+    because pyOpenSSL used by the server raises a fatal error if the socket
+    is accessed from multiple threads.
+    """
+
+    def __init__(self, request, onmessage=None, pool=None,
+                 max_queued_messages=_DEFAULT_MAX_QUEUED_MESSAGES):
+        """Construct an instance.
+
+        Args:
+            request: mod_python request.
+            onmessage: a function to be called when a message is received.
+                       May be None. If not None, the function is called on
+                       a worker thread and must not block.
+            pool: MessageWorkerPool to use. If None, the one returned by
+                  get_default_worker_pool() is used.
+            max_queued_messages: the maximum number of messages received
+                                 but not taken by receive methods.
+        """
+
+        self._logger = util.get_class_logger(self)
+
+        self._request = request
+        self._onmessage = onmessage
+        if pool is None:
+            pool = get_default_worker_pool()
+        self._pool = pool
+        self._queue = Queue.Queue(max_queued_messages)
+
+        self._lock = threading.Lock()
+        self._stop_requested = False
+        self._finished = False
+        self._paused = False
+
+        connection = request.connection
+        if (getattr(connection, 'fileno', None) is None or
+            getattr(connection, 'read_nonblocking', None) is None or
+            request.is_https() or
+            not isinstance(request.ws_stream, Stream)):
+            self._fd = None
+            self._reader = None
+            thread = threading.Thread(target=self._receive_forever)
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            self._fd = connection.fileno()
+            self._reader = _NonBlockingReadConnection(connection)
+            request.connection = self._reader
+            # Remember where each frame starts so that a frame which hasn't
+            # been fully received can be parsed again from the start.
+            request.ws_stream.set_frame_start_listener(self._reader.mark)
+            # Bytes following the opening handshake may have been read
+            # ahead already.
+            self._pool.submit(self._receive_available)
+
+    def _watch(self):
+        self._pool.watch_readable(self._fd, self._receive_available)
+
+    def _receive_available(self):
+        """Receives messages from the bytes available on the connection,
+        then waits for the socket to become readable again.
+        """
+
+        self._reader.fill()
+        # Don't parse the frame being received again until it can be
+        # complete.
+        while self._reader.has_needed_data():
+            self._lock.acquire()
+            try:
+                if self._stop_requested:
+                    return
+                if self._queue.full():
+                    self._paused = True
+                    return
+            finally:
+                self._lock.release()
+
+            try:
+                if not self._receive_one():
+                    return
+            except eventloop._NeedMoreData:
+                self._reader.rewind()
+                break
+
+        self._lock.acquire()
+        try:
+            # Don't watch again once stop() has unwatched the socket.
+            if not self._stop_requested:
+                self._watch()
+        finally:
+            self._lock.release()
+
+    def _receive_forever(self):
+        while not self._stop_requested:
+            if not self._receive_one(block=True):
+                return
+
+    def _receive_one(self, block=False):
+        """Receives and delivers one message. Returns False when no more
+        messages will be received.
+
+        Raises:
+            eventloop._NeedMoreData: when the rest of a frame hasn't been
+                received yet.
+        """
+
+        try:
+            message = receive_message(self._request)
+        except eventloop._NeedMoreData:
+            raise
+        except Exception, e:
+            self._logger.debug('%s', e)
+            self._finish()
+            return False
+
+        if self._onmessage:
+            try:
+                self._onmessage(message)
+            except Exception, e:
+                self._logger.error('onmessage raised exception:\n%s',
+                                   util.get_stack_trace())
+        else:
+            # Only this method puts. When block is False, the queue has a
+            # room as checked by _receive_available.
+            self._queue.put(message, block)
+
+        if message is None:
+            self._finish()
+            return False
+        return True
+
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._finished = True
+        finally:
+            self._lock.release()
+
+        try:
+            close_connection(self._request)
+        except Exception, e:
+            self._logger.debug('Failed to close connection: %s', e)
+        self._wake_up_receiver()
+
+    def _wake_up_receiver(self):
+        try:
+            self._queue.put_nowait(None)
+        except Queue.Full:
+            # The receiver isn't blocked.
+            pass
+
+    def receive(self, timeout=None):
+        """Receive a message from the channel, blocking.
+
+        Args:
+            timeout: the maximum time to wait in seconds. None means forever.
+
+        Returns:
+            message as a unicode string, or None if no message arrived
+            within timeout or no more message will arrive.
+        """
+
+        self._lock.acquire()
+        try:
+            block = not (self._finished or self._stop_requested)
+        finally:
+            self._lock.release()
+
+        try:
+            message = self._queue.get(block, timeout)
+        except Queue.Empty:
+            return None
+        self._resume()
+        return message
+
+    def receive_nowait(self):
+        """Receive a message from the channel, non-blocking.
+
+        Returns:
+            message as a unicode string if available. None otherwise.
+        """
+
+        return self.receive(timeout=0)
+
+    def _resume(self):
+        self._lock.acquire()
+        try:
+            if not self._paused or self._stop_requested:
+                return
+            self._paused = False
+        finally:
+            self._lock.release()
+        self._pool.submit(self._receive_available)
+
+    def stop(self):
+        """Stop receiving messages. The connection is left open. Bytes
+        already read from the socket are still returned by reads of
+        request.connection.
+
+        Unlike MessageReceiver.stop, this takes effect immediately unless a
+        message is being received, except for connections serviced by a
+        dedicated thread.
+        """
+
+        self._lock.acquire()
+        try:
+            self._stop_requested = True
+        finally:
+            self._lock.release()
+        if self._fd is not None:
+            self._pool.unwatch_readable(self._fd)
+            self._reader.set_blocking()
+        self._wake_up_receiver()
+
+
+class _PendingMessage(object):
+    def __init__(self, message):
+        self.message = message
+        self.error = None
+        self.done = threading.Event()
+
+
+class PooledMessageSender(object):
+    """MessageSender serviced by a MessageWorkerPool instead of a thread of
+    its own.
+
+    Note: This class should not be used with the standalone server for wss
+    because pyOpenSSL used by the server raises a fatal error if the socket
+    is accessed from multiple threads.
+    """
+
+    def __init__(self, request, pool=None,
+                 max_queued_messages=_DEFAULT_MAX_QUEUED_MESSAGES):
+        """Construct an instance.
+
+        Args:
+            request: mod_python request.
+            pool: MessageWorkerPool to use. If None, the one returned by
+                  get_default_worker_pool() is used.
+            max_queued_messages: the maximum number of messages waiting to
+                                 be sent.
+        """
+
+        self._logger = util.get_class_logger(self)
+
+        self._request = request
+        if pool is None:
+            pool = get_default_worker_pool()
+        self._pool = pool
+        self._queue = Queue.Queue(max_queued_messages)
+
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._stop_requested = False
+
+    def send(self, message, timeout=None):
+        """Send a message, blocking until it's written.
+
+        Args:
+            timeout: the maximum time to wait for a room in the queue in
+                     seconds. None means forever.
+
+        Raises:
+            Queue.Full: when the queue had no room within timeout.
+            BadOperationException: when the sender has been stopped.
+            Exceptions raised by send_message are re-raised.
+        """
+
+        pending = _PendingMessage(message)
+        self._enqueue(pending, True, timeout)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+    def send_nowait(self, message):
+        """Send a message, non-blocking.
+
+        Raises:
+            Queue.Full: when the queue is full.
+        """
+
+        self._enqueue(_PendingMessage(message), False, None)
+
+    def _enqueue(self, pending, block, timeout):
+        if self._stop_requested:
+            raise BadOperationException('Sender is already stopped')
+        self._queue.put(pending, block, timeout)
+
+        self._lock.acquire()
+        try:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        finally:
+            self._lock.release()
+        self._pool.submit(self._send_queued)
+
+    def _send_queued(self):
+        for i in xrange(_MAX_MESSAGES_PER_SEND_TURN):
+            try:
+                pending = self._queue.get_nowait()
+            except Queue.Empty:
+                self._lock.acquire()
+                try:
+                    if self._queue.empty():
+                        self._scheduled = False
+                        return
+                finally:
+                    self._lock.release()
+                continue
+
+            if self._stop_requested:
+                pending.error = BadOperationException(
+                    'Sender is already stopped')
+            else:
+                try:
+                    send_message(self._request, pending.message)
+                except Exception, e:
+                    self._logger.debug('%s', e)
+                    pending.error = e
+            pending.done.set()
+        # Let other connections use the worker.
+        self._pool.submit(self._send_queued)
+
+    def stop(self):
+        """Stop sending. Messages not sent yet are discarded and blocked
+        send calls raise BadOperationException.
+        """
+
+        self._stop_requested = True
+        while True:
+            try:
+                pending = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            pending.error = BadOperationException('Sender is already stopped')
+            pending.done.set()
+
+
+class OutboundMessageQueue(object):
+    """Queues messages to send to the client and sends them on a
+    MessageWorkerPool, so that a slow client never blocks the producer.
+
+    The amount of buffered data, i.e. queued messages and the message being
+    sent, is limited by a high-water mark in bytes. Text messages are
+    counted by their length in UTF-8. When a message would make the amount
+    exceed the high-water mark, the overflow policy decides what to do:
+
+    - OVERFLOW_DROP_NEWEST: discards the message.
+    - OVERFLOW_DROP_OLDEST: discards queued messages from the oldest until
+      the message fits.
+    - OVERFLOW_CLOSE_POLICY_VIOLATION, OVERFLOW_CLOSE_TRY_AGAIN_LATER:
+      discards all queued messages and aborts the connection by shutting
+      down its socket, which also releases a worker blocked on sending to
+      the slow client. If no message is being sent, a close frame with
+      status code 1008 or 1013 respectively is written first as far as the
+      socket accepts it without blocking.
+
+    A message is always accepted when nothing is buffered, even if it's
+    larger than the high-water mark.
+
+    Whatever the policy is, when sending a message takes longer than the
+    send timeout, the queued messages are discarded and the connection is
+    aborted, so that a client which stopped reading doesn't keep a worker
+    of the pool blocked.
+
+    Note: Don't send messages by other means while using this class.
+    """
+
+    def __init__(self, request, high_water_mark=_DEFAULT_HIGH_WATER_MARK,
+                 overflow_policy=OVERFLOW_DROP_NEWEST, pool=None,
+                 send_timeout=_DEFAULT_SEND_TIMEOUT):
+        """Construct an instance.
+
+        Args:
+            request: mod_python request.
+            high_water_mark: the maximum amount of queued data.
+            overflow_policy: one of the OVERFLOW_* constants.
+            pool: MessageWorkerPool to use. If None, the one returned by
+                  get_default_worker_pool() is used.
+            send_timeout: seconds to wait for a message to be sent before
+                  aborting the connection. None means forever.
+
+        Raises:
+            ValueError: when overflow_policy is unknown.
+        """
+
+        if (overflow_policy not in _OVERFLOW_CLOSE_CODES and
+            overflow_policy not in (OVERFLOW_DROP_NEWEST,
+                                    OVERFLOW_DROP_OLDEST)):
+            raise ValueError('Unknown overflow policy: %r' % overflow_policy)
+
+        self._logger = util.get_class_logger(self)
+
+        self._request = request
+        self._high_water_mark = high_water_mark
+        self._overflow_policy = overflow_policy
+        if pool is None:
+            pool = get_default_worker_pool()
+        self._pool = pool
+        self._send_timeout = send_timeout
+
+        self._lock = threading.Lock()
+        # Holds (message, binary, size) tuples.
+        self._messages = deque()
+        # Includes the size of the message being sent.
+        self._buffered_amount = 0
+        self._dropped_message_count = 0
+        self._scheduled = False
+        self._closed = False
+        # Time when sending the message being sent started, or None.
+        self._send_started_at = None
+        self._deadline_scheduled = False
+
+    def try_send(self, message, binary=False):
+        """Queue a message to send, non-blocking.
+
+        Returns:
+            True if the message was queued, False if it was discarded.
+        """
+
+        if isinstance(message, unicode):
+            size = len(message.encode('utf-8'))
+        else:
+            size = len(message)
+
+        overflowed = False
+        close_code = None
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return False
+
+            if (self._buffered_amount and
+                self._buffered_amount + size > self._high_water_mark):
+                if self._overflow_policy == OVERFLOW_DROP_NEWEST:
+                    self._dropped_message_count += 1
+                    return False
+                elif self._overflow_policy == OVERFLOW_DROP_OLDEST:
+                    while (self._messages and
+                           self._buffered_amount + size >
+                           self._high_water_mark):
+                        unused_message, unused_binary, dropped_size = (
+                            self._messages.popleft())
+                        self._buffered_amount -= dropped_size
+                        self._dropped_message_count += 1
+                else:
+                    self._logger.debug(
+                        'Send queue overflowed. Aborting connection '
+                        '(status code %d)',
+                        _OVERFLOW_CLOSE_CODES[self._overflow_policy])
+                    # A close frame can't follow a message being sent,
+                    # which may have been partially written.
+                    if self._send_started_at is None:
+                        close_code = _OVERFLOW_CLOSE_CODES[
+                            self._overflow_policy]
+                    self._dropped_message_count += 1
+                    self._close()
+                    overflowed = True
+
+            if not overflowed:
+                self._messages.append((message, binary, size))
+                self._buffered_amount += size
+                self._schedule()
+                return True
+        finally:
+            self._lock.release()
+
+        self._abort(close_code)
+        return False
+
+    def _abort(self, close_code):
+        """Shuts down the socket. If close_code is not None, tries to write
+        a close frame with it first.
+        """
+
+        if close_code is not None:
+            send_close = getattr(self._request.ws_stream,
+                                 '_send_closing_handshake_nonblocking', None)
+            if send_close is not None:
+                try:
+                    send_close(close_code, _OVERFLOW_CLOSE_REASON)
+                except Exception, e:
+                    self._logger.debug('Failed to send close frame: %s', e)
+
+        shutdown = getattr(self._request.connection, 'shutdown', None)
+        if shutdown is None:
+            self._logger.debug('Connection can\'t be shut down')
+            return
+        try:
+            shutdown()
+        except socket.error, e:
+            self._logger.debug('Failed to shut down socket: %s', e)
+
+    def _schedule(self):
+        # Must be called with self._lock held.
+        if self._scheduled:
+            return
+        self._scheduled = True
+        self._pool.submit(self._send_queued)
+
+    def _send_queued(self):
+        for i in xrange(_MAX_MESSAGES_PER_SEND_TURN):
+            self._lock.acquire()
+            try:
+                if not self._messages:
+                    self._scheduled = False
+                    return
+                message, binary, size = self._messages.popleft()
+                self._send_started_at = time.time()
+                if (self._send_timeout is not None and
+                    not self._deadline_scheduled):
+                    self._deadline_scheduled = True
+                    self._pool.call_later(self._send_timeout,
+                                          self._check_send_deadline)
+            finally:
+                self._lock.release()
+
+            try:
+                self._request.ws_stream.send_message(message, binary=binary)
+            except Exception, e:
+                self._logger.debug('Failed to send message: %s', e)
+                self._lock.acquire()
+                try:
+                    self._close()
+                    self._scheduled = False
+                finally:
+                    self._lock.release()
+                return
+
+            self._lock.acquire()
+            try:
+                self._send_started_at = None
+                # The amount has been reset if aborted while sending.
+                if not self._closed:
+                    self._buffered_amount -= size
+            finally:
+                self._lock.release()
+        # Let other connections use the worker.
+        self._pool.submit(self._send_queued)
+
+    def _check_send_deadline(self):
+        # Called on the thread of the pool watching sockets. Checks the
+        # message being sent at most once per send timeout.
+        self._lock.acquire()
+        try:
+            if self._closed or self._send_started_at is None:
+                self._deadline_scheduled = False
+                return
+            remaining = (self._send_started_at + self._send_timeout -
+                         time.time())
+            if remaining > 0:
+                self._pool.call_later(remaining, self._check_send_deadline)
+                return
+            self._logger.debug('Sending a message timed out. Aborting '
+                               'connection')
+            self._deadline_scheduled = False
+            self._close()
+        finally:
+            self._lock.release()
+
+        # The message being sent may have been partially written, so a
+        # close frame can't be sent.
+        self._abort(None)
+
+    def _close(self):
+        # Must be called with self._lock held.
+        self._closed = True
+        self._dropped_message_count += len(self._messages)
+        self._messages.clear()
+        self._buffered_amount = 0
+        self._send_started_at = None
+
+    def get_queue_depth(self):
+        """Returns the number of queued messages."""
+
+        return len(self._messages)
+
+    def get_buffered_amount(self):
+        """Returns the number of bytes of the queued messages and the message
+        being sent.
+        """
+
+        return self._buffered_amount
+
+    def get_dropped_message_count(self):
+        """Returns the number of messages discarded so far."""
+
+        return self._dropped_message_count
+
+    def is_closed(self):
+        """Returns True if no more messages will be accepted."""
+
+        return self._closed
+
+
 # vi:sts=4 sw=4 et
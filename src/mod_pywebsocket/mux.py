@@ -36,7 +36,6 @@ http://tools.ietf.org/html/draft-ietf-hybi-websocket-multiplexing-06
 
 
 import collections
-import copy
 import email
 import email.parser
 import logging
@@ -47,6 +46,7 @@ import traceback
 
 from mod_pywebsocket import common
 from mod_pywebsocket import handshake
+from mod_pywebsocket import tracing
 from mod_pywebsocket import util
 from mod_pywebsocket._stream_base import BadOperationException
 from mod_pywebsocket._stream_base import ConnectionTerminatedException
@@ -56,7 +56,6 @@ from mod_pywebsocket._stream_hybi import Stream
 from mod_pywebsocket._stream_hybi import StreamOptions
 from mod_pywebsocket._stream_hybi import create_binary_frame
 from mod_pywebsocket._stream_hybi import create_closing_handshake_body
-from mod_pywebsocket._stream_hybi import create_header
 from mod_pywebsocket._stream_hybi import create_length_header
 from mod_pywebsocket._stream_hybi import parse_frame
 from mod_pywebsocket.handshake import hybi
@@ -75,6 +74,26 @@ _MAX_CHANNEL_ID = 2 ** 29 - 1
 
 _INITIAL_NUMBER_OF_CHANNEL_SLOTS = 64
 _INITIAL_QUOTA_FOR_CLIENT = 8 * 1024
+# Maximum number of bytes the writer thread writes to the physical connection
+# at once.
+_MAX_WRITE_BATCH_SIZE = 64 * 1024
+# Number of bytes a logical channel is allowed to write in its turn of the
+# writer's round robin.
+_WRITER_QUANTUM = 4 * 1024
+# Upper limit of the receive window of a logical channel when it's adjusted
+# adaptively.
+_MAX_RECEIVE_WINDOW = 1024 * 1024
+
+# Precompiled structs for parsing multiplexing control blocks. unpack_from
+# reads fields without slicing the payload.
+_UINT16 = struct.Struct('!H')
+_UINT32 = struct.Struct('!L')
+_UINT64 = struct.Struct('!Q')
+# The first byte of a control block and the first bytes of the two fields
+# following it. When both fields are encoded in one byte, e.g. a channel id
+# less than 128 followed by a number less than 126, this is the whole header
+# of the control block.
+_CONTROL_BLOCK_HEADER = struct.Struct('!BBB')
 
 _HANDSHAKE_ENCODING_IDENTITY = 0
 _HANDSHAKE_ENCODING_DELTA = 1
@@ -82,6 +101,7 @@ _HANDSHAKE_ENCODING_DELTA = 1
 # We need only these status code for now.
 _HTTP_BAD_RESPONSE_MESSAGES = {
     common.HTTP_STATUS_BAD_REQUEST: 'Bad Request',
+    common.HTTP_STATUS_SERVICE_UNAVAILABLE: 'Service Unavailable',
 }
 
 # DropChannel reason code
@@ -235,7 +255,7 @@ class _ControlBlock(object):
     """A structure that holds parsing result of multiplexing control block.
     Control block specific attributes will be added by _MuxFramePayloadParser.
     (e.g. encoded_handshake will be added for AddChannelRequest and
-    AddChannelResponse)
+    AddChannelResponse as a memoryview of the payload)
     """
 
     def __init__(self, opcode):
@@ -247,6 +267,9 @@ class _MuxFramePayloadParser(object):
 
     def __init__(self, payload):
         self._data = payload
+        # memoryview of the payload to return contents of control blocks
+        # without copying. Created on demand.
+        self._view = None
         self._read_position = 0
         self._logger = util.get_class_logger(self)
 
@@ -268,20 +291,18 @@ class _MuxFramePayloadParser(object):
         if channel_id & 0xe0 == 0xe0:
             if remaining_length < 4:
                 raise ValueError('Invalid channel id format')
-            channel_id = struct.unpack('!L',
-                                       self._data[pos:pos+4])[0] & 0x1fffffff
+            channel_id = _UINT32.unpack_from(self._data, pos)[0] & 0x1fffffff
             channel_id_length = 4
         elif channel_id & 0xc0 == 0xc0:
             if remaining_length < 3:
                 raise ValueError('Invalid channel id format')
             channel_id = (((channel_id & 0x1f) << 16) +
-                          struct.unpack('!H', self._data[pos+1:pos+3])[0])
+                          _UINT16.unpack_from(self._data, pos + 1)[0])
             channel_id_length = 3
         elif channel_id & 0x80 == 0x80:
             if remaining_length < 2:
                 raise ValueError('Invalid channel id format')
-            channel_id = struct.unpack('!H',
-                                       self._data[pos:pos+2])[0] & 0x3fff
+            channel_id = _UINT16.unpack_from(self._data, pos)[0] & 0x3fff
             channel_id_length = 2
         self._read_position += channel_id_length
 
@@ -327,7 +348,7 @@ class _MuxFramePayloadParser(object):
             if pos + 8 > len(self._data):
                 raise ValueError('Invalid number field')
             self._read_position += 8
-            number = struct.unpack('!Q', self._data[pos:pos+8])[0]
+            number = _UINT64.unpack_from(self._data, pos)[0]
             if number > 0x7FFFFFFFFFFFFFFF:
                 raise ValueError('Encoded number(%d) >= 2^63' % number)
             if number <= 0xFFFF:
@@ -338,17 +359,32 @@ class _MuxFramePayloadParser(object):
             if pos + 2 > len(self._data):
                 raise ValueError('Invalid number field')
             self._read_position += 2
-            number = struct.unpack('!H', self._data[pos:pos+2])[0]
+            number = _UINT16.unpack_from(self._data, pos)[0]
             if number <= 125:
                 raise ValueError(
                     '%d should not be encoded by 3 bytes encoding' % number)
         return number
 
+    def _read_contents(self, size):
+        """Returns a memoryview of the next size bytes of the payload."""
+
+        pos = self._read_position
+        if pos + size > len(self._data):
+            raise PhysicalConnectionError(
+                _DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
+                'Cannot read %d bytes data' % size)
+
+        self._read_position += size
+        if self._view is None:
+            self._view = memoryview(self._data)
+        return self._view[pos:pos + size]
+
     def _read_size_and_contents(self):
         """Reads data that consists of followings:
             - the size of the contents encoded the same way as payload length
               of the WebSocket Protocol with 1 bit padding at the head.
             - the contents.
+        The contents are returned as a memoryview of the payload.
         """
 
         try:
@@ -356,16 +392,92 @@ class _MuxFramePayloadParser(object):
         except ValueError, e:
             raise PhysicalConnectionError(_DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
                                           str(e))
+        return self._read_contents(size)
+
+    def _read_control_block_header(self):
+        """Reads the first byte of a control block and the two fields
+        following it, and returns them as a tuple. The first field is the
+        number of slots for NewChannelSlot and the channel id for the
+        others. The second one is a size or a number. The fields are None
+        for unknown opcodes.
+
+        The three bytes at the head are unpacked at once. They're the whole
+        header when both fields are encoded in one byte. Otherwise, the rest
+        of the fields is unpacked from the payload at the offset told by
+        them.
+        """
+
+        data = self._data
         pos = self._read_position
-        if pos + size > len(self._data):
-            raise PhysicalConnectionError(
-                _DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
-                'Cannot read %d bytes data' % size)
+        if pos + 3 > len(data):
+            # Too short for any control block. Let read_channel_id and
+            # _read_number report the error.
+            first_byte = ord(data[pos])
+            opcode = first_byte >> 5
+            self._read_position = pos + 1
+            if opcode > _MUX_OPCODE_NEW_CHANNEL_SLOT:
+                return first_byte, None, None
+            try:
+                if opcode == _MUX_OPCODE_NEW_CHANNEL_SLOT:
+                    field1 = self._read_number()
+                else:
+                    field1 = self.read_channel_id()
+                return first_byte, field1, self._read_number()
+            except ValueError, e:
+                raise PhysicalConnectionError(
+                    _DROP_CODE_INVALID_MUX_CONTROL_BLOCK, str(e))
 
-        self._read_position += size
-        return self._data[pos:pos+size]
+        first_byte, field1, field2 = _CONTROL_BLOCK_HEADER.unpack_from(
+            data, pos)
+        opcode = first_byte >> 5
+        if opcode > _MUX_OPCODE_NEW_CHANNEL_SLOT:
+            self._read_position = pos + 1
+            return first_byte, None, None
+
+        try:
+            if opcode == _MUX_OPCODE_NEW_CHANNEL_SLOT:
+                if field1 >= 126:
+                    self._read_position = pos + 1
+                    field1 = self._read_number()
+                    return first_byte, field1, self._read_number()
+            elif field1 >= 0x80:
+                # The channel id takes 2, 3 or 4 bytes.
+                if field1 < 0xc0:
+                    if pos + 3 > len(data):
+                        raise ValueError('Invalid channel id format')
+                    field1 = _UINT16.unpack_from(data, pos + 1)[0] & 0x3fff
+                    self._read_position = pos + 3
+                elif field1 < 0xe0:
+                    if pos + 4 > len(data):
+                        raise ValueError('Invalid channel id format')
+                    field1 = (((field1 & 0x1f) << 16) +
+                              _UINT16.unpack_from(data, pos + 2)[0])
+                    self._read_position = pos + 4
+                else:
+                    if pos + 5 > len(data):
+                        raise ValueError('Invalid channel id format')
+                    field1 = (_UINT32.unpack_from(data, pos + 1)[0] &
+                              0x1fffffff)
+                    self._read_position = pos + 5
+                return first_byte, field1, self._read_number()
+
+            if field2 < 126:
+                self._read_position = pos + 3
+                return first_byte, field1, field2
+            if field2 == 126 and pos + 5 <= len(data):
+                field2 = _UINT16.unpack_from(data, pos + 3)[0]
+                if field2 > 125:
+                    self._read_position = pos + 5
+                    return first_byte, field1, field2
+            # Let _read_number handle the 9 bytes encoding and errors.
+            self._read_position = pos + 2
+            return first_byte, field1, self._read_number()
+        except ValueError, e:
+            raise PhysicalConnectionError(
+                _DROP_CODE_INVALID_MUX_CONTROL_BLOCK, str(e))
 
-    def _read_add_channel_request(self, first_byte, control_block):
+    def _read_add_channel_request(self, first_byte, control_block, channel_id,
+                                  size):
         reserved = (first_byte >> 2) & 0x7
         if reserved != 0:
             raise PhysicalConnectionError(
@@ -373,17 +485,13 @@ class _MuxFramePayloadParser(object):
                 'Reserved bits must be unset')
 
         # Invalid encoding will be handled by MuxHandler.
-        encoding = first_byte & 0x3
-        try:
-            control_block.channel_id = self.read_channel_id()
-        except ValueError, e:
-            raise PhysicalConnectionError(_DROP_CODE_INVALID_MUX_CONTROL_BLOCK)
-        control_block.encoding = encoding
-        encoded_handshake = self._read_size_and_contents()
-        control_block.encoded_handshake = encoded_handshake
+        control_block.encoding = first_byte & 0x3
+        control_block.channel_id = channel_id
+        control_block.encoded_handshake = self._read_contents(size)
         return control_block
 
-    def _read_add_channel_response(self, first_byte, control_block):
+    def _read_add_channel_response(self, first_byte, control_block,
+                                   channel_id, size):
         reserved = (first_byte >> 2) & 0x3
         if reserved != 0:
             raise PhysicalConnectionError(
@@ -392,66 +500,53 @@ class _MuxFramePayloadParser(object):
 
         control_block.accepted = (first_byte >> 4) & 1
         control_block.encoding = first_byte & 0x3
-        try:
-            control_block.channel_id = self.read_channel_id()
-        except ValueError, e:
-            raise PhysicalConnectionError(_DROP_CODE_INVALID_MUX_CONTROL_BLOCK)
-        control_block.encoded_handshake = self._read_size_and_contents()
+        control_block.channel_id = channel_id
+        control_block.encoded_handshake = self._read_contents(size)
         return control_block
 
-    def _read_flow_control(self, first_byte, control_block):
+    def _read_flow_control(self, first_byte, control_block, channel_id,
+                           send_quota):
         reserved = first_byte & 0x1f
         if reserved != 0:
             raise PhysicalConnectionError(
                 _DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
                 'Reserved bits must be unset')
 
-        try:
-            control_block.channel_id = self.read_channel_id()
-            control_block.send_quota = self._read_number()
-        except ValueError, e:
-            raise PhysicalConnectionError(_DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
-                                          str(e))
-
+        control_block.channel_id = channel_id
+        control_block.send_quota = send_quota
         return control_block
 
-    def _read_drop_channel(self, first_byte, control_block):
+    def _read_drop_channel(self, first_byte, control_block, channel_id, size):
         reserved = first_byte & 0x1f
         if reserved != 0:
             raise PhysicalConnectionError(
                 _DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
                 'Reserved bits must be unset')
 
-        try:
-            control_block.channel_id = self.read_channel_id()
-        except ValueError, e:
-            raise PhysicalConnectionError(_DROP_CODE_INVALID_MUX_CONTROL_BLOCK)
-        reason = self._read_size_and_contents()
-        if len(reason) == 0:
+        control_block.channel_id = channel_id
+        if size == 0:
             control_block.drop_code = None
             control_block.drop_message = ''
-        elif len(reason) >= 2:
-            control_block.drop_code = struct.unpack('!H', reason[:2])[0]
-            control_block.drop_message = reason[2:]
+        elif size >= 2:
+            reason = self._read_contents(size)
+            control_block.drop_code = _UINT16.unpack_from(reason)[0]
+            control_block.drop_message = reason[2:].tobytes()
         else:
             raise PhysicalConnectionError(
                 _DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
                 'Received DropChannel that conains only 1-byte reason')
         return control_block
 
-    def _read_new_channel_slot(self, first_byte, control_block):
+    def _read_new_channel_slot(self, first_byte, control_block, slots,
+                               send_quota):
         reserved = first_byte & 0x1e
         if reserved != 0:
             raise PhysicalConnectionError(
                 _DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
                 'Reserved bits must be unset')
         control_block.fallback = first_byte & 1
-        try:
-            control_block.slots = self._read_number()
-            control_block.send_quota = self._read_number()
-        except ValueError, e:
-            raise PhysicalConnectionError(_DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
-                                          str(e))
+        control_block.slots = slots
+        control_block.send_quota = send_quota
         return control_block
 
     def read_control_blocks(self):
@@ -464,21 +559,24 @@ class _MuxFramePayloadParser(object):
         """
 
         while self._read_position < len(self._data):
-            first_byte = ord(self._data[self._read_position])
-            self._read_position += 1
+            first_byte, field1, field2 = self._read_control_block_header()
             opcode = (first_byte >> 5) & 0x7
             control_block = _ControlBlock(opcode=opcode)
             if opcode == _MUX_OPCODE_ADD_CHANNEL_REQUEST:
-                yield self._read_add_channel_request(first_byte, control_block)
+                yield self._read_add_channel_request(
+                    first_byte, control_block, field1, field2)
             elif opcode == _MUX_OPCODE_ADD_CHANNEL_RESPONSE:
                 yield self._read_add_channel_response(
-                    first_byte, control_block)
+                    first_byte, control_block, field1, field2)
             elif opcode == _MUX_OPCODE_FLOW_CONTROL:
-                yield self._read_flow_control(first_byte, control_block)
+                yield self._read_flow_control(
+                    first_byte, control_block, field1, field2)
             elif opcode == _MUX_OPCODE_DROP_CHANNEL:
-                yield self._read_drop_channel(first_byte, control_block)
+                yield self._read_drop_channel(
+                    first_byte, control_block, field1, field2)
             elif opcode == _MUX_OPCODE_NEW_CHANNEL_SLOT:
-                yield self._read_new_channel_slot(first_byte, control_block)
+                yield self._read_new_channel_slot(
+                    first_byte, control_block, field1, field2)
             else:
                 raise PhysicalConnectionError(
                     _DROP_CODE_UNKNOWN_MUX_OPCODE,
@@ -525,6 +623,17 @@ class _LogicalRequest(object):
         return False
 
 
+def _get_inner_frame_quota_cost(opcode, payload):
+    """Returns the amount of quota consumed by an inner frame. An extra one
+    octet is consumed by the first frame of a message.
+    """
+
+    amount = len(payload)
+    if opcode != common.OPCODE_CONTINUATION:
+        amount += 1
+    return amount
+
+
 class _LogicalConnection(object):
     """Mimics mod_python mp_conn."""
 
@@ -543,12 +652,17 @@ class _LogicalConnection(object):
 
         self._mux_handler = mux_handler
         self._channel_id = channel_id
-        self._incoming_data = ''
-
-        # - Protects _waiting_write_completion
-        # - Signals the thread waiting for completion of write by mux handler
+        # Inner frames parsed by the mux handler. The deque is protected by
+        # _read_condition.
+        self._incoming_frames = collections.deque()
+        # Amount of quota consumed by the frames in _incoming_frames.
+        self._buffered_amount = 0
+        # Upper limit of _buffered_amount. None means no limit.
+        self._max_buffered_amount = None
+
+        # Protects _pending_write_bytes.
         self._write_condition = threading.Condition()
-        self._waiting_write_completion = False
+        self._pending_write_bytes = 0
 
         self._read_condition = threading.Condition()
         self._read_state = self.STATE_ACTIVE
@@ -572,28 +686,33 @@ class _LogicalConnection(object):
                                      'get_memorized_lines')
 
     def write(self, data):
-        """Writes data. mux_handler sends data asynchronously. The caller will
-        be suspended until write done.
+        """Writes data. mux_handler sends data asynchronously. The caller
+        isn't suspended until the data is actually written since the amount
+        of data queued for a logical channel is limited by its send quota.
+        _LogicalStream waits for FlowControl when the quota is exhausted.
 
         Args:
             data: data to be written.
 
         Raises:
-            MuxUnexpectedException: when called before finishing the previous
-                write.
+            BadOperationException: when the writer thread has finished.
         """
 
         try:
             self._write_condition.acquire()
-            if self._waiting_write_completion:
-                raise MuxUnexpectedException(
-                    'Logical connection %d is already waiting the completion '
-                    'of write' % self._channel_id)
-
-            self._waiting_write_completion = True
             self._mux_handler.send_data(self._channel_id, data)
-            self._write_condition.wait()
-            # TODO(tyoshino): Raise an exception if woke up by on_writer_done.
+            self._pending_write_bytes += len(data)
+        finally:
+            self._write_condition.release()
+
+    def get_write_buffered_amount(self):
+        """Returns the number of bytes written but not yet sent to the
+        physical connection.
+        """
+
+        self._write_condition.acquire()
+        try:
+            return self._pending_write_bytes
         finally:
             self._write_condition.release()
 
@@ -607,50 +726,80 @@ class _LogicalConnection(object):
 
         self._mux_handler.send_control_data(data)
 
-    def on_write_data_done(self):
-        """Called when sending data is completed."""
+    def on_write_data_done(self, amount):
+        """Called when sending data is completed.
+
+        Args:
+            amount: the number of bytes sent.
+        """
 
         try:
             self._write_condition.acquire()
-            if not self._waiting_write_completion:
-                raise MuxUnexpectedException(
-                    'Invalid call of on_write_data_done for logical '
-                    'connection %d' % self._channel_id)
-            self._waiting_write_completion = False
-            self._write_condition.notify()
+            self._pending_write_bytes -= amount
         finally:
             self._write_condition.release()
 
     def on_writer_done(self):
-        """Called by the mux handler when the writer thread has finished."""
+        """Called by the mux handler when the writer thread has finished.
+        Data which hasn't been sent is discarded.
+        """
 
         try:
             self._write_condition.acquire()
-            self._waiting_write_completion = False
-            self._write_condition.notify()
+            self._pending_write_bytes = 0
         finally:
             self._write_condition.release()
 
+    def set_max_buffered_amount(self, max_buffered_amount):
+        """Sets the upper limit of the amount of quota consumed by frames
+        which haven't been read yet. The receive quota of the channel is
+        used so that a client obeying flow control never hits the limit.
+        """
 
-    def append_frame_data(self, frame_data):
-        """Appends incoming frame data. Called when mux_handler dispatches
-        frame data to the corresponding application.
+        self._read_condition.acquire()
+        self._max_buffered_amount = max_buffered_amount
+        self._read_condition.release()
 
-        Args:
-            frame_data: incoming frame data.
+    def get_buffered_amount(self):
+        """Returns the amount of quota consumed by frames which haven't been
+        read yet.
         """
 
         self._read_condition.acquire()
-        self._incoming_data += frame_data
-        self._read_condition.notify()
-        self._read_condition.release()
+        try:
+            return self._buffered_amount
+        finally:
+            self._read_condition.release()
 
-    def read(self, length):
-        """Reads data. Blocks until enough data has arrived via physical
-        connection.
+    def append_frame(self, frame):
+        """Appends an incoming inner frame. Called when mux_handler
+        dispatches a frame to the corresponding application.
 
         Args:
-            length: length of data to be read.
+            frame: incoming inner frame as a Frame instance.
+
+        Returns:
+            False if the frame wasn't appended since it would make the
+            buffered amount exceed the limit. True otherwise.
+        """
+
+        amount = _get_inner_frame_quota_cost(frame.opcode, frame.payload)
+        self._read_condition.acquire()
+        try:
+            if (self._max_buffered_amount is not None and
+                self._buffered_amount + amount > self._max_buffered_amount):
+                return False
+            self._incoming_frames.append(frame)
+            self._buffered_amount += amount
+            self._read_condition.notify()
+            return True
+        finally:
+            self._read_condition.release()
+
+    def read_frame(self):
+        """Reads an inner frame. Blocks until a frame has arrived via
+        physical connection.
+
         Raises:
             LogicalConnectionClosedException: when closing handshake for this
                 logical channel has been received.
@@ -660,7 +809,7 @@ class _LogicalConnection(object):
 
         self._read_condition.acquire()
         while (self._read_state == self.STATE_ACTIVE and
-               len(self._incoming_data) < length):
+               not self._incoming_frames):
             self._read_condition.wait()
 
         try:
@@ -669,16 +818,16 @@ class _LogicalConnection(object):
                     'Logical channel %d has closed.' % self._channel_id)
             elif self._read_state == self.STATE_TERMINATED:
                 raise ConnectionTerminatedException(
-                    'Receiving %d byte failed. Logical channel (%d) closed' %
-                    (length, self._channel_id))
+                    'Receiving a frame failed. Logical channel (%d) closed' %
+                    self._channel_id)
 
-            value = self._incoming_data[:length]
-            self._incoming_data = self._incoming_data[length:]
+            frame = self._incoming_frames.popleft()
+            self._buffered_amount -= _get_inner_frame_quota_cost(
+                frame.opcode, frame.payload)
+            return frame
         finally:
             self._read_condition.release()
 
-        return value
-
     def set_read_state(self, new_state):
         """Sets the state of this connection. Called when an event for this
         connection has occurred.
@@ -805,12 +954,53 @@ class _InnerMessageBuilder(object):
         return self._frame_handler(frame)
 
 
+class _ReceiveWindowBudget(object):
+    """Limits the sum of receive windows of logical channels on a physical
+    connection, i.e. the amount of data the client may send to the server
+    without waiting for FlowControl.
+    """
+
+    def __init__(self, budget):
+        self._budget = budget
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        """Accounts amount regardless of the budget. Used for initial
+        receive quota which has already been granted.
+        """
+
+        self._lock.acquire()
+        self._used += amount
+        self._lock.release()
+
+    def reserve(self, amount):
+        """Reserves at most amount. Returns the amount reserved."""
+
+        self._lock.acquire()
+        try:
+            reserved = max(0, min(amount, self._budget - self._used))
+            self._used += reserved
+            return reserved
+        finally:
+            self._lock.release()
+
+    def release(self, amount):
+        self._lock.acquire()
+        self._used -= amount
+        self._lock.release()
+
+    def get_used(self):
+        return self._used
+
+
 class _LogicalStream(Stream):
     """Mimics the Stream class. This class interprets multiplexed WebSocket
     frames.
     """
 
-    def __init__(self, request, stream_options, send_quota, receive_quota):
+    def __init__(self, request, stream_options, send_quota, receive_quota,
+                 receive_window_budget=None):
         """Constructs an instance.
 
         Args:
@@ -818,6 +1008,11 @@ class _LogicalStream(Stream):
             stream_options: StreamOptions instance.
             send_quota: Initial send quota.
             receive_quota: Initial receive quota.
+            receive_window_budget: _ReceiveWindowBudget instance. If given,
+                the receive window grows while the handler consumes data
+                as fast as the client sends it, and shrinks back to
+                receive_quota while the handler lags behind. Otherwise,
+                the receive window is fixed to receive_quota.
         """
 
         # Physical stream is responsible for masking.
@@ -836,6 +1031,16 @@ class _LogicalStream(Stream):
         self._last_message_was_fragmented = False
 
         self._receive_quota = receive_quota
+        # Protects _receive_quota. It's consumed by the reader thread of the
+        # mux handler and replenished by the thread running the handler.
+        self._receive_quota_lock = threading.Lock()
+        # The sum of receive quota granted to the client and not replenished
+        # yet. Only the thread running the handler changes it.
+        self._receive_window = receive_quota
+        self._min_receive_window = receive_quota
+        self._receive_window_budget = receive_window_budget
+        if receive_window_budget is not None:
+            receive_window_budget.add(receive_quota)
         self._write_inner_frame_semaphore = threading.Semaphore()
 
         self._inner_message_builder = _InnerMessageBuilder()
@@ -913,7 +1118,7 @@ class _LogicalStream(Stream):
                 finally:
                     self._send_condition.release()
 
-                # Writing data will block the worker so we need to release
+                # Writing data may block the worker so we need to release
                 # _send_condition before writing.
                 self._logger.debug('Sending inner frame: %r' % inner_frame)
                 self._request.connection.write(inner_frame)
@@ -945,13 +1150,17 @@ class _LogicalStream(Stream):
     def consume_receive_quota(self, amount):
         """Consumes receive quota. Returns False on failure."""
 
-        if self._receive_quota < amount:
-            self._logger.debug('Violate quota on channel id %d: %d < %d' %
-                               (self._request.channel_id,
-                                self._receive_quota, amount))
-            return False
-        self._receive_quota -= amount
-        return True
+        self._receive_quota_lock.acquire()
+        try:
+            if self._receive_quota < amount:
+                self._logger.debug('Violate quota on channel id %d: %d < %d' %
+                                   (self._request.channel_id,
+                                    self._receive_quota, amount))
+                return False
+            self._receive_quota -= amount
+            return True
+        finally:
+            self._receive_quota_lock.release()
 
     def send_message(self, message, end=True, binary=False):
         """Override Stream.send_message."""
@@ -984,27 +1193,83 @@ class _LogicalStream(Stream):
         self._write_inner_frame(opcode, message, end)
         self._last_message_was_fragmented = not end
 
-    def _receive_frame(self):
-        """Overrides Stream._receive_frame.
+    def send_messages(self, messages, binary=False):
+        """Override Stream.send_messages."""
 
-        In addition to call Stream._receive_frame, this method adds the amount
-        of payload to receiving quota and sends FlowControl to the client.
-        We need to do it here because Stream.receive_message() handles
-        control frames internally.
+        for message in messages:
+            self.send_message(message, binary=binary)
+
+    def _receive_frame_as_frame_object(self):
+        """Overrides Stream._receive_frame_as_frame_object.
+
+        Takes an inner frame already parsed by the mux handler from the
+        logical connection instead of parsing frame data. In addition, this
+        method adds the amount of payload to receiving quota and sends
+        FlowControl to the client. We need to do it here because
+        Stream.receive_message() handles control frames internally.
         """
 
-        opcode, payload, fin, rsv1, rsv2, rsv3 = Stream._receive_frame(self)
-        amount = len(payload)
-        # Replenish extra one octet when receiving the first fragmented frame.
-        if opcode != common.OPCODE_CONTINUATION:
-            amount += 1
+        frame = self._request.connection.read_frame()
+        amount = _get_inner_frame_quota_cost(frame.opcode, frame.payload)
+        amount += self._adjust_receive_window(amount)
+        if amount == 0:
+            return frame
+        self._receive_quota_lock.acquire()
         self._receive_quota += amount
+        self._receive_quota_lock.release()
         frame_data = _create_flow_control(self._request.channel_id,
                                           amount)
         self._logger.debug('Sending flow control for %d, replenished=%d' %
                            (self._request.channel_id, amount))
         self._request.connection.write_control_data(frame_data)
-        return opcode, payload, fin, rsv1, rsv2, rsv3
+        return frame
+
+    def _adjust_receive_window(self, consumed):
+        """Adjusts the receive window after the handler has consumed
+        consumed octets of quota. Returns the change of the window.
+
+        Like TCP receive buffer auto-tuning, the window is doubled when the
+        handler has caught up with all the data received and the client is
+        about to run out of quota, i.e. the window limits the throughput.
+        When the handler lags behind, the window is shrunk by withholding
+        the quota consumed.
+        """
+
+        if self._receive_window_budget is None:
+            return 0
+
+        connection = self._request.connection
+        buffered = connection.get_buffered_amount()
+        self._receive_quota_lock.acquire()
+        remaining_quota = self._receive_quota
+        self._receive_quota_lock.release()
+
+        window = self._receive_window
+        if buffered == 0 and remaining_quota < window / 4:
+            delta = self._receive_window_budget.reserve(
+                min(window, _MAX_RECEIVE_WINDOW - window))
+        elif buffered > window / 2:
+            delta = -min(consumed, window - self._min_receive_window)
+            self._receive_window_budget.release(-delta)
+        else:
+            return 0
+
+        if delta == 0:
+            return 0
+        self._receive_window += delta
+        self._logger.debug('Receive window for %d: %d' %
+                           (self._request.channel_id, self._receive_window))
+        connection.set_max_buffered_amount(self._receive_window)
+        return delta
+
+    def release_receive_window(self):
+        """Returns the receive window to the budget. Called when the logical
+        channel has closed.
+        """
+
+        if self._receive_window_budget is not None:
+            self._receive_window_budget.release(self._receive_window)
+            self._receive_window_budget = None
 
     def _get_message_from_frame(self, frame):
         """Overrides Stream._get_message_from_frame.
@@ -1050,7 +1315,11 @@ class _LogicalStream(Stream):
                            (self._request.channel_id, body))
         self._write_inner_frame(common.OPCODE_PING, body, end=True)
 
-        self._ping_queue.append(body)
+        self._ping_queue_lock.acquire()
+        try:
+            self._ping_queue.append((body, tracing.get_timestamp()))
+        finally:
+            self._ping_queue_lock.release()
 
     def _send_pong(self, body):
         """Overrides Stream._send_pong"""
@@ -1081,9 +1350,23 @@ class _OutgoingData(object):
     origin of the data.
     """
 
-    def __init__(self, channel_id, data):
+    def __init__(self, channel_id, data, queue_id=None):
+        """Constructs an instance.
+
+        Args:
+            channel_id: channel id to send the data on.
+            data: data to be sent.
+            queue_id: id of the channel whose queue the data is scheduled
+                in. Defaults to channel_id. Control data about a logical
+                channel which must not overtake data of the channel
+                specifies the logical channel.
+        """
+
         self.channel_id = channel_id
         self.data = data
+        if queue_id is None:
+            queue_id = channel_id
+        self.queue_id = queue_id
 
 
 class _PhysicalConnectionWriter(threading.Thread):
@@ -1110,10 +1393,21 @@ class _PhysicalConnectionWriter(threading.Thread):
         self._stop_requested = False
         # The close code of the physical connection.
         self._close_code = common.STATUS_NORMAL_CLOSURE
-        # Deque for passing write data. It's protected by _deque_condition
-        # until _stop_requested is set.
-        self._deque = collections.deque()
-        # - Protects _deque, _stop_requested and _close_code
+        # Deques for passing write data keyed by queue id. They're scheduled
+        # by deficit round robin, except that the deque for the control
+        # channel is always served first. They're protected by
+        # _deque_condition until _stop_requested is set.
+        self._deques = {}
+        # Ids of logical channels which have data to write in the order
+        # they're served.
+        self._active_queue_ids = collections.deque()
+        # Number of bytes each active logical channel may still write in
+        # the current round.
+        self._deficits = {}
+        # True when the channel at the head of _active_queue_ids has already
+        # been given its quantum for the current round.
+        self._in_round = False
+        # - Protects the members above, _stop_requested and _close_code
         # - Signals threads waiting for them to be available
         self._deque_condition = threading.Condition()
 
@@ -1133,49 +1427,113 @@ class _PhysicalConnectionWriter(threading.Thread):
             if self._stop_requested:
                 raise BadOperationException('Cannot write data anymore')
 
-            self._deque.append(data)
+            queue = self._deques.get(data.queue_id)
+            if queue is None:
+                queue = collections.deque()
+                self._deques[data.queue_id] = queue
+                if data.queue_id != _CONTROL_CHANNEL_ID:
+                    self._active_queue_ids.append(data.queue_id)
+                    self._deficits[data.queue_id] = 0
+            queue.append(data)
             self._deque_condition.notify()
         finally:
             self._deque_condition.release()
 
-    def _write_data(self, outgoing_data):
-        message = (_encode_channel_id(outgoing_data.channel_id) +
-                   outgoing_data.data)
+    def _has_outgoing_data(self):
+        return len(self._deques) > 0
+
+    def _pop_batch(self):
+        """Pops queued data up to _MAX_WRITE_BATCH_SIZE bytes. At least one
+        item is popped. _deque_condition must be acquired.
+
+        Data for the control channel is popped first. Then logical channels
+        are served in turn. Each turn, a channel is allowed to write
+        _WRITER_QUANTUM bytes plus what it couldn't use in the previous
+        turns (deficit round robin) so that a channel sending a large
+        message doesn't delay small messages on the other channels.
+        """
+
+        batch = []
+        batch_size = 0
+
+        def _fits(outgoing_data):
+            return (not batch or batch_size + len(outgoing_data.data) <=
+                    _MAX_WRITE_BATCH_SIZE)
+
+        control_queue = self._deques.get(_CONTROL_CHANNEL_ID)
+        if control_queue is not None:
+            while control_queue and _fits(control_queue[0]):
+                outgoing_data = control_queue.popleft()
+                batch.append(outgoing_data)
+                batch_size += len(outgoing_data.data)
+            if control_queue:
+                return batch
+            del self._deques[_CONTROL_CHANNEL_ID]
+
+        while self._active_queue_ids:
+            queue_id = self._active_queue_ids[0]
+            queue = self._deques[queue_id]
+            if not self._in_round:
+                self._deficits[queue_id] += _WRITER_QUANTUM
+                self._in_round = True
+
+            while queue and len(queue[0].data) <= self._deficits[queue_id]:
+                if not _fits(queue[0]):
+                    return batch
+                outgoing_data = queue.popleft()
+                batch.append(outgoing_data)
+                batch_size += len(outgoing_data.data)
+                self._deficits[queue_id] -= len(outgoing_data.data)
+
+            self._in_round = False
+            self._active_queue_ids.popleft()
+            if queue:
+                self._active_queue_ids.append(queue_id)
+            else:
+                del self._deques[queue_id]
+                del self._deficits[queue_id]
+        return batch
+
+    def _write_data(self, batch):
+        # Each item is still sent as a physical message of its own since a
+        # physical message carries exactly one multiplexed frame, but all of
+        # them are written to the socket at once.
+        messages = [_encode_channel_id(outgoing_data.channel_id) +
+                    outgoing_data.data for outgoing_data in batch]
         try:
-            self._mux_handler.physical_stream.send_message(
-                message=message, end=True, binary=True)
+            self._mux_handler.physical_stream.send_messages(
+                messages, binary=True)
         except Exception, e:
             util.prepend_message_to_exception(
                 'Failed to send message to %r: ' %
                 (self._mux_handler.physical_connection.remote_addr,), e)
             raise
 
-        # TODO(bashi): It would be better to block the thread that sends
-        # control data as well.
-        if outgoing_data.channel_id != _CONTROL_CHANNEL_ID:
-            self._mux_handler.notify_write_data_done(outgoing_data.channel_id)
+        for outgoing_data in batch:
+            if outgoing_data.channel_id != _CONTROL_CHANNEL_ID:
+                self._mux_handler.notify_write_data_done(
+                    outgoing_data.channel_id, len(outgoing_data.data))
 
     def run(self):
         try:
             self._deque_condition.acquire()
             while not self._stop_requested:
-                if len(self._deque) == 0:
+                if not self._has_outgoing_data():
                     self._deque_condition.wait()
                     continue
 
-                outgoing_data = self._deque.popleft()
+                batch = self._pop_batch()
 
                 self._deque_condition.release()
-                self._write_data(outgoing_data)
+                self._write_data(batch)
                 self._deque_condition.acquire()
 
             # Flush deque.
             #
             # At this point, self._deque_condition is always acquired.
             try:
-                while len(self._deque) > 0:
-                    outgoing_data = self._deque.popleft()
-                    self._write_data(outgoing_data)
+                while self._has_outgoing_data():
+                    self._write_data(self._pop_batch())
             finally:
                 self._deque_condition.release()
 
@@ -1255,7 +1613,8 @@ class _PhysicalConnectionReader(threading.Thread):
 
 class _Worker(threading.Thread):
     """A thread that is responsible for running the corresponding application
-    handler.
+    handler. When _MuxHandler has a worker pool, run() is called on a thread
+    of the pool instead of starting this thread.
     """
 
     def __init__(self, mux_handler, request):
@@ -1290,18 +1649,24 @@ class _MuxHandshaker(hybi.Handshaker):
 
     _DUMMY_WEBSOCKET_KEY = 'dGhlIHNhbXBsZSBub25jZQ=='
 
-    def __init__(self, request, dispatcher, send_quota, receive_quota):
+    def __init__(self, request, dispatcher, send_quota, receive_quota,
+                 receive_window_budget=None, handshake_base=None):
         """Constructs an instance.
         Args:
             request: _LogicalRequest instance.
             dispatcher: Dispatcher instance (dispatch.Dispatcher).
             send_quota: Initial send quota.
             receive_quota: Initial receive quota.
+            receive_window_budget: _ReceiveWindowBudget instance or None.
+            handshake_base: _HandshakeDeltaBase instance or None. Used to
+                reuse the result of parsing extensions.
         """
 
         hybi.Handshaker.__init__(self, request, dispatcher)
         self._send_quota = send_quota
         self._receive_quota = receive_quota
+        self._receive_window_budget = receive_window_budget
+        self._handshake_base = handshake_base
 
         # Append headers which should not be included in handshake field of
         # AddChannelRequest.
@@ -1314,14 +1679,28 @@ class _MuxHandshaker(hybi.Handshaker):
         request.headers_in[common.SEC_WEBSOCKET_KEY_HEADER] = (
             self._DUMMY_WEBSOCKET_KEY)
 
+    def _parse_extensions(self):
+        """Override hybi.Handshaker._parse_extensions."""
+
+        if self._handshake_base is not None:
+            extensions = self._handshake_base.get_requested_extensions(
+                self._request.headers_in.get(
+                    common.SEC_WEBSOCKET_EXTENSIONS_HEADER))
+            if extensions is not None:
+                self._request.ws_requested_extensions = extensions
+                return
+        hybi.Handshaker._parse_extensions(self)
+
     def _create_stream(self, stream_options):
         """Override hybi.Handshaker._create_stream."""
 
         self._logger.debug('Creating logical stream for %d' %
                            self._request.channel_id)
+        self._request.connection.set_max_buffered_amount(
+            self._receive_quota)
         return _LogicalStream(
             self._request, stream_options, self._send_quota,
-            self._receive_quota)
+            self._receive_quota, self._receive_window_budget)
 
     def _create_handshake_response(self, accept):
         """Override hybi._create_handshake_response."""
@@ -1373,21 +1752,117 @@ class _LogicalChannelData(object):
         self.drop_message = ''
 
 
+class _HeaderTable(object):
+    """Case-insensitive table of HTTP headers which mimics mp_table.
+
+    Tables derived from a table by derive() share the headers of the
+    original table and hold only their own changes, so deriving a table
+    doesn't copy the headers. The original table must not be modified
+    afterwards.
+    """
+
+    def __init__(self, items=()):
+        """Constructs an instance.
+
+        Args:
+            items: iterable of (name, value) pairs.
+        """
+
+        # Maps lower-cased names to (name, value) pairs.
+        self._base = {}
+        for name, value in items:
+            self._base[name.lower()] = (name, value)
+        # Changes to _base. None values mark removed headers.
+        self._changes = {}
+
+    def derive(self):
+        """Returns a new table which initially has the same headers."""
+
+        table = _HeaderTable()
+        if self._changes:
+            table._base = dict(self._base)
+            for key, item in self._changes.iteritems():
+                if item is None:
+                    table._base.pop(key, None)
+                else:
+                    table._base[key] = item
+        else:
+            table._base = self._base
+        return table
+
+    def _get_item(self, name):
+        key = name.lower()
+        if key in self._changes:
+            return self._changes[key]
+        return self._base.get(key)
+
+    def get(self, name, default=None):
+        item = self._get_item(name)
+        if item is None:
+            return default
+        return item[1]
+
+    def __getitem__(self, name):
+        item = self._get_item(name)
+        if item is None:
+            raise KeyError(name)
+        return item[1]
+
+    def __setitem__(self, name, value):
+        self._changes[name.lower()] = (name, value)
+
+    def __delitem__(self, name):
+        if self._get_item(name) is None:
+            raise KeyError(name)
+        self._changes[name.lower()] = None
+
+    def has_key(self, name):
+        return self._get_item(name) is not None
+
+    __contains__ = has_key
+
+    def items(self):
+        items = [item for key, item in self._base.iteritems()
+                 if key not in self._changes]
+        items.extend([item for item in self._changes.itervalues()
+                      if item is not None])
+        return items
+
+    def keys(self):
+        return [name for name, unused_value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+
 class _HandshakeDeltaBase(object):
     """A class that holds information for delta-encoded handshake."""
 
     def __init__(self, headers):
-        self._headers = headers
+        """Constructs an instance.
+
+        Args:
+            headers: headers of the delta base. It's copied.
+        """
+
+        self._headers = _HeaderTable(headers.items())
+        self._extensions_header = self._headers.get(
+            common.SEC_WEBSOCKET_EXTENSIONS_HEADER)
+        # Result of parsing _extensions_header. Parsed on demand.
+        self._requested_extensions = None
 
     def create_headers(self, delta=None):
         """Creates request headers for an AddChannelRequest that has
-        delta-encoded handshake.
+        delta-encoded handshake. The headers of the delta base aren't copied.
 
         Args:
             delta: headers should be overridden.
         """
 
-        headers = copy.copy(self._headers)
+        headers = self._headers.derive()
         if delta:
             for key, value in delta.items():
                 # The spec requires that a header with an empty value is
@@ -1398,6 +1873,26 @@ class _HandshakeDeltaBase(object):
                     headers[key] = value
         return headers
 
+    def get_requested_extensions(self, extensions_header):
+        """Returns a list of common.ExtensionParameter instances parsed from
+        extensions_header if it's the same as the Sec-WebSocket-Extensions
+        header of the delta base. Otherwise, returns None. The header of the
+        delta base is parsed only once.
+        """
+
+        if (extensions_header is None or
+            extensions_header != self._extensions_header):
+            return None
+        if self._requested_extensions is None:
+            try:
+                self._requested_extensions = common.parse_extensions(
+                    extensions_header)
+            except common.ExtensionParsingException, e:
+                return None
+        # Extension processors don't modify the parameters, but the list is
+        # modifiable by handlers.
+        return list(self._requested_extensions)
+
 
 class _MuxHandler(object):
     """Multiplexing handler. When a handler starts, it launches three
@@ -1414,19 +1909,38 @@ class _MuxHandler(object):
     The worker thread launched at the starting point handles the
     "Implicitly Opened Connection". If multiplexing handler receives
     an AddChannelRequest and accepts it, the handler will launch a new worker
-    thread and dispatch the request to it.
+    thread and dispatch the request to it. When a worker pool is given, the
+    requests are dispatched on a thread of the pool instead so that the
+    number of threads is bounded by the size of the pool. Handlers block
+    until their channel closes, so an AddChannelRequest received while all
+    the threads of the pool are busy is rejected with status 503 rather than
+    waiting for another channel to close.
     """
 
-    def __init__(self, request, dispatcher):
+    def __init__(self, request, dispatcher, worker_pool=None,
+                 receive_window_budget=None):
         """Constructs an instance.
 
         Args:
             request: mod_python request of the physical connection.
             dispatcher: Dispatcher instance (dispatch.Dispatcher).
+            worker_pool: if given, handlers of logical channels run on a
+                thread of it instead of a thread of their own. It must have
+                try_reserve, submit_reserved and cancel_reservation methods
+                like msgutil.MessageWorkerPool.
+            receive_window_budget: if given, receive windows of logical
+                channels are adjusted to how fast their handlers consume
+                data, and the sum of them is limited to this number of
+                octets. Otherwise, they're fixed to the initial quota.
         """
 
         self.original_request = request
         self.dispatcher = dispatcher
+        self._worker_pool = worker_pool
+        self._receive_window_budget = None
+        if receive_window_budget is not None:
+            self._receive_window_budget = _ReceiveWindowBudget(
+                receive_window_budget)
         self.physical_connection = request.connection
         self.physical_stream = request.ws_stream
         self._logger = util.get_class_logger(self)
@@ -1457,7 +1971,7 @@ class _MuxHandler(object):
 
         # Create "Implicitly Opened Connection".
         logical_connection = _LogicalConnection(self, _DEFAULT_CHANNEL_ID)
-        headers = copy.copy(self.original_request.headers_in)
+        headers = _HeaderTable(self.original_request.headers_in.items())
         # Add extensions for logical channel.
         headers[common.SEC_WEBSOCKET_EXTENSIONS_HEADER] = (
             common.format_extensions(
@@ -1479,7 +1993,14 @@ class _MuxHandler(object):
             logical_request, send_quota=send_quota):
             raise MuxUnexpectedException(
                 'Failed handshake on the default channel id')
-        self._add_logical_channel(logical_request)
+        if not self._try_reserve_worker():
+            raise MuxUnexpectedException(
+                'No idle worker for the default channel id')
+        try:
+            self._add_logical_channel(logical_request)
+        except:
+            self._cancel_worker_reservation()
+            raise
 
         # Send FlowControl for the implicitly opened connection.
         frame_data = _create_flow_control(_DEFAULT_CHANNEL_ID,
@@ -1526,18 +2047,19 @@ class _MuxHandler(object):
 
         return True
 
-    def notify_write_data_done(self, channel_id):
+    def notify_write_data_done(self, channel_id, amount):
         """Called by the writer thread when a write operation has done.
 
         Args:
             channel_id: objective channel id.
+            amount: the number of bytes written.
         """
 
         try:
             self._logical_channels_condition.acquire()
             if channel_id in self._logical_channels:
                 channel_data = self._logical_channels[channel_id]
-                channel_data.request.connection.on_write_data_done()
+                channel_data.request.connection.on_write_data_done(amount)
             else:
                 self._logger.debug('Seems that logical channel for %d has gone'
                                    % channel_id)
@@ -1570,7 +2092,11 @@ class _MuxHandler(object):
         frame_data = _create_drop_channel(channel_id, code, message)
         self._logger.debug(
             'Sending drop channel for channel id %d' % channel_id)
-        self.send_control_data(frame_data)
+        # Queue DropChannel behind the data of the logical channel so that
+        # it's not sent before the data.
+        self._writer.put_outgoing_data(_OutgoingData(
+                channel_id=_CONTROL_CHANNEL_ID, data=frame_data,
+                queue_id=channel_id))
 
     def _send_error_add_channel_response(self, channel_id, status=None):
         if status is None:
@@ -1601,7 +2127,7 @@ class _MuxHandler(object):
                 _DROP_CODE_UNKNOWN_REQUEST_ENCODING)
 
         method, path, version, headers = _parse_request_text(
-            block.encoded_handshake)
+            block.encoded_handshake.tobytes())
         if block.encoding == _HANDSHAKE_ENCODING_DELTA:
             headers = self._handshake_base.create_headers(headers)
 
@@ -1618,7 +2144,9 @@ class _MuxHandler(object):
                 request.channel_id, _DROP_CODE_NEW_CHANNEL_SLOT_VIOLATION)
 
         handshaker = _MuxHandshaker(request, self.dispatcher,
-                                    send_quota, receive_quota)
+                                    send_quota, receive_quota,
+                                    self._receive_window_budget,
+                                    self._handshake_base)
         try:
             handshaker.do_handshake()
         except handshake.VersionException, e:
@@ -1653,38 +2181,73 @@ class _MuxHandler(object):
             worker = _Worker(self, logical_request)
             channel_data = _LogicalChannelData(logical_request, worker)
             self._logical_channels[logical_request.channel_id] = channel_data
-            worker.start()
+            if self._worker_pool is None:
+                worker.start()
+            else:
+                # The caller has reserved a worker by _try_reserve_worker().
+                self._worker_pool.submit_reserved(worker.run)
         finally:
             self._logical_channels_condition.release()
 
+    def _try_reserve_worker(self):
+        """Reserves a worker of the pool for a logical channel to be added.
+        Returns False if all the workers of the pool are busy.
+        """
+
+        return self._worker_pool is None or self._worker_pool.try_reserve()
+
+    def _cancel_worker_reservation(self):
+        if self._worker_pool is not None:
+            self._worker_pool.cancel_reservation()
+
     def _process_add_channel_request(self, block):
-        try:
-            logical_request = self._create_logical_request(block)
-        except ValueError, e:
-            self._logger.debug('Failed to create logical request: %r' % e)
+        # Handlers block until their channel closes, so the channel would
+        # wait for another channel to close if it were queued for a busy
+        # pool. Reject it instead.
+        if not self._try_reserve_worker():
+            self._logger.debug('No idle worker for channel id %d' %
+                               block.channel_id)
             self._send_error_add_channel_response(
-                block.channel_id, status=common.HTTP_STATUS_BAD_REQUEST)
+                block.channel_id,
+                status=common.HTTP_STATUS_SERVICE_UNAVAILABLE)
             return
-        if self._do_handshake_for_logical_request(logical_request):
-            if block.encoding == _HANDSHAKE_ENCODING_IDENTITY:
-                # Update handshake base.
-                # TODO(bashi): Make sure this is the right place to update
-                # handshake base.
-                self._handshake_base = _HandshakeDeltaBase(
-                    logical_request.headers_in)
-            self._add_logical_channel(logical_request)
-        else:
-            self._send_error_add_channel_response(
-                block.channel_id, status=common.HTTP_STATUS_BAD_REQUEST)
 
-    def _process_flow_control(self, block):
+        added = False
         try:
-            self._logical_channels_condition.acquire()
-            if not block.channel_id in self._logical_channels:
+            try:
+                logical_request = self._create_logical_request(block)
+            except ValueError, e:
+                self._logger.debug('Failed to create logical request: %r' % e)
+                self._send_error_add_channel_response(
+                    block.channel_id, status=common.HTTP_STATUS_BAD_REQUEST)
                 return
-            channel_data = self._logical_channels[block.channel_id]
-            channel_data.request.ws_stream.replenish_send_quota(
-                block.send_quota)
+            if self._do_handshake_for_logical_request(logical_request):
+                if block.encoding == _HANDSHAKE_ENCODING_IDENTITY:
+                    # Update handshake base.
+                    # TODO(bashi): Make sure this is the right place to update
+                    # handshake base.
+                    self._handshake_base = _HandshakeDeltaBase(
+                        logical_request.headers_in)
+                self._add_logical_channel(logical_request)
+                added = True
+            else:
+                self._send_error_add_channel_response(
+                    block.channel_id, status=common.HTTP_STATUS_BAD_REQUEST)
+        finally:
+            if not added:
+                self._cancel_worker_reservation()
+
+    def _process_flow_controls(self, blocks):
+        """Processes consecutive FlowControl blocks at once."""
+
+        try:
+            self._logical_channels_condition.acquire()
+            for block in blocks:
+                channel_data = self._logical_channels.get(block.channel_id)
+                if channel_data is None:
+                    continue
+                channel_data.request.ws_stream.replenish_send_quota(
+                    block.send_quota)
         finally:
             self._logical_channels_condition.release()
 
@@ -1707,17 +2270,25 @@ class _MuxHandler(object):
             self._logical_channels_condition.release()
 
     def _process_control_blocks(self, parser):
+        # FlowControl blocks are queued here until a block of another type
+        # comes so that they're processed at once.
+        flow_controls = []
         for control_block in parser.read_control_blocks():
             opcode = control_block.opcode
             self._logger.debug('control block received, opcode: %d' % opcode)
+            if opcode == _MUX_OPCODE_FLOW_CONTROL:
+                flow_controls.append(control_block)
+                continue
+            if flow_controls:
+                self._process_flow_controls(flow_controls)
+                flow_controls = []
+
             if opcode == _MUX_OPCODE_ADD_CHANNEL_REQUEST:
                 self._process_add_channel_request(control_block)
             elif opcode == _MUX_OPCODE_ADD_CHANNEL_RESPONSE:
                 raise PhysicalConnectionError(
                     _DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
                     'Received AddChannelResponse')
-            elif opcode == _MUX_OPCODE_FLOW_CONTROL:
-                self._process_flow_control(control_block)
             elif opcode == _MUX_OPCODE_DROP_CHANNEL:
                 self._process_drop_channel(control_block)
             elif opcode == _MUX_OPCODE_NEW_CHANNEL_SLOT:
@@ -1727,6 +2298,8 @@ class _MuxHandler(object):
             else:
                 raise MuxUnexpectedException(
                     'Unexpected opcode %r' % opcode)
+        if flow_controls:
+            self._process_flow_controls(flow_controls)
 
     def _process_logical_frame(self, channel_id, parser):
         self._logger.debug('Received a frame. channel id=%d' % channel_id)
@@ -1737,18 +2310,18 @@ class _MuxHandler(object):
                 return
             channel_data = self._logical_channels[channel_id]
             fin, rsv1, rsv2, rsv3, opcode, payload = parser.read_inner_frame()
-            consuming_byte = len(payload)
-            if opcode != common.OPCODE_CONTINUATION:
-                consuming_byte += 1
+            consuming_byte = _get_inner_frame_quota_cost(opcode, payload)
             if not channel_data.request.ws_stream.consume_receive_quota(
                 consuming_byte):
                 # The client violates quota. Close logical channel.
                 raise LogicalChannelError(
                     channel_id, _DROP_CODE_SEND_QUOTA_VIOLATION)
-            header = create_header(opcode, len(payload), fin, rsv1, rsv2, rsv3,
-                                   mask=False)
-            frame_data = header + payload
-            channel_data.request.connection.append_frame_data(frame_data)
+            if not channel_data.request.connection.append_frame(
+                Frame(fin=fin, rsv1=rsv1, rsv2=rsv2, rsv3=rsv3,
+                      opcode=opcode, payload=payload)):
+                # Unread frames exceed the receive quota of the channel.
+                raise LogicalChannelError(
+                    channel_id, _DROP_CODE_SEND_QUOTA_VIOLATION)
         finally:
             self._logical_channels_condition.release()
 
@@ -1793,6 +2366,8 @@ class _MuxHandler(object):
             self._logical_channels_condition.notify()
             self._logical_channels_condition.release()
 
+        channel_data.request.ws_stream.release_receive_window()
+
         if not channel_data.request.server_terminated:
             self._send_drop_channel(
                 channel_id, code=channel_data.drop_code,
@@ -1877,7 +2452,9 @@ def use_mux(request):
 
 
 def start(request, dispatcher):
-    mux_handler = _MuxHandler(request, dispatcher)
+    mux_handler = _MuxHandler(request, dispatcher,
+                              dispatcher.get_mux_worker_pool(),
+                              dispatcher.get_mux_receive_window_budget())
     mux_handler.start()
 
     mux_handler.add_channel_slots(_INITIAL_NUMBER_OF_CHANNEL_SLOTS,
@@ -146,6 +146,42 @@ THREADING
 This server is derived from SocketServer.ThreadingMixIn. Hence a thread is
 used for each request.
 
+Logical channels multiplexed over a WebSocket connection also use a thread
+each by default. Specify --mux-worker-pool-size to run logical channels on a
+pool of up to the given number of threads instead, which bounds the number
+of threads they use. Handlers of logical channels occupy a thread until
+their channel closes, so an AddChannelRequest received while all the threads
+of the pool are busy is rejected with status 503.
+
+Each thread reserves a stack of the default size of the platform (often
+8MiB of virtual memory). Specify --thread-stack-size to reserve a smaller
+stack when serving many connections.
+
+
+STATUS PAGE
+===========
+
+Run with --metrics --status-path=/_status to serve counters and histograms
+of WebSocket connections, the number of threads and the depth of the queue
+of the mux worker pool at /_status in the text exposition format of
+Prometheus. Collectors compute rates such as bytes per second from the
+counters.
+
+With --memory-sample-size, the memory of a random sample of WebSocket
+connections is estimated per component and the mean is served as
+connection_memory_bytes. Connections are sampled after the memorized lines
+of the opening handshake are released, so the handshake_lines component is
+only the size of an empty list. See memory.py.
+
+
+KEEPALIVE
+=========
+
+Run with --keepalive-ping-interval, --keepalive-pong-timeout and
+--idle-timeout to send pings on quiet connections, abort connections whose
+peer doesn't respond, and close connections exchanging no message. A single
+thread watches all the connections. See keepalive.py.
+
 
 SECURITY WARNING
 ================
@@ -175,9 +211,14 @@ import time
 
 from mod_pywebsocket import common
 from mod_pywebsocket import dispatch
+from mod_pywebsocket import eventloop
 from mod_pywebsocket import handshake
 from mod_pywebsocket import http_header_util
+from mod_pywebsocket import keepalive
 from mod_pywebsocket import memorizingfile
+from mod_pywebsocket import memory
+from mod_pywebsocket import metrics
+from mod_pywebsocket import msgutil
 from mod_pywebsocket import util
 from mod_pywebsocket.xhr_benchmark_handler import XHRBenchmarkHandler
 
@@ -190,6 +231,10 @@ _DEFAULT_REQUEST_QUEUE_SIZE = 128
 # 1024 is practically large enough to contain WebSocket handshake lines.
 _MAX_MEMORIZED_LINES = 1024
 
+# Quantiles of the opening handshake time and the round-trip time of pings
+# reported on the status page.
+_STATUS_QUANTILES = (0.5, 0.9, 0.99)
+
 # Constants for the --tls_module flag.
 _TLS_BY_STANDARD_MODULE = 'ssl'
 _TLS_BY_PYOPENSSL = 'pyopenssl'
@@ -233,11 +278,96 @@ class _StandaloneConnection(object):
 
         return self._request_handler.rfile.read(length)
 
+    def read_nonblocking(self, length):
+        """Read up to length bytes which can be read without blocking.
+
+        Returns:
+            the bytes read, '' on EOF, or None if no byte is available.
+        """
+
+        read_ahead_data = self._get_read_ahead_data()
+        if read_ahead_data:
+            return self._request_handler.rfile.read(
+                min(length, len(read_ahead_data)))
+        socket_ = self._request_handler.request
+        readable, unused_writable, unused_error = select.select(
+            [socket_], [], [], 0)
+        if not readable:
+            return None
+        return socket_.recv(length)
+
+    def write_nonblocking(self, data):
+        """Write as much of data as can be written without blocking.
+
+        Returns:
+            the number of bytes written.
+        """
+
+        socket_ = self._request_handler.request
+        unused_readable, writable, unused_error = select.select(
+            [], [socket_], [], 0)
+        if not writable:
+            return 0
+        # Writes of the request handler aren't buffered by wfile, so data
+        # doesn't get interleaved with them.
+        return socket_.send(data)
+
     def get_memorized_lines(self):
         """Get memorized lines."""
 
         return self._request_handler.rfile.get_memorized_lines()
 
+    def fileno(self):
+        """Return the file descriptor of the socket."""
+
+        return self._request_handler.request.fileno()
+
+    def shutdown(self):
+        """Shut down the socket so that reads and writes blocked on it fail.
+        Thread-safe.
+        """
+
+        socket_ = self._request_handler.request
+        # shutdown of OpenSSL.SSL.Connection sends a TLS close_notify alert
+        # instead.
+        sock_shutdown = getattr(socket_, 'sock_shutdown', None)
+        if sock_shutdown is not None:
+            sock_shutdown(socket.SHUT_RDWR)
+        else:
+            socket_.shutdown(socket.SHUT_RDWR)
+
+    def has_buffered_data(self):
+        """Return True if there're bytes already read from the socket but
+        not consumed yet.
+        """
+
+        if self._get_read_ahead_data():
+            return True
+        # TLS layer may also hold decrypted data.
+        pending = getattr(self._request_handler.request, 'pending', None)
+        return pending is not None and pending() > 0
+
+    def _get_read_ahead_data(self):
+        # rfile wraps socket._fileobject which may have read ahead the bytes
+        # following the opening handshake.
+        buffered_data = self._request_handler.rfile._rbuf
+        if not isinstance(buffered_data, str):
+            buffered_data = buffered_data.getvalue()
+        return buffered_data
+
+    def detach(self):
+        """Detach the socket from the request handler so that the server
+        doesn't close it when the request handler finishes.
+
+        Returns:
+            a tuple of the socket and the bytes already read from it into the
+            buffer of rfile but not consumed yet.
+        """
+
+        request_handler = self._request_handler
+        request_handler.server.detach_request(request_handler.request)
+        return request_handler.request, self._get_read_ahead_data()
+
 
 class _StandaloneRequest(object):
     """Mimic mod_python request."""
@@ -373,8 +503,12 @@ def _alias_handlers(dispatcher, websock_handlers_map_file):
                 logging.warning('Wrong format in map file:' + line)
                 continue
             try:
-                dispatcher.add_resource_path_alias(
-                    m.group(1), m.group(2))
+                if dispatch.is_resource_path_pattern(m.group(1)):
+                    dispatcher.add_resource_path_pattern(
+                        m.group(1), m.group(2))
+                else:
+                    dispatcher.add_resource_path_alias(
+                        m.group(1), m.group(2))
             except dispatch.DispatchException, e:
                 logging.error(str(e))
     finally:
@@ -400,10 +534,31 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         options.dispatcher = dispatch.Dispatcher(
             options.websock_handlers,
             options.scan_dir,
-            options.allow_handlers_outside_root_dir)
+            options.allow_handlers_outside_root_dir,
+            options.lazy_handler_loading,
+            options.handler_bytecode_cache_dir)
         if options.websock_handlers_map_file:
             _alias_handlers(options.dispatcher,
                             options.websock_handlers_map_file)
+        if options.mux_worker_pool_size > 0:
+            options.dispatcher.set_mux_worker_pool(
+                msgutil.MessageWorkerPool(options.mux_worker_pool_size))
+        if options.mux_receive_window_budget > 0:
+            options.dispatcher.set_mux_receive_window_budget(
+                options.mux_receive_window_budget)
+        if options.metrics:
+            options.dispatcher.set_metrics_registry(
+                metrics.MetricsRegistry())
+        if (options.keepalive_ping_interval or
+            options.keepalive_pong_timeout or options.idle_timeout):
+            options.dispatcher.set_keepalive_scheduler(
+                keepalive.KeepaliveScheduler(
+                    options.keepalive_ping_interval or None,
+                    options.keepalive_pong_timeout or None,
+                    options.idle_timeout or None))
+        if options.memory_sample_size > 0:
+            options.dispatcher.set_memory_sampler(
+                memory.MemorySampler(options.memory_sample_size))
         warnings = options.dispatcher.source_warnings()
         if warnings:
             for warning in warnings:
@@ -411,6 +566,11 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
 
         self._logger = util.get_class_logger(self)
 
+        # Runs coroutine handlers. The thread is started on demand.
+        self.event_loop = eventloop.EventLoop()
+        self._detached_requests = set()
+        self._detached_requests_lock = threading.Lock()
+
         self.request_queue_size = options.request_queue_size
         self.__ws_is_shut_down = threading.Event()
         self.__ws_serving = False
@@ -540,6 +700,51 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             self._logger.info('Close on: %r', addrinfo)
             socket_.close()
 
+        self.event_loop.stop()
+        dispatcher = self.websocket_server_options.dispatcher
+        keepalive_scheduler = dispatcher.get_keepalive_scheduler()
+        if keepalive_scheduler is not None:
+            keepalive_scheduler.stop()
+
+    def detach_request(self, request):
+        """Prevent the server from closing request (the accepted socket)
+        when its request handler finishes.
+        """
+
+        self._detached_requests_lock.acquire()
+        try:
+            self._detached_requests.add(request)
+        finally:
+            self._detached_requests_lock.release()
+
+    def _forget_detached_request(self, request):
+        self._detached_requests_lock.acquire()
+        try:
+            if request in self._detached_requests:
+                self._detached_requests.remove(request)
+                return True
+            return False
+        finally:
+            self._detached_requests_lock.release()
+
+    def shutdown_request(self, request):
+        """Override SocketServer.TCPServer.shutdown_request to keep detached
+        requests open.
+        """
+
+        if self._forget_detached_request(request):
+            return
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_request(self, request):
+        """Override SocketServer.TCPServer.close_request to keep detached
+        requests open.
+        """
+
+        if self._forget_detached_request(request):
+            return
+        BaseHTTPServer.HTTPServer.close_request(self, request)
+
     def fileno(self):
         """Override SocketServer.TCPServer.fileno."""
 
@@ -726,6 +931,11 @@ class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
 
         host, port, resource = http_header_util.parse_uri(self.path)
 
+        if (self._options.status_path is not None and
+            resource == self._options.status_path):
+            self._send_status()
+            return False
+
         # Special paths for XMLHttpRequest benchmark
         xhr_benchmark_helper_prefix = '/073be001e10950692ccbf3a2ad21c245'
         if resource == (xhr_benchmark_helper_prefix + '_send'):
@@ -801,12 +1011,76 @@ class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
                 self.send_error(e.status)
                 return False
 
+            # The lines of the opening handshake are no longer needed.
+            self.rfile.release_memorized_lines()
+
             request._dispatcher = self._options.dispatcher
+            if not self._options.use_tls:
+                # Let coroutine handlers run on the event loop.
+                request._event_loop = self.server.event_loop
             self._options.dispatcher.transfer_data(request)
         except handshake.AbortedByUserException, e:
             self._logger.info('Aborted: %s', e)
         return False
 
+    def _send_status(self):
+        """Sends metrics of the server in the text exposition format of
+        Prometheus. Values are read without taking locks used for
+        transferring data.
+        """
+
+        dispatcher = self._options.dispatcher
+        registry = dispatcher.get_metrics_registry()
+        if registry is None:
+            snapshot = metrics.MetricsSnapshot({}, {}, {})
+        else:
+            snapshot = registry.snapshot()
+
+        gauges = snapshot.gauges
+        gauges[metrics.make_key('threads')] = threading.active_count()
+        gauges[metrics.make_key('event_loop_connections')] = (
+            self.server.event_loop.get_connection_count())
+        worker_pool = dispatcher.get_mux_worker_pool()
+        if worker_pool is not None:
+            gauges[metrics.make_key('mux_worker_pool_workers')] = (
+                worker_pool.get_worker_count())
+            gauges[metrics.make_key('mux_worker_pool_queued_tasks')] = (
+                worker_pool.get_queued_task_count())
+        for direction in (metrics.DIRECTION_IN, metrics.DIRECTION_OUT):
+            original_bytes = snapshot.get_counter(
+                'compression_original_bytes', direction=direction)
+            if original_bytes:
+                compressed_bytes = snapshot.get_counter(
+                    'compression_compressed_bytes', direction=direction)
+                gauges[metrics.make_key(
+                    'compression_ratio', direction=direction)] = (
+                        float(compressed_bytes) / original_bytes)
+        for name in ('handshake_seconds', 'round_trip_seconds'):
+            histogram = snapshot.histograms.get(metrics.make_key(name))
+            if histogram is None:
+                continue
+            for quantile in _STATUS_QUANTILES:
+                gauges[metrics.make_key(
+                    name + '_quantile', quantile=str(quantile))] = (
+                        histogram.get_quantile(quantile))
+        memory_sampler = dispatcher.get_memory_sampler()
+        if memory_sampler is not None:
+            for component, (mean, unused_max) in (
+                memory_sampler.summarize().iteritems()):
+                gauges[metrics.make_key(
+                    'connection_memory_bytes', component=component)] = mean
+        thread_stack_size = memory.get_thread_stack_size()
+        if thread_stack_size is not None:
+            gauges[metrics.make_key('thread_stack_size_bytes')] = (
+                thread_stack_size)
+
+        body = metrics.format_text(snapshot)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def log_request(self, code='-', size='-'):
         """Override BaseHTTPServer.log_request."""
 
@@ -908,7 +1182,9 @@ def _build_option_parser():
                       default=None,
                       help=('WebSocket handlers map file. '
                             'Each line consists of alias_resource_path and '
-                            'existing_resource_path, separated by spaces.'))
+                            'existing_resource_path, separated by spaces. '
+                            'alias_resource_path can be a pattern such as '
+                            '/room/{room_id} or /static/*.'))
     parser.add_option('-s', '--scan-dir', '--scan_dir', dest='scan_dir',
                       default=None,
                       help=('Must be a directory under --websock-handlers. '
@@ -925,6 +1201,22 @@ def _build_option_parser():
                       default=False,
                       help=('Scans WebSocket handlers even if their canonical '
                             'path is not under --websock-handlers.'))
+    parser.add_option('--lazy-handler-loading', '--lazy_handler_loading',
+                      dest='lazy_handler_loading',
+                      action='store_true',
+                      default=False,
+                      help=('Only index WebSocket handler files on startup '
+                            'and source each of them on the first request '
+                            'for its resource. Speeds up startup when there '
+                            'are many handlers.'))
+    parser.add_option('--handler-bytecode-cache-dir',
+                      '--handler_bytecode_cache_dir',
+                      dest='handler_bytecode_cache_dir',
+                      default=None,
+                      help=('Directory to cache compiled WebSocket handler '
+                            'files in. Cached code is reused while the '
+                            'modification time and the size of the handler '
+                            'file are unchanged.'))
     parser.add_option('-d', '--document-root', '--document_root',
                       dest='document_root', default='.',
                       help='Document root directory.')
@@ -1005,6 +1297,68 @@ def _build_option_parser():
     parser.add_option('-q', '--queue', dest='request_queue_size', type='int',
                       default=_DEFAULT_REQUEST_QUEUE_SIZE,
                       help='request queue size')
+    parser.add_option('--mux-worker-pool-size', '--mux_worker_pool_size',
+                      dest='mux_worker_pool_size', type='int', default=0,
+                      help=('If positive integer is specified, run handlers '
+                            'of multiplexed logical channels on a pool of '
+                            'the specified number of threads instead of '
+                            'starting a thread per logical channel. Logical '
+                            'channels are rejected while all the threads '
+                            'are busy.'))
+    parser.add_option('--mux-receive-window-budget',
+                      '--mux_receive_window_budget',
+                      dest='mux_receive_window_budget', type='int',
+                      default=0,
+                      help=('If positive integer is specified, adjust the '
+                            'flow control window of each multiplexed '
+                            'logical channel to how fast its handler '
+                            'consumes data, keeping the sum of the windows '
+                            'on a connection within the specified number of '
+                            'bytes. Otherwise, the windows are fixed.'))
+    parser.add_option('--metrics', dest='metrics', action='store_true',
+                      default=False,
+                      help=('Record counters and histograms of WebSocket '
+                            'connections. See metrics.py.'))
+    parser.add_option('--status-path', '--status_path', dest='status_path',
+                      default=None,
+                      help=('Serve metrics of the server at the specified '
+                            'path (e.g. /_status) in the text exposition '
+                            'format of Prometheus. Metrics of connections '
+                            'are included only with --metrics.'))
+    parser.add_option('--keepalive-ping-interval',
+                      '--keepalive_ping_interval',
+                      dest='keepalive_ping_interval', type='float',
+                      default=0,
+                      help=('If positive number is specified, send a ping '
+                            'on WebSocket connections from which nothing '
+                            'has been received for the specified number of '
+                            'seconds.'))
+    parser.add_option('--keepalive-pong-timeout',
+                      '--keepalive_pong_timeout',
+                      dest='keepalive_pong_timeout', type='float',
+                      default=0,
+                      help=('If positive number is specified, abort '
+                            'WebSocket connections from which nothing has '
+                            'been received for the specified number of '
+                            'seconds after sending a ping or a close frame '
+                            'for idle timeout.'))
+    parser.add_option('--idle-timeout', '--idle_timeout',
+                      dest='idle_timeout', type='float', default=0,
+                      help=('If positive number is specified, close '
+                            'WebSocket connections with status code 1001 '
+                            'when no message has been sent or received for '
+                            'the specified number of seconds.'))
+    parser.add_option('--memory-sample-size', '--memory_sample_size',
+                      dest='memory_sample_size', type='int', default=0,
+                      help=('If positive number is specified, estimate '
+                            'memory of a random sample of up to the '
+                            'specified number of WebSocket connections. '
+                            'The mean is served at --status-path.'))
+    parser.add_option('--thread-stack-size', '--thread_stack_size',
+                      dest='thread_stack_size', type='int', default=0,
+                      help=('Stack size of threads in bytes. If 0, the '
+                            'default of the platform is used. Must be at '
+                            'least 32768.'))
 
     return parser
 
@@ -1164,6 +1518,13 @@ def _main(args=None):
         options.basic_auth_credential = 'Basic ' + base64.b64encode(
             options.basic_auth_credential)
 
+    if options.thread_stack_size:
+        try:
+            threading.stack_size(options.thread_stack_size)
+        except (ValueError, threading.ThreadError), e:
+            logging.critical('Invalid --thread-stack-size option: %s' % e)
+            sys.exit(1)
+
     try:
         if options.thread_monitor_interval_in_sec > 0:
             # Run a thread monitor to show the status of server threads for
@@ -0,0 +1,144 @@
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Hooks to trace WebSocket connections.
+
+To trace connections, subclass Tracer, override the methods of the events
+to trace, and install an instance by set_tracer() before the server starts
+accepting connections, e.g. in a handler file.
+
+    class MyTracer(tracing.Tracer):
+        def on_frame_parsed(self, request, opcode, fin, payload_length,
+                            timestamp):
+            ...
+
+    tracing.set_tracer(MyTracer())
+
+Streams and extension processors look up the tracer when they're created
+and check it against None at each event, so tracing costs nothing else while
+no tracer is installed. Methods of a tracer are called on the threads
+transferring data, so they must be thread-safe, fast and must not raise.
+
+Every method takes the mod_python request of the connection as the first
+argument, so that events can be attributed to connections. For logical
+channels of the multiplexing extension, it's the request of the channel.
+It's None for extension processors used without a connection.
+
+Timestamps are given by get_timestamp(), which is time.monotonic() where
+available and time.time() otherwise.
+"""
+
+
+import time
+
+
+get_timestamp = getattr(time, 'monotonic', time.time)
+
+
+class Tracer(object):
+    """Base class of tracers. All methods do nothing."""
+
+    def on_handshake_start(self, request, timestamp):
+        """Called when the opening handshake of request starts."""
+
+        pass
+
+    def on_handshake_end(self, request, timestamp, error):
+        """Called when the opening handshake of request finishes.
+
+        Args:
+            error: the exception that failed the handshake, or None on
+                success.
+        """
+
+        pass
+
+    def on_extensions_negotiated(self, request, extensions, timestamp):
+        """Called when the extensions to accept are decided.
+
+        Args:
+            extensions: list of common.ExtensionParameter instances sent back
+                to the client.
+        """
+
+        pass
+
+    def on_frame_parsed(self, request, opcode, fin, payload_length,
+                        timestamp):
+        """Called when a frame is received and parsed. payload_length is the
+        length on the wire.
+        """
+
+        pass
+
+    def on_message_reassembled(self, request, opcode, length, timestamp):
+        """Called when a message including a control message is received.
+        length is the length after the extensions are applied.
+        """
+
+        pass
+
+    def on_filter_applied(self, request, extension_name, direction,
+                          input_length, output_length, start_timestamp,
+                          end_timestamp):
+        """Called when an extension compresses or decompresses data.
+
+        Args:
+            extension_name: name of the extension.
+            direction: 'in' for decompression of received data, 'out' for
+                compression of data to send.
+        """
+
+        pass
+
+    def on_write_completed(self, request, length, start_timestamp,
+                           end_timestamp):
+        """Called when data is written to the connection."""
+
+        pass
+
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Installs tracer (Tracer instance). None uninstalls the tracer.
+    Connections established before the call keep the previous one.
+    """
+
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+# vi:sts=4 sw=4 et
@@ -155,6 +155,67 @@ def get_class_logger(o):
         '%s.%s' % (o.__class__.__module__, o.__class__.__name__))
 
 
+# Incremented by notify_logging_config_changed() to let LogLevelCache
+# instances re-evaluate their cached level checks.
+_logging_config_generation = 0
+
+
+def notify_logging_config_changed():
+    """Lets LogLevelCache instances created before a change of the logging
+    configuration pick up the new configuration. Logger.setLevel() and
+    logging.disable() are detected automatically. Call this only after
+    changing levels by other means, e.g. assigning to Logger.level.
+    """
+
+    global _logging_config_generation
+    _logging_config_generation += 1
+
+
+def _install_set_level_hook():
+    """Makes Logger.setLevel() call notify_logging_config_changed()."""
+
+    original_set_level = logging.Logger.setLevel
+    if getattr(original_set_level, '_notifies_log_level_caches', False):
+        # Already installed, e.g. by an earlier load of this module.
+        return
+
+    def set_level(self, level):
+        original_set_level(self, level)
+        notify_logging_config_changed()
+    set_level._notifies_log_level_caches = True
+    logging.Logger.setLevel = set_level
+
+
+_install_set_level_hook()
+
+
+class LogLevelCache(object):
+    """Caches the result of logger.isEnabledFor(level).
+
+    isEnabledFor walks up the logger hierarchy on every call. Code logging
+    per frame or per message checks is_enabled() once and skips building
+    log arguments entirely when the level is disabled. The cached value is
+    refreshed when Logger.setLevel() or logging.disable() is called, or
+    notify_logging_config_changed() is called.
+    """
+
+    def __init__(self, logger, level):
+        self._logger = logger
+        self._level = level
+        self._refresh()
+
+    def _refresh(self):
+        self._generation = _logging_config_generation
+        self._disable = self._logger.manager.disable
+        self._enabled = self._logger.isEnabledFor(self._level)
+
+    def is_enabled(self):
+        if (self._generation != _logging_config_generation or
+            self._disable != self._logger.manager.disable):
+            self._refresh()
+        return self._enabled
+
+
 class NoopMasker(object):
     """A masking object that has the same interface as RepeatedXorMasker but
     just returns the string passed in without making any change.
@@ -227,28 +288,33 @@ class _Deflater(object):
 
     def __init__(self, window_bits):
         self._logger = get_class_logger(self)
+        self._debug_log_cache = LogLevelCache(self._logger, logging.DEBUG)
+        self._window_bits = window_bits
 
         self._compress = zlib.compressobj(
             zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -window_bits)
 
     def compress(self, bytes):
         compressed_bytes = self._compress.compress(bytes)
-        self._logger.debug('Compress input %r', bytes)
-        self._logger.debug('Compress result %r', compressed_bytes)
+        if self._debug_log_cache.is_enabled():
+            self._logger.debug('Compress input %r', bytes)
+            self._logger.debug('Compress result %r', compressed_bytes)
         return compressed_bytes
 
     def compress_and_flush(self, bytes):
         compressed_bytes = self._compress.compress(bytes)
         compressed_bytes += self._compress.flush(zlib.Z_SYNC_FLUSH)
-        self._logger.debug('Compress input %r', bytes)
-        self._logger.debug('Compress result %r', compressed_bytes)
+        if self._debug_log_cache.is_enabled():
+            self._logger.debug('Compress input %r', bytes)
+            self._logger.debug('Compress result %r', compressed_bytes)
         return compressed_bytes
 
     def compress_and_finish(self, bytes):
         compressed_bytes = self._compress.compress(bytes)
         compressed_bytes += self._compress.flush(zlib.Z_FINISH)
-        self._logger.debug('Compress input %r', bytes)
-        self._logger.debug('Compress result %r', compressed_bytes)
+        if self._debug_log_cache.is_enabled():
+            self._logger.debug('Compress input %r', bytes)
+            self._logger.debug('Compress result %r', compressed_bytes)
         return compressed_bytes
 
 
@@ -256,6 +322,7 @@ class _Inflater(object):
 
     def __init__(self, window_bits):
         self._logger = get_class_logger(self)
+        self._debug_log_cache = LogLevelCache(self._logger, logging.DEBUG)
         self._window_bits = window_bits
 
         self._unconsumed = ''
@@ -303,16 +370,18 @@ class _Inflater(object):
                 # don't have to "continue" here.
                 break
 
-        if data:
+        if data and self._debug_log_cache.is_enabled():
             self._logger.debug('Decompressed %r', data)
         return data
 
     def append(self, data):
-        self._logger.debug('Appended %r', data)
+        if self._debug_log_cache.is_enabled():
+            self._logger.debug('Appended %r', data)
         self._unconsumed += data
 
     def reset(self):
-        self._logger.debug('Reset')
+        if self._debug_log_cache.is_enabled():
+            self._logger.debug('Reset')
         self._decompress = zlib.decompressobj(-self._window_bits)
 
 
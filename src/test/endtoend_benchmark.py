@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""End-to-end benchmark for standalone.py.
+
+Launches standalone.py on localhost with each configuration in turn, drives
+it by example/load_client.py and writes the results as JSON so that results
+of different revisions can be compared. For each configuration, measures:
+
+- the round-trip time of small messages on a connection
+- the throughput of large messages echoed on a connection
+- the opening handshake rate of connections opened one by one
+- the increase in the resident memory of the server per idle connection
+
+Usage:
+    $ python test/endtoend_benchmark.py --output result.json
+
+Configurations are named after the handler (thread for echo_wsh.py,
+eventloop for echo_coroutine_wsh.py) and the features used (tls, deflate for
+permessage-deflate, hybi00, and fine_log for logging every frame at the FINE
+level to a temporary file). Compare a fine_log configuration with the one
+without it to see the cost of logging. Select them by --configs, e.g.
+--configs=thread,eventloop. Memory is read from /proc and reported as null on
+platforms without it. TLS configurations need a certificate the ssl module of
+this Python accepts. Specify one by --certificate and --private-key if the
+one in test/cert is rejected.
+"""
+
+
+import json
+import logging
+import optparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+sys.path.insert(0, os.path.join(os.path.split(__file__)[0], '..', 'example'))
+
+import load_client
+
+
+_SERVER_STARTUP_TIMEOUT_IN_SEC = 10
+
+# Time to wait for the server to finish setting up idle connections before
+# reading its memory usage.
+_IDLE_SETTLE_TIME_IN_SEC = 0.5
+
+# Name, whether to use TLS, options of load_client.py other than TLS, and
+# the log level of the server logging to a temporary file (None for the
+# default level logging to stderr).
+_CONFIGS = [
+    ('thread', False, {}, None),
+    ('eventloop', False, {'resource': '/echo_coroutine'}, None),
+    ('thread_deflate', False, {'use_permessage_deflate': True}, None),
+    ('eventloop_deflate', False, {'resource': '/echo_coroutine',
+                                  'use_permessage_deflate': True}, None),
+    ('thread_tls', True, {}, None),
+    ('thread_hybi00', False, {'protocol_version': 'hybi00'}, None),
+    ('thread_fine_log', False, {}, 'fine'),
+    ('thread_deflate_fine_log', False, {'use_permessage_deflate': True},
+     'fine'),
+]
+
+
+def _get_resident_memory(pid):
+    """Returns the resident set size of the process in bytes, or None if
+    it's not available on this platform.
+    """
+
+    try:
+        f = open('/proc/%d/status' % pid)
+    except IOError:
+        return None
+    try:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    finally:
+        f.close()
+    return None
+
+
+def _get_unused_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    (_, port) = s.getsockname()
+    s.close()
+    return port
+
+
+def _start_server(options, port, use_tls, log_level, log_file):
+    top_dir = os.path.abspath(
+        os.path.join(os.path.split(__file__)[0], '..'))
+    os.putenv('PYTHONPATH', os.path.pathsep.join(sys.path))
+    args = [sys.executable,
+            os.path.join(top_dir, 'mod_pywebsocket', 'standalone.py'),
+            '-H', 'localhost',
+            '-V', 'localhost',
+            '-p', str(port),
+            '-P', str(port),
+            '-d', os.path.join(top_dir, 'example')]
+    if use_tls:
+        args.extend(['--tls',
+                     '--private-key', options.private_key,
+                     '--certificate', options.certificate])
+    if log_level is not None:
+        args.extend(['--log-level', log_level, '--log-file', log_file])
+    args.extend(options.server_options)
+    return subprocess.Popen(args, close_fds=True)
+
+
+def _wait_for_server(server, port):
+    """Returns True when the server accepts connections, or False if it
+    exited or didn't start listening in time.
+    """
+
+    deadline = time.time() + _SERVER_STARTUP_TIMEOUT_IN_SEC
+    while time.time() < deadline:
+        if server.poll() is not None:
+            return False
+        s = socket.socket()
+        try:
+            s.connect(('localhost', port))
+            return True
+        except socket.error:
+            time.sleep(0.1)
+        finally:
+            s.close()
+    return False
+
+
+def _create_client_options(port, use_tls, config_options, **kwargs):
+    client_options = optparse.Values({
+        'server_host': 'localhost',
+        'server_port': port,
+        'origin': 'http://localhost',
+        'resource': '/echo',
+        'use_tls': use_tls,
+        'socket_timeout': 10,
+        'concurrent_handshakes': 100,
+        'protocol_version': 'hybi13',
+        'version_header': -1,
+        'deflate_frame': False,
+        'use_permessage_deflate': False,
+        'profile': 'request',
+        'rate': 0,
+        'duration': 0,
+    })
+    client_options._update_loose(config_options)
+    client_options._update_loose(kwargs)
+    return client_options
+
+
+def _run_config(options, use_tls, config_options, log_level):
+    """Runs the benchmark with a configuration and returns the result as a
+    dict.
+    """
+
+    log_file = None
+    if log_level is not None:
+        log_fd, log_file = tempfile.mkstemp(suffix='.log')
+        os.close(log_fd)
+    port = _get_unused_port()
+    server = _start_server(options, port, use_tls, log_level, log_file)
+    try:
+        if not _wait_for_server(server, port):
+            return {'error': 'Server failed to start'}
+
+        rtt = load_client.LoadClient(_create_client_options(
+            port, use_tls, config_options,
+            connections=1,
+            message_size=options.small_message_size,
+            duration=options.duration)).run()
+        bulk = load_client.LoadClient(_create_client_options(
+            port, use_tls, config_options,
+            connections=1,
+            message_size=options.bulk_message_size,
+            duration=options.duration)).run()
+
+        memory_before = _get_resident_memory(server.pid)
+        idle_client = load_client.LoadClient(_create_client_options(
+            port, use_tls, config_options,
+            connections=options.idle_connections,
+            message_size=0))
+        idle_client.open_connections()
+        time.sleep(_IDLE_SETTLE_TIME_IN_SEC)
+        memory_after = _get_resident_memory(server.pid)
+        idle_client.close_connections()
+        setup = idle_client.get_result()
+    finally:
+        # kill() raises OSError if the server has already exited.
+        if server.poll() is None:
+            server.kill()
+        server.wait()
+        if log_file is not None:
+            os.remove(log_file)
+
+    memory_per_connection = None
+    if (memory_before is not None and memory_after is not None and
+        setup['connections']):
+        memory_per_connection = (
+            (memory_after - memory_before) / setup['connections'])
+    return {
+        'rtt_p50_ms': rtt['latency_p50_ms'],
+        'rtt_p99_ms': rtt['latency_p99_ms'],
+        'round_trips_per_sec': rtt['messages_per_sec'],
+        'bulk_mb_per_sec': bulk['mb_per_sec'],
+        'connections_per_sec': setup['connections_per_sec'],
+        'handshake_p50_ms': setup['handshake_p50_ms'],
+        'handshake_p99_ms': setup['handshake_p99_ms'],
+        'idle_connections': setup['connections'],
+        'memory_per_idle_connection_bytes': memory_per_connection,
+        'errors': (rtt['errors'] + bulk['errors'] + setup['errors'] +
+                   rtt['connect_failures'] + bulk['connect_failures'] +
+                   setup['connect_failures']),
+    }
+
+
+def _format_result(name, result):
+    if 'error' in result:
+        return '%s: %s' % (name, result['error'])
+    if result['memory_per_idle_connection_bytes'] is None:
+        memory = 'n/a'
+    else:
+        memory = '%d bytes' % result['memory_per_idle_connection_bytes']
+    return ('%s: rtt p50 %.2f ms, p99 %.2f ms, bulk %.2f MB/s, '
+            '%.1f conn/s, %s per idle connection, %d errors' %
+            (name, result['rtt_p50_ms'], result['rtt_p99_ms'],
+             result['bulk_mb_per_sec'], result['connections_per_sec'],
+             memory, result['errors']))
+
+
+def main():
+    cert_dir = os.path.abspath(
+        os.path.join(os.path.split(__file__)[0], 'cert'))
+
+    parser = optparse.OptionParser()
+    parser.add_option('--configs', dest='configs', type='string',
+                      default=','.join(name for name, _, _, _ in _CONFIGS),
+                      help='comma-separated list of configurations to run')
+    parser.add_option('--server-option', '--server_option',
+                      dest='server_options', action='append', default=[],
+                      help='option passed to standalone.py')
+    parser.add_option('--certificate', dest='certificate', type='string',
+                      default=os.path.join(cert_dir, 'cert.pem'),
+                      help='certificate of the server for TLS')
+    parser.add_option('--private-key', '--private_key', dest='private_key',
+                      type='string', default=os.path.join(cert_dir, 'key.pem'),
+                      help='private key of the server for TLS')
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+                      default=3, help='duration(sec) of each measurement')
+    parser.add_option('--small-message-size', '--small_message_size',
+                      dest='small_message_size', type='int', default=16,
+                      help='size of messages to measure round-trip time')
+    parser.add_option('--bulk-message-size', '--bulk_message_size',
+                      dest='bulk_message_size', type='int', default=65536,
+                      help='size of messages to measure throughput')
+    parser.add_option('--idle-connections', '--idle_connections',
+                      dest='idle_connections', type='int', default=200,
+                      help='number of connections to measure memory usage')
+    parser.add_option('-o', '--output', dest='output', type='string',
+                      default=None,
+                      help='file to write the JSON result to. By default, '
+                      'it\'s written to stdout')
+    parser.add_option('--log-level', '--log_level', type='choice',
+                      dest='log_level', default='warn',
+                      choices=['debug', 'info', 'warn', 'error', 'critical'],
+                      help='log level')
+    (options, unused_args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.getLevelName(options.log_level.upper()))
+
+    configs = dict((name, (use_tls, config_options, log_level))
+                   for name, use_tls, config_options, log_level in _CONFIGS)
+    names = options.configs.split(',')
+    for name in names:
+        if name not in configs:
+            logging.critical('Unknown configuration: %s', name)
+            sys.exit(1)
+
+    results = {}
+    for name in names:
+        use_tls, config_options, log_level = configs[name]
+        results[name] = _run_config(
+            options, use_tls, config_options, log_level)
+        print >>sys.stderr, _format_result(name, results[name])
+
+    report = {
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'parameters': {
+            'duration': options.duration,
+            'small_message_size': options.small_message_size,
+            'bulk_message_size': options.bulk_message_size,
+            'idle_connections': options.idle_connections,
+            'server_options': options.server_options,
+        },
+        'results': results,
+    }
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        f = open(options.output, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vi:sts=4 sw=4 et
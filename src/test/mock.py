@@ -210,10 +210,18 @@ class MockDispatcher(object):
 
     def __init__(self):
         self.do_extra_handshake_called = False
+        self.metrics_registry = None
+        self.keepalive_scheduler = None
 
     def do_extra_handshake(self, conn_context):
         self.do_extra_handshake_called = True
 
+    def get_metrics_registry(self):
+        return self.metrics_registry
+
+    def get_keepalive_scheduler(self):
+        return self.keepalive_scheduler
+
     def transfer_data(self, conn_context):
         pass
 
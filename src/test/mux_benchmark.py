@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Benchmark for the mux extension.
+
+Opens logical channels over one physical connection to a standalone server
+running locally, exchanges messages with the /echo handler on all of them,
+and reports the aggregate throughput, the latency of messages on each
+channel and the number of threads of the server.
+
+Usage:
+    $ python test/mux_benchmark.py --channels 100 --quotas 1024,65536
+
+The channels send a message each in turn and then wait for the echoes, so
+a channel which is served late gets a high latency. Quota is what the client
+grants to the server for each channel via FlowControl. Pass standalone.py
+options to the server by --server-option, e.g.
+--server-option=--mux-worker-pool-size=8. To benchmark a server launched
+separately, specify its port by --server-port.
+"""
+
+
+import logging
+import optparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from test import client_for_testing
+from test import mux_client_for_testing
+
+
+_SERVER_WARMUP_IN_SEC = 0.5
+
+_DEFAULT_CHANNEL_ID = 1
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1,
+                int(len(sorted_values) * percent / 100.0))
+    return sorted_values[index]
+
+
+def _get_thread_count(pid):
+    """Returns the number of threads of the process, or None if it's not
+    available on this platform.
+    """
+
+    if pid is None:
+        return None
+    try:
+        f = open('/proc/%d/status' % pid)
+    except IOError:
+        return None
+    try:
+        for line in f:
+            if line.startswith('Threads:'):
+                return int(line.split()[1])
+    finally:
+        f.close()
+    return None
+
+
+def _receive_message(client, channel_id):
+    """Receives a message replenishing the quota for each frame so that the
+    server can send a message larger than the quota.
+    """
+
+    payload = []
+    first_frame = True
+    while True:
+        frame = client.receive_frame(channel_id)
+        payload.append(frame.payload)
+        # The first frame of a message consumes an extra octet.
+        replenished_quota = len(frame.payload)
+        if first_frame:
+            replenished_quota += 1
+            first_frame = False
+        client.send_flow_control(channel_id, replenished_quota)
+        if frame.fin:
+            return ''.join(payload)
+
+
+def _create_options(options, resource):
+    client_options = client_for_testing.ClientOptions()
+    client_options.server_host = options.server_host
+    client_options.server_port = options.server_port
+    client_options.origin = 'http://%s' % options.server_host
+    client_options.resource = resource
+    return client_options
+
+
+def _run_benchmark(options, quota, server_pid):
+    """Runs the benchmark with the quota and returns the result as a dict."""
+
+    client = mux_client_for_testing.MuxClient(
+        _create_options(options, '/echo'))
+    client.connect()
+    try:
+        logical_channel_options = _create_options(options, '/echo')
+        channel_ids = [_DEFAULT_CHANNEL_ID]
+        for i in xrange(options.channels - 1):
+            channel_id = i + 2
+            client.add_channel(channel_id, logical_channel_options)
+            channel_ids.append(channel_id)
+        for channel_id in channel_ids:
+            client.send_flow_control(channel_id, quota)
+
+        message = 'x' * options.message_size
+        latencies = dict([(channel_id, []) for channel_id in channel_ids])
+        max_thread_count = _get_thread_count(server_pid)
+
+        start = time.time()
+        for unused_round in xrange(options.messages):
+            sent_times = {}
+            for channel_id in channel_ids:
+                client.wait_for_send_quota(channel_id, len(message) + 1)
+                sent_times[channel_id] = time.time()
+                client.send_message(channel_id, message, binary=True)
+            for channel_id in channel_ids:
+                payload = _receive_message(client, channel_id)
+                latencies[channel_id].append(
+                    time.time() - sent_times[channel_id])
+                if payload != message:
+                    raise Exception('Unexpected payload received on channel '
+                                    'id %d' % channel_id)
+            thread_count = _get_thread_count(server_pid)
+            if thread_count > max_thread_count:
+                max_thread_count = thread_count
+        elapsed = time.time() - start
+
+        for channel_id in channel_ids[1:]:
+            client.send_close(channel_id)
+        for channel_id in channel_ids[1:]:
+            client.assert_receive_close(channel_id)
+        client.send_physical_connection_close()
+        client.assert_physical_connection_receive_close()
+    finally:
+        client.close_socket()
+
+    channel_p50s = []
+    channel_p99s = []
+    for channel_id in channel_ids:
+        channel_latencies = sorted(latencies[channel_id])
+        channel_p50s.append(_percentile(channel_latencies, 50))
+        channel_p99s.append(_percentile(channel_latencies, 99))
+
+    total_bytes = options.message_size * options.messages * len(channel_ids)
+    return {
+        'quota': quota,
+        'mb_per_sec': total_bytes / elapsed / 1000 / 1000,
+        'p50_ms': _percentile(sorted(channel_p50s), 50) * 1000,
+        'worst_channel_p50_ms': max(channel_p50s) * 1000,
+        'p99_ms': _percentile(sorted(channel_p99s), 50) * 1000,
+        'worst_channel_p99_ms': max(channel_p99s) * 1000,
+        'server_threads': max_thread_count,
+    }
+
+
+def _format_result(result):
+    if result['server_threads'] is None:
+        server_threads = 'n/a'
+    else:
+        server_threads = str(result['server_threads'])
+    return ('quota=%d: %.2f MB/s, p50 %.2f ms (worst channel %.2f ms), '
+            'p99 %.2f ms (worst channel %.2f ms), server threads %s' %
+            (result['quota'], result['mb_per_sec'], result['p50_ms'],
+             result['worst_channel_p50_ms'], result['p99_ms'],
+             result['worst_channel_p99_ms'], server_threads))
+
+
+def _start_server(options):
+    top_dir = os.path.join(os.path.split(__file__)[0], '..')
+    os.putenv('PYTHONPATH', os.path.pathsep.join(sys.path))
+    args = [sys.executable,
+            os.path.join(top_dir, 'mod_pywebsocket', 'standalone.py'),
+            '-H', options.server_host,
+            '-V', options.server_host,
+            '-p', str(options.server_port),
+            '-P', str(options.server_port),
+            '-d', os.path.join(top_dir, 'example')]
+    args.extend(options.server_options)
+    return subprocess.Popen(args, close_fds=True)
+
+
+def _get_unused_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    (_, port) = s.getsockname()
+    s.close()
+    return port
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--server-host', '--server_host',
+                      dest='server_host', type='string', default='localhost',
+                      help='server host')
+    parser.add_option('-p', '--server-port', '--server_port',
+                      dest='server_port', type='int', default=0,
+                      help=('port of a server launched separately. If not '
+                            'specified, launch standalone.py'))
+    parser.add_option('--server-option', '--server_option',
+                      dest='server_options', action='append', default=[],
+                      help='option passed to standalone.py')
+    parser.add_option('-c', '--channels', dest='channels', type='int',
+                      default=10,
+                      help='number of logical channels including the '
+                      'implicitly opened one')
+    parser.add_option('-m', '--messages', dest='messages', type='int',
+                      default=100, help='number of messages per channel')
+    parser.add_option('--message-size', '--message_size',
+                      dest='message_size', type='int', default=1024,
+                      help='size of each message in bytes')
+    parser.add_option('-q', '--quotas', dest='quotas', type='string',
+                      default='1024,8192,65536',
+                      help=('comma-separated list of quota the client '
+                            'grants to the server for each channel'))
+    parser.add_option('--log-level', '--log_level', type='choice',
+                      dest='log_level', default='warn',
+                      choices=['debug', 'info', 'warn', 'error', 'critical'],
+                      help='log level')
+    (options, unused_args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.getLevelName(options.log_level.upper()))
+
+    quotas = [int(quota) for quota in options.quotas.split(',')]
+
+    server = None
+    server_pid = None
+    if options.server_port == 0:
+        options.server_port = _get_unused_port()
+        server = _start_server(options)
+        server_pid = server.pid
+        time.sleep(_SERVER_WARMUP_IN_SEC)
+    try:
+        print ('%d channels, %d messages of %d bytes per channel' %
+               (options.channels, options.messages, options.message_size))
+        for quota in quotas:
+            print _format_result(_run_benchmark(options, quota, server_pid))
+    finally:
+        if server is not None:
+            server.kill()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vi:sts=4 sw=4 et
@@ -52,6 +52,7 @@ import random
 import socket
 import struct
 import threading
+import time
 
 from mod_pywebsocket import util
 
@@ -387,10 +388,10 @@ class MuxClient(object):
             raise Exception('Invalid encapsulated frame received')
 
         first_byte = ord(data[0])
-        fin = (first_byte << 7) & 1
-        rsv1 = (first_byte << 6) & 1
-        rsv2 = (first_byte << 5) & 1
-        rsv3 = (first_byte << 4) & 1
+        fin = (first_byte >> 7) & 1
+        rsv1 = (first_byte >> 6) & 1
+        rsv2 = (first_byte >> 5) & 1
+        rsv3 = (first_byte >> 4) & 1
         opcode = first_byte & 0xf
 
         if self._outgoing_frame_filter:
@@ -464,27 +465,31 @@ class MuxClient(object):
         self.close_socket()
 
     def _assert_channel_slot_available(self):
+        deadline = time.time() + self._timeout
         try:
             self._control_blocks_condition.acquire()
-            if len(self._channel_slots) == 0:
-                # Wait once
-                self._control_blocks_condition.wait(timeout=self._timeout)
+            # Other control blocks may wake us up before NewChannelSlot.
+            while len(self._channel_slots) == 0 and time.time() < deadline:
+                self._control_blocks_condition.wait(
+                    timeout=deadline - time.time())
         finally:
             self._control_blocks_condition.release()
 
         if len(self._channel_slots) == 0:
             raise Exception('Failed to receive NewChannelSlot')
 
-    def _assert_send_quota_available(self, channel_id):
+    def _assert_send_quota_available(self, channel_id, amount=1):
+        deadline = time.time() + self._timeout
         try:
             self._logical_channels_condition.acquire()
-            if self._logical_channels[channel_id].send_quota == 0:
-                # Wait once
-                self._logical_channels_condition.wait(timeout=self._timeout)
+            while (self._logical_channels[channel_id].send_quota < amount and
+                   time.time() < deadline):
+                self._logical_channels_condition.wait(
+                    timeout=deadline - time.time())
         finally:
             self._logical_channels_condition.release()
 
-        if self._logical_channels[channel_id].send_quota == 0:
+        if self._logical_channels[channel_id].send_quota < amount:
             raise Exception('Failed to receive FlowControl for channel id %d' %
                             channel_id)
 
@@ -613,19 +618,43 @@ class MuxClient(object):
             first_byte = (end << 7) | client_for_testing.OPCODE_TEXT
             message = message.encode('utf-8')
 
+        # The first frame of a message consumes an extra octet.
+        consumed_quota = len(message) + 1
         try:
             self._logical_channels_condition.acquire()
-            if self._logical_channels[channel_id].send_quota < len(message):
+            if self._logical_channels[channel_id].send_quota < consumed_quota:
                 raise Exception('Send quota violation: %d < %d' % (
                         self._logical_channels[channel_id].send_quota,
-                        len(message)))
+                        consumed_quota))
 
-            self._logical_channels[channel_id].send_quota -= len(message)
+            self._logical_channels[channel_id].send_quota -= consumed_quota
         finally:
             self._logical_channels_condition.release()
         payload = _encode_channel_id(channel_id) + chr(first_byte) + message
         self._stream.send_binary(payload)
 
+    def wait_for_send_quota(self, channel_id, amount):
+        """Waits until the send quota of the channel becomes amount or more.
+        Raises an exception on timeout.
+        """
+
+        self._check_logical_channel_is_opened(channel_id)
+        self._assert_send_quota_available(channel_id, amount)
+
+    def receive_frame(self, channel_id):
+        """Receives an inner frame on the channel. Returns an object with
+        fin, rsv1, rsv2, rsv3, opcode and payload attributes.
+        """
+
+        self._check_logical_channel_is_opened(channel_id)
+
+        try:
+            return self._logical_channels[channel_id].queue.get(
+                timeout=self._timeout)
+        except Queue.Empty, e:
+            raise Exception('Cannot receive message from channel id %d' %
+                            channel_id)
+
     def assert_receive(self, channel_id, payload, binary=False):
         self._check_logical_channel_is_opened(channel_id)
 
@@ -34,12 +34,15 @@
 
 
 import os
+import shutil
+import tempfile
 import unittest
 
 import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
 from mod_pywebsocket import dispatch
 from mod_pywebsocket import handshake
+from mod_pywebsocket import util
 from test import mock
 
 
@@ -280,6 +283,159 @@ class DispatcherTest(unittest.TestCase):
         self.assertRaises(dispatch.DispatchException,
                           disp.add_resource_path_alias, '/alias', '/not-exist')
 
+    def test_resource_path_pattern(self):
+        disp = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None)
+        disp.add_resource_path_pattern('/room/{room_id}', '/origin_check')
+        disp.add_resource_path_pattern('/room/{room_id}/user/{user_id}',
+                                       '/sub/plain')
+        disp.add_resource_path_pattern('/room/lobby', '/sub/plain')
+        disp.add_resource_path_pattern('/static/*', '/sub/plain')
+
+        origin_check = disp.get_handler_suite('/origin_check')
+        plain = disp.get_handler_suite('/sub/plain')
+
+        self.assertEqual((origin_check, {'room_id': '123'}),
+                         disp._get_handler_suite_and_params('/room/123'))
+        self.assertEqual((origin_check, {'room_id': '123'}),
+                         disp._get_handler_suite_and_params('/room/123?q=v'))
+        self.assertEqual(
+            (plain, {'room_id': '1', 'user_id': '2'}),
+            disp._get_handler_suite_and_params('/room/1/user/2'))
+        # Literal segments take precedence over parameters.
+        self.assertEqual((plain, {}),
+                         disp._get_handler_suite_and_params('/room/lobby'))
+        self.assertEqual((plain, {}),
+                         disp._get_handler_suite_and_params('/static/a/b'))
+        self.assertEqual((plain, {}),
+                         disp._get_handler_suite_and_params('/static/'))
+        self.assertEqual(None, disp.get_handler_suite('/room'))
+        self.assertEqual(None, disp.get_handler_suite('/room/'))
+        self.assertEqual(None, disp.get_handler_suite('/room/1/user'))
+        self.assertEqual(None, disp.get_handler_suite('/static'))
+        # Exact resources take precedence over patterns.
+        disp.add_resource_path_pattern('/sub/*', '/origin_check')
+        self.assertEqual(plain, disp.get_handler_suite('/sub/plain'))
+        self.assertEqual(origin_check, disp.get_handler_suite('/sub/other'))
+
+        self.assertRaises(dispatch.DispatchException,
+                          disp.add_resource_path_pattern,
+                          '/room/{id}', '/not-exist')
+        for pattern in ['room/{id}', '/room/{other}', '/a/*/b', '/a/b{c}',
+                        '/a/b*']:
+            self.assertRaises(dispatch.DispatchException,
+                              disp.add_resource_path_pattern,
+                              pattern, '/origin_check')
+
+    def test_transfer_data_resource_path_pattern(self):
+        disp = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None)
+        disp.add_resource_path_pattern('/plain/{name}', '/sub/plain')
+        request = mock.MockRequest(connection=mock.MockConn('\xff\x00'))
+        request.ws_resource = '/plain/foo'
+        request.ws_protocol = None
+        disp.transfer_data(request)
+        self.assertEqual({'name': 'foo'}, request.ws_resource_params)
+        self.assertEqual('sub/plain_wsh.py is called for /plain/foo, None'
+                         '\xff\x00',
+                         request.connection.written_data())
+
+    def test_is_resource_path_pattern(self):
+        self.failUnless(dispatch.is_resource_path_pattern('/room/{id}'))
+        self.failUnless(dispatch.is_resource_path_pattern('/static/*'))
+        self.failIf(dispatch.is_resource_path_pattern('/'))
+        self.failIf(dispatch.is_resource_path_pattern('/echo'))
+        # Only a trailing * segment is the prefix wildcard.
+        self.failIf(dispatch.is_resource_path_pattern('/foo*'))
+        self.failUnless(dispatch.is_resource_path_pattern('/*'))
+
+    def test_resource_path_pattern_duplicate(self):
+        disp = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None)
+        disp.add_resource_path_pattern('/room/{room_id}', '/origin_check')
+        disp.add_resource_path_pattern('/static/*', '/origin_check')
+        for pattern in ['/room/{room_id}', '/static/*']:
+            self.assertRaises(dispatch.DispatchException,
+                              disp.add_resource_path_pattern,
+                              pattern, '/sub/plain')
+        # The patterns registered first are kept.
+        origin_check = disp.get_handler_suite('/origin_check')
+        self.assertEqual(origin_check, disp.get_handler_suite('/room/1'))
+        self.assertEqual(origin_check, disp.get_handler_suite('/static/a'))
+        # /room/{room_id}/* is a different pattern.
+        disp.add_resource_path_pattern('/room/{room_id}/*', '/sub/plain')
+
+    def test_lazy_load(self):
+        disp = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None, lazy_load=True)
+        # Handler files are only indexed on construction.
+        self.assertEqual(8, len(disp._handler_suite_map))
+        self.assertEqual([], disp.source_warnings())
+        self.failUnless(isinstance(disp._handler_suite_map['/sub/plain'],
+                                   dispatch._LazyHandlerSuite))
+
+        request = mock.MockRequest(connection=mock.MockConn('\xff\x00'))
+        request.ws_resource = '/sub/plain'
+        request.ws_protocol = None
+        disp.transfer_data(request)
+        self.assertEqual('sub/plain_wsh.py is called for /sub/plain, None'
+                         '\xff\x00',
+                         request.connection.written_data())
+
+    def test_lazy_load_source_warnings(self):
+        disp = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None, lazy_load=True)
+        self.assertEqual(None, disp.get_handler_suite('/blank'))
+        # Sourcing is not retried.
+        self.assertEqual(None, disp.get_handler_suite('/blank'))
+        self.assertEqual(
+            [os.path.realpath(os.path.join(_TEST_HANDLERS_DIR,
+                                           'blank_wsh.py')) +
+             ': web_socket_do_extra_handshake is not defined.'],
+            disp.source_warnings())
+
+    def test_lazy_load_resource_path_alias(self):
+        disp = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None, lazy_load=True)
+        disp.add_resource_path_alias('/', '/origin_check')
+        handler_suite = disp.get_handler_suite('/')
+        self.failUnless(handler_suite)
+        self.failUnless(handler_suite is
+                        disp.get_handler_suite('/origin_check'))
+
+    def test_bytecode_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            disp = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None,
+                                       bytecode_cache_dir=cache_dir)
+            self.failUnless(disp.get_handler_suite('/origin_check'))
+            # One entry for each of the 8 handler files.
+            self.assertEqual(8, len(os.listdir(cache_dir)))
+
+            path = os.path.join(_TEST_HANDLERS_DIR, 'origin_check_wsh.py')
+            code = dispatch._compile_handler_file(path, cache_dir)
+            self.assertEqual(
+                code.co_code,
+                dispatch._compile_handler_file(path, cache_dir).co_code)
+
+            disp = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None,
+                                       bytecode_cache_dir=cache_dir)
+            self.assertEqual(4, len(disp._handler_suite_map))
+            self.assertEqual(4, len(disp.source_warnings()))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_bytecode_cache_write_failure(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(_TEST_HANDLERS_DIR, 'origin_check_wsh.py')
+            cache_path = os.path.join(
+                cache_dir,
+                util.sha1_hash(os.path.realpath(path)).hexdigest() +
+                dispatch._BYTECODE_CACHE_SUFFIX)
+            # A directory in place of the cache entry makes rename fail.
+            os.mkdir(cache_path)
+            self.failUnless(dispatch._compile_handler_file(path, cache_dir))
+            # The temporary file is removed.
+            self.assertEqual([os.path.basename(cache_path)],
+                             os.listdir(cache_dir))
+        finally:
+            shutil.rmtree(cache_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
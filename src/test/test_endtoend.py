@@ -37,6 +37,7 @@ the port on which the Apache server is running.
 """
 
 
+import httplib
 import logging
 import os
 import signal
@@ -197,13 +198,14 @@ class EndToEndTestBase(unittest.TestCase):
         return subprocess.Popen([sys.executable] + commandline, close_fds=True,
                                 stdout=stdout, stderr=stderr)
 
-    def _run_server(self):
+    def _run_server(self, extra_args=None):
+        extra_args = extra_args or []
         args = [self.standalone_command,
                 '-H', 'localhost',
                 '-V', 'localhost',
                 '-p', str(self.test_port),
                 '-P', str(self.test_port),
-                '-d', self.document_root]
+                '-d', self.document_root] + extra_args
 
         # Inherit the level set to the root logger by test runner.
         root_logger = logging.getLogger()
@@ -338,6 +340,22 @@ class EndToEndHyBiTest(EndToEndTestBase):
     def test_unmasked_frame(self):
         self._run_test(_unmasked_frame_check_procedure)
 
+    def test_echo_coroutine(self):
+        self._options.resource = '/echo_coroutine'
+        self._run_test(_echo_check_procedure)
+
+    def test_echo_coroutine_binary(self):
+        self._options.resource = '/echo_coroutine'
+        self._run_test(_echo_check_procedure_with_binary)
+
+    def test_echo_coroutine_server_close(self):
+        self._options.resource = '/echo_coroutine'
+        self._run_test(_echo_check_procedure_with_goodbye)
+
+    def test_echo_coroutine_unmasked_frame(self):
+        self._options.resource = '/echo_coroutine'
+        self._run_test(_unmasked_frame_check_procedure)
+
     def test_echo_deflate_frame(self):
         self._run_deflate_frame_test(_echo_check_procedure)
 
@@ -658,6 +676,37 @@ class EndToEndHyBiTest(EndToEndTestBase):
         options.version = 99
         self._run_http_fallback_test(options, 400)
 
+    def test_status_page(self):
+        server = self._run_server(['--metrics', '--status-path=/_status'])
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            client = client_for_testing.create_client(self._options)
+            try:
+                _echo_check_procedure(client)
+            finally:
+                client.close_socket()
+
+            connection = httplib.HTTPConnection(
+                'localhost', self._options.server_port)
+            try:
+                connection.request('GET', '/_status')
+                response = connection.getresponse()
+                self.assertEqual(200, response.status)
+                body = response.read()
+            finally:
+                connection.close()
+        finally:
+            self._kill_process(server.pid)
+
+        lines = body.splitlines()
+        self.failUnless(
+            'pywebsocket_connections_total{resource="/echo"} 1' in lines)
+        self.failUnless(
+            'pywebsocket_messages_total{direction="in",opcode="text"} 2' in
+            lines)
+        self.failUnless('# TYPE pywebsocket_threads gauge' in lines)
+
 
 class EndToEndHyBi00Test(EndToEndTestBase):
     def setUp(self):
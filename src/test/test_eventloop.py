@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+#
+# Copyright 2013, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Tests for eventloop module."""
+
+
+import socket
+import threading
+import time
+import unittest
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket import eventloop
+from mod_pywebsocket import stream
+from test import mock
+
+
+_TIMEOUT_IN_SEC = 5
+
+
+def _close_frame(code=common.STATUS_NORMAL_CLOSURE, mask=False):
+    return stream.create_close_frame(
+        stream.create_closing_handshake_body(code, ''), mask=mask)
+
+
+def _create_request(connection):
+    request = mock.MockRequest(connection=connection)
+    request.ws_version = common.VERSION_HYBI_LATEST
+    request.ws_resource = '/echo'
+    request.ws_stream = stream.Stream(request, stream.StreamOptions())
+    return request
+
+
+def _echo_handler(request):
+    while True:
+        message = yield
+        if message is None:
+            return
+        request.ws_stream.send_message(
+            message, binary=not isinstance(message, unicode))
+        yield eventloop.DRAIN
+
+
+def _receive_exactly(socket_, length):
+    data = []
+    while length > 0:
+        received = socket_.recv(length)
+        if not received:
+            break
+        data.append(received)
+        length -= len(received)
+    return ''.join(data)
+
+
+class _DetachableConnection(object):
+    """Mimics _StandaloneConnection of standalone.py."""
+
+    def __init__(self, socket_, buffered_data=''):
+        self._socket = socket_
+        self._buffered_data = buffered_data
+        self.local_addr = ('localhost', 80)
+        self.remote_addr = ('localhost', 12345)
+
+    def detach(self):
+        return self._socket, self._buffered_data
+
+
+class RunCoroutineHandlerTest(unittest.TestCase):
+    """Tests for run_coroutine_handler without an event loop."""
+
+    def test_echo(self):
+        request = _create_request(mock.MockConn(
+            stream.create_text_frame('Hello', mask=True) +
+            stream.create_binary_frame('\x00\xff', mask=True) +
+            _close_frame(mask=True)))
+
+        self.failIf(eventloop.run_coroutine_handler(
+            request, _echo_handler(request)))
+        self.assertEqual(stream.create_text_frame('Hello') +
+                         stream.create_binary_frame('\x00\xff') +
+                         _close_frame(),
+                         request.connection.written_data())
+        self.failUnless(request.client_terminated)
+
+    def test_exception_is_thrown_into_coroutine(self):
+        request = _create_request(mock.MockConn(''))
+        caught = []
+
+        def handler(request):
+            try:
+                yield
+            except stream.ConnectionTerminatedException, e:
+                caught.append(e)
+
+        self.failIf(eventloop.run_coroutine_handler(request, handler(request)))
+        self.assertEqual(1, len(caught))
+
+    def test_uncaught_exception(self):
+        request = _create_request(mock.MockConn(''))
+        self.assertRaises(stream.ConnectionTerminatedException,
+                          eventloop.run_coroutine_handler,
+                          request,
+                          _echo_handler(request))
+
+    def test_yield_invalid_value(self):
+        request = _create_request(mock.MockConn(''))
+
+        def handler(request):
+            yield 'foo'
+
+        self.assertRaises(stream.BadOperationException,
+                          eventloop.run_coroutine_handler,
+                          request,
+                          handler(request))
+
+
+class EventLoopConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self._server_socket, self._client_socket = socket.socketpair()
+        self._connection = eventloop._EventLoopConnection(
+            self._server_socket, 'ab', None, None)
+
+    def tearDown(self):
+        self._connection.close()
+        self._client_socket.close()
+
+    def test_read(self):
+        self.assertEqual('a', self._connection.read(1))
+        self.assertRaises(eventloop._NeedMoreData, self._connection.read, 2)
+
+        self._client_socket.sendall('cd')
+        self._connection.fill()
+        self.assertEqual('bcd', self._connection.read(3))
+        self.assertRaises(eventloop._NeedMoreData, self._connection.read, 1)
+
+        # Nothing available.
+        self._connection.fill()
+        self.failIf(self._connection.is_eof())
+
+    def test_rewind(self):
+        self._connection.mark()
+        self.assertEqual('a', self._connection.read(1))
+        self.assertRaises(eventloop._NeedMoreData, self._connection.read, 2)
+        self._connection.rewind()
+
+        self._client_socket.sendall('c')
+        self._connection.fill()
+        self.assertEqual('abc', self._connection.read(3))
+
+    def test_has_needed_data(self):
+        self._connection.mark()
+        self.failUnless(self._connection.has_needed_data())
+        self.assertEqual('a', self._connection.read(1))
+        self.assertRaises(eventloop._NeedMoreData, self._connection.read, 5)
+        self._connection.rewind()
+        self.failIf(self._connection.has_needed_data())
+
+        self._client_socket.sendall('cde')
+        self._connection.fill()
+        self.failIf(self._connection.has_needed_data())
+
+        self._client_socket.sendall('f')
+        self._connection.fill()
+        self.failUnless(self._connection.has_needed_data())
+        # Received chunks are joined only when they're read.
+        self.assertEqual(2, len(self._connection._read_chunks))
+        self.assertEqual('a', self._connection.read(1))
+        self.assertEqual('bcdef', self._connection.read(5))
+        self.assertEqual(0, len(self._connection._read_chunks))
+
+        # Consumed bytes are released on the next mark.
+        self._connection.mark()
+        self.assertEqual('', self._connection._read_buffer)
+
+    def test_eof(self):
+        self._client_socket.shutdown(socket.SHUT_WR)
+        self._connection.fill()
+        self.failUnless(self._connection.is_eof())
+        self.assertEqual('ab', self._connection.read(2))
+        self.assertEqual('', self._connection.read(1))
+
+    def test_write(self):
+        write_listener_calls = []
+
+        def listener():
+            write_listener_calls.append(True)
+        self._connection.set_write_listener(listener)
+
+        self._connection.write('hello')
+        self.assertEqual(0, self._connection.get_write_buffered_amount())
+        self.assertEqual('hello', _receive_exactly(self._client_socket, 5))
+        self.assertEqual(0, len(write_listener_calls))
+
+        # Write until the socket stops accepting data.
+        chunk = 'x' * 65536
+        written = 0
+        while not self._connection.get_write_buffered_amount():
+            self._connection.write(chunk)
+            written += len(chunk)
+        self.assertEqual(1, len(write_listener_calls))
+
+        self._client_socket.settimeout(_TIMEOUT_IN_SEC)
+        received = 0
+        while received < written:
+            received += len(self._client_socket.recv(written - received))
+            self._connection.flush()
+        self.assertEqual(0, self._connection.get_write_buffered_amount())
+
+
+class EventLoopTest(unittest.TestCase):
+    def setUp(self):
+        self._event_loop = eventloop.EventLoop()
+        self._server_socket, self._client_socket = socket.socketpair()
+        self._client_socket.settimeout(_TIMEOUT_IN_SEC)
+
+    def tearDown(self):
+        self._event_loop.stop()
+        self._client_socket.close()
+
+    def _adopt(self, handler, buffered_data=''):
+        request = _create_request(
+            _DetachableConnection(self._server_socket, buffered_data))
+        request._event_loop = self._event_loop
+        self.failUnless(eventloop.run_coroutine_handler(
+            request, handler(request)))
+        return request
+
+    def test_echo(self):
+        # The first frame has been read ahead on handshake.
+        self._adopt(_echo_handler, stream.create_text_frame('Hello',
+                                                            mask=True))
+        expected = stream.create_text_frame('Hello')
+        self.assertEqual(expected,
+                         _receive_exactly(self._client_socket, len(expected)))
+
+        # Send a frame in pieces.
+        frame = stream.create_binary_frame('x' * 1000, mask=True)
+        self._client_socket.sendall(frame[:1])
+        self._client_socket.sendall(frame[1:10])
+        self._client_socket.sendall(frame[10:])
+        expected = stream.create_binary_frame('x' * 1000)
+        self.assertEqual(expected,
+                         _receive_exactly(self._client_socket, len(expected)))
+
+        # Client-initiated closing handshake.
+        self._client_socket.sendall(_close_frame(mask=True))
+        expected = _close_frame()
+        self.assertEqual(expected,
+                         _receive_exactly(self._client_socket, len(expected)))
+        self.assertEqual('', self._client_socket.recv(1))
+
+    def test_large_frame(self):
+        self._adopt(_echo_handler)
+
+        payload = 'x' * (1024 * 1024)
+        self._client_socket.sendall(
+            stream.create_binary_frame(payload, mask=True))
+        expected = stream.create_binary_frame(payload)
+        self.assertEqual(expected,
+                         _receive_exactly(self._client_socket, len(expected)))
+
+    def test_server_initiated_close(self):
+        def handler(request):
+            message = yield
+            request.ws_stream.send_message(message)
+
+        self._adopt(handler)
+        self._client_socket.sendall(stream.create_text_frame('Hi', mask=True))
+        expected = stream.create_text_frame('Hi') + _close_frame()
+        self.assertEqual(expected,
+                         _receive_exactly(self._client_socket, len(expected)))
+
+        self._client_socket.sendall(_close_frame(mask=True))
+        self.assertEqual('', self._client_socket.recv(1))
+
+    def test_invalid_frame(self):
+        self._adopt(_echo_handler)
+        # Unmasked frame.
+        self._client_socket.sendall(stream.create_text_frame('Hi'))
+        expected = _close_frame(common.STATUS_PROTOCOL_ERROR)
+        self.assertEqual(expected,
+                         _receive_exactly(self._client_socket, len(expected)))
+        self.assertEqual('', self._client_socket.recv(1))
+
+    def test_peer_closed(self):
+        closed = []
+
+        def handler(request):
+            try:
+                yield
+            finally:
+                closed.append(True)
+
+        self._adopt(handler)
+        self._client_socket.shutdown(socket.SHUT_WR)
+        self.assertEqual('', self._client_socket.recv(1))
+        self.assertEqual([True], closed)
+
+    def test_call_soon(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            while (yield) is not None:
+                pass
+
+        request = self._adopt(handler)
+        self._event_loop.call_soon(request.ws_stream.send_message, 'pushed')
+        expected = stream.create_text_frame('pushed')
+        self.assertEqual(expected,
+                         _receive_exactly(self._client_socket, len(expected)))
+        self.assertEqual(1, self._event_loop.get_connection_count())
+
+    def test_call_later(self):
+        called = []
+        done = threading.Event()
+
+        def callback(name):
+            called.append(name)
+            if len(called) == 2:
+                done.set()
+
+        start = time.time()
+        self._event_loop.call_later(0.2, callback, 'later')
+        self._event_loop.call_later(0.1, callback, 'sooner')
+        done.wait(5)
+        self.assertEqual(['sooner', 'later'], called)
+        self.failUnless(time.time() - start >= 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vi:sts=4 sw=4 et
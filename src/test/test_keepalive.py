@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Tests for keepalive module."""
+
+
+import time
+import unittest
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket import keepalive
+from mod_pywebsocket.stream import Stream
+from mod_pywebsocket.stream import StreamOptions
+from mod_pywebsocket.stream import create_close_frame
+from mod_pywebsocket.stream import create_closing_handshake_body
+from mod_pywebsocket.stream import create_ping_frame
+from mod_pywebsocket.stream import create_pong_frame
+from mod_pywebsocket.stream import create_text_frame
+from test import mock
+
+
+class _MockConnWithShutdown(mock.MockConn):
+    def __init__(self, read_data):
+        mock.MockConn.__init__(self, read_data)
+        self.shut_down = False
+
+    def shutdown(self):
+        self.shut_down = True
+
+
+def _create_stream(scheduler, read_data=''):
+    request = mock.MockRequest(connection=_MockConnWithShutdown(read_data))
+    request.ws_version = common.VERSION_HYBI_LATEST
+    request.ws_keepalive = scheduler.create_connection_keepalive(request)
+    options = StreamOptions()
+    options.unmask_receive = False
+    request.ws_stream = Stream(request, options)
+    return request
+
+
+def _set_last_received(request, t):
+    request.ws_keepalive.last_received = t
+    request.ws_keepalive.last_activity = t
+
+
+class KeepaliveSchedulerTest(unittest.TestCase):
+    """A unittest for KeepaliveScheduler class."""
+
+    def test_ping(self):
+        scheduler = keepalive.KeepaliveScheduler(ping_interval=10)
+        request = _create_stream(scheduler)
+        _set_last_received(request, 100)
+
+        self.assertEqual(110, scheduler._check(request.ws_keepalive, 105))
+        self.assertEqual('', request.connection.written_data())
+
+        self.assertEqual(120, scheduler._check(request.ws_keepalive, 110))
+        self.assertEqual(create_ping_frame(''),
+                         request.connection.written_data())
+        self.assertFalse(request.connection.shut_down)
+
+    def test_pong_timeout(self):
+        scheduler = keepalive.KeepaliveScheduler(
+            ping_interval=10, pong_timeout=5)
+        request = _create_stream(scheduler)
+        _set_last_received(request, 100)
+
+        self.assertEqual(115, scheduler._check(request.ws_keepalive, 110))
+        self.assertEqual(None, scheduler._check(request.ws_keepalive, 115))
+        self.assertTrue(request.connection.shut_down)
+
+    def test_pong_received(self):
+        scheduler = keepalive.KeepaliveScheduler(
+            ping_interval=10, pong_timeout=5)
+        request = _create_stream(
+            scheduler, create_pong_frame('') + create_text_frame('hello'))
+        now = time.time()
+        _set_last_received(request, now - 10)
+
+        scheduler._check(request.ws_keepalive, now)
+        self.assertEqual(create_ping_frame(''),
+                         request.connection.written_data())
+        self.assertEqual('hello', request.ws_stream.receive_message())
+
+        # Nothing is done until ping_interval passes since the pong.
+        scheduler._check(request.ws_keepalive, now + 5)
+        self.assertFalse(request.connection.shut_down)
+        self.assertEqual(create_ping_frame(''),
+                         request.connection.written_data())
+
+    def test_ping_while_writing(self):
+        scheduler = keepalive.KeepaliveScheduler(ping_interval=10)
+        request = _create_stream(scheduler)
+        _set_last_received(request, 100)
+
+        request.ws_stream._write_lock.acquire()
+        try:
+            self.assertEqual(
+                110 + keepalive.KeepaliveScheduler._RETRY_INTERVAL_IN_SEC,
+                scheduler._check(request.ws_keepalive, 110))
+        finally:
+            request.ws_stream._write_lock.release()
+        self.assertEqual('', request.connection.written_data())
+
+    def test_ping_failure_keeps_other_pings(self):
+        scheduler = keepalive.KeepaliveScheduler(ping_interval=10)
+        request = _create_stream(scheduler)
+        stream = request.ws_stream
+
+        class _BusyLock(object):
+            def acquire(self, blocking=True):
+                # Another thread queues a ping while this one fails to
+                # take the lock.
+                stream._ping_queue.append(('other', 0))
+                return False
+
+        stream._write_lock = _BusyLock()
+        self.assertFalse(stream.send_ping('', blocking=False))
+        self.assertEqual(['other'],
+                         [body for body, sent_at in stream._ping_queue])
+
+    def test_idle_timeout(self):
+        scheduler = keepalive.KeepaliveScheduler(
+            pong_timeout=5, idle_timeout=30)
+        request = _create_stream(scheduler)
+        _set_last_received(request, 100)
+
+        self.assertEqual(135, scheduler._check(request.ws_keepalive, 130))
+        self.assertEqual(
+            create_close_frame(create_closing_handshake_body(
+                common.STATUS_GOING_AWAY, 'Idle timeout')),
+            request.connection.written_data())
+        self.assertTrue(request.server_terminated)
+
+        # The peer didn't send back a close frame.
+        self.assertEqual(None, scheduler._check(request.ws_keepalive, 135))
+        self.assertTrue(request.connection.shut_down)
+
+    def test_idle_timeout_while_writing(self):
+        scheduler = keepalive.KeepaliveScheduler(idle_timeout=30)
+        request = _create_stream(scheduler)
+        _set_last_received(request, 100)
+
+        request.ws_stream._write_lock.acquire()
+        try:
+            self.assertEqual(
+                None, scheduler._check(request.ws_keepalive, 130))
+        finally:
+            request.ws_stream._write_lock.release()
+        self.assertEqual('', request.connection.written_data())
+        self.assertFalse(request.server_terminated)
+        self.assertTrue(request.connection.shut_down)
+
+    def test_executor(self):
+        scheduler = keepalive.KeepaliveScheduler(ping_interval=10)
+        request = _create_stream(scheduler)
+        _set_last_received(request, 100)
+        callbacks = []
+        request.ws_keepalive.set_executor(callbacks.append)
+
+        scheduler._check(request.ws_keepalive, 110)
+        self.assertEqual('', request.connection.written_data())
+        self.assertEqual(1, len(callbacks))
+        callbacks[0]()
+        self.assertEqual(create_ping_frame(''),
+                         request.connection.written_data())
+
+    def test_thread(self):
+        scheduler = keepalive.KeepaliveScheduler(ping_interval=0.01)
+        request = _create_stream(scheduler)
+        request.ws_keepalive.start()
+        try:
+            for unused_i in xrange(100):
+                if request.connection.written_data():
+                    break
+                time.sleep(0.05)
+            self.assertEqual(1, scheduler.get_connection_count())
+        finally:
+            request.ws_keepalive.stop()
+            scheduler.stop()
+            scheduler.join(5)
+        self.assertTrue(request.connection.written_data().startswith(
+            create_ping_frame('')))
+        self.assertEqual(0, scheduler.get_connection_count())
+        self.assertFalse(scheduler.isAlive())
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vi:sts=4 sw=4 et
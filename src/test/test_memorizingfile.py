@@ -97,6 +97,15 @@ class UtilTest(unittest.TestCase):
             self.check_with_size(memorizing_file, size,
                                  ['Hello\n', 'World\n', 'Welcome'])
 
+    def test_release_memorized_lines(self):
+        memorizing_file = memorizingfile.MemorizingFile(StringIO.StringIO(
+                'Hello\nWorld\nWelcome'))
+        self.check(memorizing_file, 1, ['Hello\n'])
+        memorizing_file.release_memorized_lines()
+        self.check(memorizing_file, 0, [])
+        self.assertEqual('World\n', memorizing_file.readline())
+        self.check(memorizing_file, 0, [])
+
 if __name__ == '__main__':
     unittest.main()
 
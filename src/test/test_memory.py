@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Tests for memory module."""
+
+
+import unittest
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket import memorizingfile
+from mod_pywebsocket import memory
+from mod_pywebsocket import util
+from mod_pywebsocket.stream import Frame
+from mod_pywebsocket.stream import Stream
+from mod_pywebsocket.stream import StreamOptions
+from test import mock
+
+
+class _MemorizingConn(mock.MockConn):
+    def __init__(self, read_data):
+        mock.MockConn.__init__(self, '')
+        self._file = memorizingfile.MemorizingFile(
+            mock.MockConn(read_data))
+
+    def get_memorized_lines(self):
+        return self._file.get_memorized_lines()
+
+
+def _create_request(extension_processors=None):
+    conn = _MemorizingConn('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+    while conn._file.readline() != '\r\n':
+        pass
+    request = mock.MockRequest(connection=conn)
+    request.ws_stream = Stream(request, StreamOptions())
+    request.ws_extension_processors = extension_processors or []
+    return request
+
+
+class EstimateConnectionMemoryTest(unittest.TestCase):
+    def test_components(self):
+        result = memory.estimate_connection_memory(_create_request())
+        self.assertEqual(set(memory.COMPONENTS), set(result.keys()))
+        self.assertTrue(result[memory.COMPONENT_STREAM] > 0)
+        self.assertTrue(result[memory.COMPONENT_HANDSHAKE_LINES] > 0)
+        self.assertTrue(result[memory.COMPONENT_REQUEST] > 0)
+
+    def test_zlib(self):
+        without_zlib = memory.estimate_connection_memory(
+            _create_request())
+        with_zlib = memory.estimate_connection_memory(
+            _create_request([util._Deflater(15), util._Inflater(15)]))
+        self.assertTrue(
+            with_zlib[memory.COMPONENT_EXTENSIONS] -
+            without_zlib[memory.COMPONENT_EXTENSIONS] >
+            (1 << 17) + (1 << 15))
+        # zlib streams are counted only for extensions.
+        self.assertTrue(with_zlib[memory.COMPONENT_STREAM] < (1 << 15))
+        self.assertTrue(with_zlib[memory.COMPONENT_REQUEST] < (1 << 15))
+
+    def test_shared_objects(self):
+        request = _create_request()
+        request.shared = ['x' * 100000]
+        without_shared = memory.estimate_connection_memory(request)
+        with_shared = memory.estimate_connection_memory(
+            request, [request.shared])
+        self.assertTrue(
+            without_shared[memory.COMPONENT_REQUEST] -
+            with_shared[memory.COMPONENT_REQUEST] >= 100000)
+
+    def test_released_handshake_lines(self):
+        request = _create_request()
+        before = memory.estimate_connection_memory(request)
+        request.connection._file.release_memorized_lines()
+        after = memory.estimate_connection_memory(request)
+        self.assertTrue(after[memory.COMPONENT_HANDSHAKE_LINES] <
+                        before[memory.COMPONENT_HANDSHAKE_LINES])
+
+    def test_slots(self):
+        frame = Frame(opcode=common.OPCODE_TEXT, payload='hello')
+        self.assertFalse(hasattr(frame, '__dict__'))
+        self.assertFalse(hasattr(StreamOptions(), '__dict__'))
+        self.assertFalse(hasattr(_create_request().ws_stream, '__dict__'))
+        self.assertFalse(
+            hasattr(common.ExtensionParameter('foo'), '__dict__'))
+
+
+class MemorySamplerTest(unittest.TestCase):
+    def test_empty(self):
+        sampler = memory.MemorySampler(2)
+        self.assertEqual({}, sampler.summarize())
+        self.assertEqual(0, sampler.get_sample_count())
+
+    def test_sample_size(self):
+        sampler = memory.MemorySampler(2)
+        for unused_i in xrange(10):
+            sampler.add(_create_request())
+        self.assertEqual(2, sampler.get_sample_count())
+
+        summary = sampler.summarize()
+        self.assertEqual(set(memory.COMPONENTS), set(summary.keys()))
+        for mean, max_ in summary.itervalues():
+            self.assertTrue(mean <= max_)
+
+    def test_shared_objects(self):
+        request = _create_request()
+        request.shared = ['x' * 100000]
+        sampler = memory.MemorySampler(1, [request.shared])
+        sampler.add(request)
+        mean, unused_max = sampler.summarize()[memory.COMPONENT_REQUEST]
+        self.assertTrue(mean < 100000)
+
+
+class GetThreadStackSizeTest(unittest.TestCase):
+    def test_get_thread_stack_size(self):
+        size = memory.get_thread_stack_size()
+        self.assertTrue(size is None or size > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vi:sts=4 sw=4 et
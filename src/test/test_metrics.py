@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Tests for metrics module."""
+
+
+import threading
+import unittest
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket.extensions import PerMessageDeflateExtensionProcessor
+from mod_pywebsocket import handshake
+from mod_pywebsocket import metrics
+from mod_pywebsocket.stream import Stream
+from mod_pywebsocket.stream import StreamOptions
+from mod_pywebsocket.stream import create_close_frame
+from mod_pywebsocket.stream import create_ping_frame
+from mod_pywebsocket.stream import create_text_frame
+from test import mock
+
+
+def _create_handshake_request(version='13'):
+    return mock.MockRequest(
+        method='GET',
+        uri='/demo',
+        headers_in={'Host': 'server.example.com',
+                    'Upgrade': 'websocket',
+                    'Connection': 'Upgrade',
+                    'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ==',
+                    'Sec-WebSocket-Version': version,
+                    'Origin': 'http://example.com'},
+        connection=mock.MockConn(''))
+
+
+def _create_stream(read_data, connection_metrics):
+    request = mock.MockRequest(connection=mock.MockConn(read_data))
+    request.ws_version = common.VERSION_HYBI_LATEST
+    request.ws_metrics = connection_metrics
+    options = StreamOptions()
+    options.unmask_receive = False
+    request.ws_stream = Stream(request, options)
+    return request
+
+
+class HistogramTest(unittest.TestCase):
+    """A unittest for Histogram class."""
+
+    def test_observe(self):
+        histogram = metrics.Histogram((10, 100))
+        histogram.observe(0)
+        histogram.observe(10)
+        histogram.observe(11)
+        histogram.observe(1000)
+        self.assertEqual([2, 1, 1], histogram.bucket_counts)
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(1021, histogram.sum)
+
+    def test_merge(self):
+        histogram = metrics.Histogram((10, 100))
+        histogram.observe(5)
+        other = histogram.copy()
+        other.observe(50)
+        histogram.merge(other)
+        self.assertEqual([2, 1, 0], histogram.bucket_counts)
+        self.assertEqual(3, histogram.count)
+        self.assertRaises(
+            ValueError, histogram.merge, metrics.Histogram((10,)))
+
+    def test_get_quantile(self):
+        histogram = metrics.Histogram((10, 100))
+        self.assertEqual(None, histogram.get_quantile(0.5))
+        for value in (1, 2, 50, 60):
+            histogram.observe(value)
+        self.assertEqual(10, histogram.get_quantile(0.5))
+        self.assertEqual(55, histogram.get_quantile(0.75))
+        histogram.observe(1000)
+        self.assertEqual(100, histogram.get_quantile(0.99))
+
+
+class ConnectionMetricsTest(unittest.TestCase):
+    """A unittest for ConnectionMetrics class."""
+
+    def test_add_frame(self):
+        connection_metrics = metrics.ConnectionMetrics()
+        connection_metrics.add_frame(
+            metrics.DIRECTION_IN, common.OPCODE_TEXT, 0, 3)
+        # A control frame between fragments.
+        connection_metrics.add_frame(
+            metrics.DIRECTION_IN, common.OPCODE_PING, 1, 1)
+        connection_metrics.add_frame(
+            metrics.DIRECTION_IN, common.OPCODE_CONTINUATION, 1, 4)
+        connection_metrics.add_frame(
+            metrics.DIRECTION_OUT, common.OPCODE_BINARY, 1, 2)
+
+        self.assertEqual(1, connection_metrics.get_counter(
+            'frames', direction='in', opcode='text'))
+        self.assertEqual(1, connection_metrics.get_counter(
+            'frames', direction='in', opcode='continuation'))
+        self.assertEqual(2, connection_metrics.get_counter(
+            'fragments', direction='in'))
+        self.assertEqual(0, connection_metrics.get_counter(
+            'fragments', direction='out'))
+        self.assertEqual(1, connection_metrics.get_counter(
+            'messages', direction='in', opcode='text'))
+        self.assertEqual(7, connection_metrics.get_counter(
+            'message_bytes', direction='in', opcode='text'))
+        self.assertEqual(1, connection_metrics.get_counter(
+            'messages', direction='in', opcode='ping'))
+        self.assertEqual(2, connection_metrics.get_counter(
+            'message_bytes', direction='out', opcode='binary'))
+
+        histogram = connection_metrics.get_histogram(
+            'message_size', direction='in')
+        self.assertEqual(2, histogram.count)
+        self.assertEqual(8, histogram.sum)
+        self.assertEqual(None, connection_metrics.get_histogram(
+            'message_size', direction='unknown'))
+
+    def test_add_round_trip_time(self):
+        connection_metrics = metrics.ConnectionMetrics()
+        connection_metrics.add_round_trip_time(0.02)
+        connection_metrics.add_round_trip_time(3)
+
+        histogram = connection_metrics.get_histogram('round_trip_seconds')
+        self.assertEqual(2, histogram.count)
+        self.assertEqual(3.02, histogram.sum)
+
+    def test_close_without_close_frame(self):
+        connection_metrics = metrics.ConnectionMetrics()
+        connection_metrics.close()
+        connection_metrics.close()
+        self.assertEqual(1, connection_metrics.get_counter(
+            'close_codes', direction='in',
+            code=str(common.STATUS_ABNORMAL_CLOSURE)))
+
+    def test_close_twice_from_threads(self):
+        connection_metrics = metrics.ConnectionMetrics()
+        threads = [threading.Thread(target=connection_metrics.close)
+                   for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, connection_metrics.get_counter(
+            'close_codes', direction='in',
+            code=str(common.STATUS_ABNORMAL_CLOSURE)))
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    """A unittest for MetricsRegistry class."""
+
+    def test_snapshot(self):
+        registry = metrics.MetricsRegistry()
+        registry.increment('handshake_failures', reason='version')
+
+        first = registry.create_connection_metrics()
+        first.open('/echo')
+        first.add_frame(metrics.DIRECTION_IN, common.OPCODE_TEXT, 1, 5)
+        second = registry.create_connection_metrics()
+        second.open('/echo')
+        second.add_frame(metrics.DIRECTION_IN, common.OPCODE_TEXT, 1, 6)
+        second.add_close_code(
+            metrics.DIRECTION_IN, common.STATUS_NORMAL_CLOSURE)
+
+        self.assertEqual(2, registry.get_active_connection_count('/echo'))
+        snapshot = registry.snapshot()
+        self.assertEqual(2, snapshot.get_gauge(
+            'active_connections', resource='/echo'))
+        self.assertEqual(2, snapshot.get_counter(
+            'messages', direction='in', opcode='text'))
+        self.assertEqual(1, snapshot.get_counter(
+            'handshake_failures', reason='version'))
+
+        second.close()
+        second.close()
+        self.assertEqual(1, registry.get_active_connection_count())
+        snapshot = registry.snapshot()
+        self.assertEqual(1, snapshot.get_gauge(
+            'active_connections', resource='/echo'))
+        self.assertEqual(2, snapshot.get_counter(
+            'connections', resource='/echo'))
+        # Metrics of the closed connection are kept.
+        self.assertEqual(11, snapshot.get_counter(
+            'message_bytes', direction='in', opcode='text'))
+        self.assertEqual(1, snapshot.get_counter(
+            'close_codes', direction='in',
+            code=str(common.STATUS_NORMAL_CLOSURE)))
+        self.assertEqual(2, snapshot.get_histogram(
+            'message_size', direction='in').count)
+
+
+class FormatTextTest(unittest.TestCase):
+    """A unittest for format_text function."""
+
+    def test_format_text(self):
+        histogram = metrics.Histogram((1, 10))
+        histogram.observe(5)
+        snapshot = metrics.MetricsSnapshot(
+            {metrics.make_key('messages', direction='in', opcode='text'): 3,
+             metrics.make_key('connections', resource='/a"b'): 1},
+            {metrics.make_key('threads'): 4},
+            {metrics.make_key('message_size', direction='in'): histogram})
+        self.assertEqual(
+            '# TYPE pywebsocket_connections_total counter\n'
+            'pywebsocket_connections_total{resource="/a\\"b"} 1\n'
+            '# TYPE pywebsocket_messages_total counter\n'
+            'pywebsocket_messages_total{direction="in",opcode="text"} 3\n'
+            '# TYPE pywebsocket_threads gauge\n'
+            'pywebsocket_threads 4\n'
+            '# TYPE pywebsocket_message_size histogram\n'
+            'pywebsocket_message_size_bucket{direction="in",le="1"} 0\n'
+            'pywebsocket_message_size_bucket{direction="in",le="10"} 1\n'
+            'pywebsocket_message_size_bucket{direction="in",le="+Inf"} 1\n'
+            'pywebsocket_message_size_sum{direction="in"} 5\n'
+            'pywebsocket_message_size_count{direction="in"} 1\n',
+            metrics.format_text(snapshot))
+
+
+class StreamMetricsTest(unittest.TestCase):
+    """Tests that Stream records frames to request.ws_metrics."""
+
+    def test_receive_and_send(self):
+        read_data = (create_ping_frame('x') +
+                     create_text_frame(u'Hello', fin=0) +
+                     create_text_frame(u'World',
+                                       opcode=common.OPCODE_CONTINUATION) +
+                     create_close_frame('\x03\xe8'))
+        connection_metrics = metrics.ConnectionMetrics()
+        request = _create_stream(read_data, connection_metrics)
+
+        self.assertEqual(u'HelloWorld', request.ws_stream.receive_message())
+        request.ws_stream.send_messages(['a', 'bc'])
+        self.assertEqual(None, request.ws_stream.receive_message())
+
+        self.assertEqual(2, connection_metrics.get_counter(
+            'fragments', direction='in'))
+        self.assertEqual(10, connection_metrics.get_counter(
+            'message_bytes', direction='in', opcode='text'))
+        self.assertEqual(1, connection_metrics.get_counter(
+            'messages', direction='in', opcode='ping'))
+        self.assertEqual(1, connection_metrics.get_counter(
+            'messages', direction='out', opcode='pong'))
+        self.assertEqual(2, connection_metrics.get_counter(
+            'messages', direction='out', opcode='text'))
+        self.assertEqual(3, connection_metrics.get_counter(
+            'message_bytes', direction='out', opcode='text'))
+        self.assertEqual(1, connection_metrics.get_counter(
+            'close_codes', direction='in', code='1000'))
+        self.assertEqual(1, connection_metrics.get_counter(
+            'close_codes', direction='out', code='1000'))
+        self.assertEqual(1, connection_metrics.get_counter(
+            'messages', direction='out', opcode='close'))
+
+
+    def test_compression(self):
+        connection_metrics = metrics.ConnectionMetrics()
+        request = mock.MockRequest(connection=mock.MockConn(''))
+        request.ws_version = common.VERSION_HYBI_LATEST
+        request.ws_metrics = connection_metrics
+
+        processor = PerMessageDeflateExtensionProcessor(
+            common.ExtensionParameter(common.PERMESSAGE_DEFLATE_EXTENSION))
+        processor.get_extension_response()
+        processor.set_metrics(connection_metrics)
+        options = StreamOptions()
+        processor.setup_stream_options(options)
+        stream = Stream(request, options)
+
+        stream.send_message('a' * 1000, binary=True)
+
+        compressed_bytes = connection_metrics.get_counter(
+            'compression_compressed_bytes', direction='out')
+        self.assertEqual(1000, connection_metrics.get_counter(
+            'compression_original_bytes', direction='out'))
+        self.failUnless(0 < compressed_bytes < 100)
+        self.assertEqual(compressed_bytes, connection_metrics.get_counter(
+            'message_bytes', direction='out', opcode='binary'))
+
+
+class HandshakeMetricsTest(unittest.TestCase):
+    """Tests that handshake.do_handshake records metrics."""
+
+    def test_handshake(self):
+        dispatcher = mock.MockDispatcher()
+        dispatcher.metrics_registry = metrics.MetricsRegistry()
+
+        request = _create_handshake_request()
+        handshake.do_handshake(request, dispatcher)
+        self.assertEqual('/demo', request.ws_metrics.resource)
+
+        request = _create_handshake_request(version='7')
+        self.assertRaises(handshake.VersionException,
+                          handshake.do_handshake, request, dispatcher)
+
+        snapshot = dispatcher.metrics_registry.snapshot()
+        self.assertEqual(1, snapshot.get_gauge(
+            'active_connections', resource='/demo'))
+        self.assertEqual(1, snapshot.get_histogram(
+            'handshake_seconds').count)
+        self.assertEqual(1, snapshot.get_counter(
+            'handshake_failures', reason='version'))
+
+    def test_handshake_without_registry(self):
+        request = _create_handshake_request()
+        handshake.do_handshake(request, mock.MockDispatcher())
+        self.assertEqual(None, request.ws_metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vi:sts=4 sw=4 et
@@ -36,7 +36,11 @@
 import array
 import Queue
 import random
+import select
+import socket
 import struct
+import threading
+import time
 import unittest
 import zlib
 
@@ -47,10 +51,12 @@ from mod_pywebsocket.extensions import DeflateFrameExtensionProcessor
 from mod_pywebsocket.extensions import PerMessageCompressExtensionProcessor
 from mod_pywebsocket.extensions import PerMessageDeflateExtensionProcessor
 from mod_pywebsocket import msgutil
+from mod_pywebsocket import stream
 from mod_pywebsocket.stream import InvalidUTF8Exception
 from mod_pywebsocket.stream import Stream
 from mod_pywebsocket.stream import StreamHixie75
 from mod_pywebsocket.stream import StreamOptions
+from mod_pywebsocket import tracing
 from mod_pywebsocket import util
 from test import mock
 
@@ -133,6 +139,45 @@ def _create_blocking_request():
     return req
 
 
+class _SocketConn(object):
+    """Mimics _StandaloneConnection on top of one end of a socket pair."""
+
+    def __init__(self, socket_):
+        self._socket = socket_
+        self.remote_addr = 'fake_address'
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def read(self, length):
+        return self._socket.recv(length)
+
+    def read_nonblocking(self, length):
+        readable, unused_writable, unused_error = select.select(
+            [self._socket], [], [], 0)
+        if not readable:
+            return None
+        return self._socket.recv(length)
+
+    def write(self, data):
+        self._socket.sendall(data)
+
+
+def _create_socket_request():
+    """Creates MockRequest reading from and writing to a socket.
+
+    Returns:
+        a tuple of the request and the socket of the peer.
+    """
+
+    server_socket, client_socket = socket.socketpair()
+    client_socket.settimeout(5)
+    req = mock.MockRequest(connection=_SocketConn(server_socket))
+    req.ws_version = common.VERSION_HYBI_LATEST
+    req.ws_stream = Stream(req, StreamOptions())
+    return req, client_socket
+
+
 def _create_request_hixie75(read_data=''):
     req = mock.MockRequest(connection=mock.MockConn(read_data))
     req.ws_stream = StreamHixie75(req)
@@ -186,6 +231,13 @@ class BasicMessageTest(unittest.TestCase):
         self.assertEqual('\x81\x03\xe6\x97\xa5',
                          request.connection.written_data())
 
+    def test_send_messages(self):
+        request = _create_request()
+        request.ws_stream.send_messages(['Hello', 'World'], binary=True)
+        # Both frames are written at once.
+        self.assertEqual(['\x82\x05Hello\x82\x05World'],
+                         request.connection._write_data)
+
     def test_send_message_fragments(self):
         request = _create_request()
         msgutil.send_message(request, 'Hello', False)
@@ -407,6 +459,35 @@ class BasicMessageTest(unittest.TestCase):
 
         self.assertTrue(request.called)
 
+    def test_receive_pong_round_trip_time(self):
+        round_trip_times = []
+
+        def handler(request, round_trip_time):
+            round_trip_times.append(round_trip_time)
+
+        request = _create_request(
+            ('\x8a\x85', 'Hello'), ('\x8a\x85', 'World'),
+            ('\x81\x85', 'Hello'))
+        request.on_round_trip_time_handler = handler
+        self.assertEqual(None, request.ws_stream.get_round_trip_time())
+
+        # Sending times of the pings and receiving times of the pongs.
+        timestamps = [10.0, 10.5, 10.25, 11.5]
+        original_get_timestamp = tracing.get_timestamp
+        tracing.get_timestamp = lambda: timestamps.pop(0)
+        try:
+            msgutil.send_ping(request, 'Hello')
+            msgutil.send_ping(request, 'World')
+            self.assertEqual('Hello', msgutil.receive_message(request))
+        finally:
+            tracing.get_timestamp = original_get_timestamp
+
+        self.assertEqual([0.25, 1.0], round_trip_times)
+        self.assertEqual(1.0, request.ws_stream.get_round_trip_time())
+        self.assertEqual(0.34375,
+                         request.ws_stream.get_smoothed_round_trip_time())
+        self.assertEqual(0.25, request.ws_stream.get_min_round_trip_time())
+
     def test_receive_unsolicited_pong(self):
         # Unsolicited pong is allowed from HyBi 07.
         request = _create_request(
@@ -418,6 +499,9 @@ class BasicMessageTest(unittest.TestCase):
         msgutil.send_ping(request, 'Jumbo')
         # Body mismatch.
         msgutil.receive_message(request)
+        # The ping is still waiting for its pong.
+        self.assertEqual(None, request.ws_stream.get_round_trip_time())
+        self.assertEqual(1, len(request.ws_stream._ping_queue))
 
     def test_ping_cannot_be_fragmented(self):
         request = _create_request(('\x09\x85', 'Hello'))
@@ -1264,6 +1348,188 @@ class MessageReceiverTest(unittest.TestCase):
         self.assertEqual('Hello!', onmessage_queue.get())
 
 
+class MessageWorkerPoolTest(unittest.TestCase):
+    """Tests MessageWorkerPool."""
+
+    def test_try_submit(self):
+        pool = msgutil.MessageWorkerPool(size=1)
+        try:
+            release = threading.Event()
+            done = threading.Event()
+
+            self.failUnless(pool.try_submit(release.wait))
+            # The only worker is busy.
+            self.failIf(pool.try_submit(done.set))
+            # Waits for the worker.
+            pool.submit(done.set)
+            self.failIf(done.isSet())
+
+            release.set()
+            done.wait(5)
+            self.failUnless(done.isSet())
+            # The worker becomes idle again.
+            deadline = time.time() + 5
+            while not pool.try_submit(lambda: None):
+                self.failUnless(time.time() < deadline)
+                time.sleep(0.01)
+            self.assertEqual(1, pool.get_worker_count())
+        finally:
+            pool.stop()
+
+
+    def test_try_reserve(self):
+        pool = msgutil.MessageWorkerPool(size=1)
+        try:
+            done = threading.Event()
+
+            self.failUnless(pool.try_reserve())
+            # The only worker is reserved.
+            self.failIf(pool.try_submit(lambda: None))
+            pool.cancel_reservation()
+
+            self.failUnless(pool.try_reserve())
+            pool.submit_reserved(done.set)
+            done.wait(5)
+            self.failUnless(done.isSet())
+            self.assertEqual(1, pool.get_worker_count())
+        finally:
+            pool.stop()
+
+
+class PooledMessageReceiverTest(unittest.TestCase):
+    """Tests the Stream class using PooledMessageReceiver."""
+
+    def setUp(self):
+        self._pool = msgutil.MessageWorkerPool(size=2)
+
+    def tearDown(self):
+        self._pool.stop()
+
+    def test_queue(self):
+        request, client_socket = _create_socket_request()
+        receiver = msgutil.PooledMessageReceiver(request, pool=self._pool)
+
+        self.assertEqual(None, receiver.receive_nowait())
+        self.assertEqual(None, receiver.receive(timeout=0.01))
+
+        client_socket.sendall('\x81\x86' + _mask_hybi('Hello!'))
+        self.assertEqual('Hello!', receiver.receive(timeout=5))
+
+    def test_onmessage(self):
+        onmessage_queue = Queue.Queue()
+
+        def onmessage_handler(message):
+            onmessage_queue.put(message)
+
+        request, client_socket = _create_socket_request()
+        receiver = msgutil.PooledMessageReceiver(
+            request, onmessage_handler, pool=self._pool)
+
+        client_socket.sendall('\x81\x86' + _mask_hybi('Hello!'))
+        self.assertEqual('Hello!', onmessage_queue.get(timeout=5))
+
+    def test_bounded_queue(self):
+        request, client_socket = _create_socket_request()
+        receiver = msgutil.PooledMessageReceiver(
+            request, pool=self._pool, max_queued_messages=1)
+
+        for i in xrange(3):
+            client_socket.sendall('\x81\x81' + _mask_hybi(str(i)))
+        for i in xrange(3):
+            self.assertEqual(str(i), receiver.receive(timeout=5))
+
+    def test_close(self):
+        request, client_socket = _create_socket_request()
+        receiver = msgutil.PooledMessageReceiver(request, pool=self._pool)
+
+        client_socket.sendall('\x88\x80' + _mask_hybi(''))
+        self.assertEqual(None, receiver.receive(timeout=5))
+        self.failUnless(request.client_terminated)
+        self.failUnless(request.server_terminated)
+        # No more messages will arrive. receive() shouldn't block.
+        self.assertEqual(None, receiver.receive())
+
+    def test_stop(self):
+        request, client_socket = _create_socket_request()
+        receiver = msgutil.PooledMessageReceiver(request, pool=self._pool)
+
+        receiver.stop()
+        self.assertEqual(None, receiver.receive())
+
+        # The message is left for the handler.
+        client_socket.sendall('\x81\x86' + _mask_hybi('Hello!'))
+        self.assertEqual('Hello!', msgutil.receive_message(request))
+
+    def test_many_connections(self):
+        pairs = [_create_socket_request() for i in xrange(10)]
+        receivers = [msgutil.PooledMessageReceiver(request, pool=self._pool)
+                     for request, unused_client_socket in pairs]
+
+        for i, (unused_request, client_socket) in enumerate(pairs):
+            client_socket.sendall('\x81\x81' + _mask_hybi(str(i)))
+        for i, receiver in enumerate(receivers):
+            self.assertEqual(str(i), receiver.receive(timeout=5))
+        self.assertEqual(2, self._pool.get_worker_count())
+
+    def test_partial_frame(self):
+        pool = msgutil.MessageWorkerPool(size=1)
+        try:
+            slow_request, slow_socket = _create_socket_request()
+            slow_receiver = msgutil.PooledMessageReceiver(
+                slow_request, pool=pool)
+            request, client_socket = _create_socket_request()
+            receiver = msgutil.PooledMessageReceiver(request, pool=pool)
+
+            frame = '\x81\x86' + _mask_hybi('Hello!')
+            slow_socket.sendall(frame[:4])
+            # The only worker doesn't wait for the rest of the frame.
+            client_socket.sendall(frame)
+            self.assertEqual('Hello!', receiver.receive(timeout=5))
+
+            slow_socket.sendall(frame[4:])
+            self.assertEqual('Hello!', slow_receiver.receive(timeout=5))
+        finally:
+            pool.stop()
+
+    def test_large_message(self):
+        request, client_socket = _create_socket_request()
+        receiver = msgutil.PooledMessageReceiver(request, pool=self._pool)
+
+        payload = 'x' * (1024 * 1024)
+        frame = '\x82\xff' + struct.pack('!Q', len(payload)) + (
+            _mask_hybi(payload))
+        sender = threading.Thread(target=client_socket.sendall,
+                                  args=(frame,))
+        sender.start()
+        self.assertEqual(payload, receiver.receive(timeout=5))
+        sender.join()
+
+    def test_stop_with_buffered_data(self):
+        request, client_socket = _create_socket_request()
+        onmessage_queue = Queue.Queue()
+
+        def onmessage_handler(message):
+            onmessage_queue.put(message)
+            receiver.stop()
+
+        receiver = msgutil.PooledMessageReceiver(
+            request, onmessage_handler, pool=self._pool)
+
+        client_socket.sendall('\x81\x85' + _mask_hybi('Hello') +
+                              '\x81\x85' + _mask_hybi('World'))
+        self.assertEqual('Hello', onmessage_queue.get(timeout=5))
+        # The second message read ahead by the receiver is left for the
+        # handler.
+        self.assertEqual('World', msgutil.receive_message(request))
+
+    def test_dedicated_thread(self):
+        request = _create_blocking_request()
+        receiver = msgutil.PooledMessageReceiver(request, pool=self._pool)
+
+        request.connection.put_bytes('\x81\x86' + _mask_hybi('Hello!'))
+        self.assertEqual('Hello!', receiver.receive(timeout=5))
+
+
 class MessageReceiverHixie75Test(unittest.TestCase):
     """Tests the StreamHixie75 class using MessageReceiver."""
 
@@ -1319,6 +1585,297 @@ class MessageSenderTest(unittest.TestCase):
         self.assertEqual('\x81\x05World', send_queue.get())
 
 
+class _ManualPool(object):
+    """MessageWorkerPool which runs tasks only when requested."""
+
+    def __init__(self):
+        self.tasks = []
+        # Holds (delay, callback) tuples.
+        self.timers = []
+
+    def submit(self, task):
+        self.tasks.append(task)
+
+    def call_later(self, delay, callback):
+        self.timers.append((delay, callback))
+
+    def run_tasks(self):
+        tasks = self.tasks
+        self.tasks = []
+        for task in tasks:
+            task()
+
+
+class PooledMessageSenderTest(unittest.TestCase):
+    """Tests the Stream class using PooledMessageSender."""
+
+    def test_send(self):
+        request = _create_blocking_request()
+        pool = msgutil.MessageWorkerPool(size=1)
+        try:
+            sender = msgutil.PooledMessageSender(request, pool=pool)
+
+            sender.send('World')
+            self.assertEqual('\x81\x05World',
+                             request.connection.written_data())
+        finally:
+            pool.stop()
+
+    def test_send_nowait(self):
+        request = _create_blocking_request()
+        pool = _ManualPool()
+        sender = msgutil.PooledMessageSender(request, pool=pool)
+
+        sender.send_nowait('Hello')
+        sender.send_nowait('World')
+        self.assertEqual(1, len(pool.tasks))
+        pool.run_tasks()
+        self.assertEqual('\x81\x05Hello\x81\x05World',
+                         request.connection.written_data())
+        self.assertEqual(0, len(pool.tasks))
+
+    def test_bounded_queue(self):
+        request = _create_blocking_request()
+        pool = _ManualPool()
+        sender = msgutil.PooledMessageSender(
+            request, pool=pool, max_queued_messages=1)
+
+        sender.send_nowait('Hello')
+        self.assertRaises(Queue.Full, sender.send_nowait, 'World')
+        self.assertRaises(Queue.Full, sender.send, 'World', 0.01)
+
+    def test_stop(self):
+        request = _create_blocking_request()
+        pool = _ManualPool()
+        sender = msgutil.PooledMessageSender(request, pool=pool)
+
+        sender.send_nowait('Hello')
+        sender.stop()
+        pool.run_tasks()
+        self.assertEqual('', request.connection.written_data())
+        self.assertRaises(msgutil.BadOperationException,
+                          sender.send_nowait, 'World')
+
+
+class OutboundMessageQueueTest(unittest.TestCase):
+    """Tests the Stream class using OutboundMessageQueue."""
+
+    def _create_queue(self, **kwargs):
+        request = _create_blocking_request()
+        pool = _ManualPool()
+        queue = msgutil.OutboundMessageQueue(request, pool=pool, **kwargs)
+        return request, pool, queue
+
+    def test_try_send(self):
+        request, pool, queue = self._create_queue()
+
+        self.failUnless(queue.try_send('Hello'))
+        self.failUnless(queue.try_send('\x00', binary=True))
+        self.assertEqual(2, queue.get_queue_depth())
+        self.assertEqual(6, queue.get_buffered_amount())
+
+        pool.run_tasks()
+        self.assertEqual('\x81\x05Hello\x82\x01\x00',
+                         request.connection.written_data())
+        self.assertEqual(0, queue.get_queue_depth())
+        self.assertEqual(0, queue.get_buffered_amount())
+        self.assertEqual(0, len(pool.tasks))
+
+    def test_drop_newest(self):
+        request, pool, queue = self._create_queue(
+            high_water_mark=10, overflow_policy=msgutil.OVERFLOW_DROP_NEWEST)
+
+        self.failUnless(queue.try_send('12345'))
+        self.failUnless(queue.try_send('67890'))
+        self.failIf(queue.try_send('a'))
+        self.assertEqual(2, queue.get_queue_depth())
+        self.assertEqual(1, queue.get_dropped_message_count())
+
+        pool.run_tasks()
+        self.assertEqual('\x81\x0512345\x81\x0567890',
+                         request.connection.written_data())
+
+    def test_large_message_to_empty_queue(self):
+        request, pool, queue = self._create_queue(high_water_mark=1)
+
+        self.failUnless(queue.try_send('Hello'))
+        self.failIf(queue.try_send('World'))
+
+    def test_drop_oldest(self):
+        request, pool, queue = self._create_queue(
+            high_water_mark=10, overflow_policy=msgutil.OVERFLOW_DROP_OLDEST)
+
+        self.failUnless(queue.try_send('12345'))
+        self.failUnless(queue.try_send('67890'))
+        self.failUnless(queue.try_send('abc'))
+        self.assertEqual(2, queue.get_queue_depth())
+        self.assertEqual(8, queue.get_buffered_amount())
+        self.assertEqual(1, queue.get_dropped_message_count())
+
+        pool.run_tasks()
+        self.assertEqual('\x81\x0567890\x81\x03abc',
+                         request.connection.written_data())
+
+    def test_unicode_message_size(self):
+        request, pool, queue = self._create_queue(high_water_mark=4)
+
+        # U+672c is encoded as e6,9c,ac in UTF-8
+        self.failUnless(queue.try_send(u'\u672c'))
+        self.assertEqual(3, queue.get_buffered_amount())
+        self.failIf(queue.try_send(u'\u672c'))
+
+    def _check_close_on_overflow(self, overflow_policy):
+        request, pool, queue = self._create_queue(
+            high_water_mark=5, overflow_policy=overflow_policy)
+        shutdown_called = []
+        request.connection.shutdown = lambda: shutdown_called.append(True)
+        written_nonblocking = []
+
+        def write_nonblocking(data):
+            written_nonblocking.append(data)
+            return len(data)
+        request.connection.write_nonblocking = write_nonblocking
+
+        self.failUnless(queue.try_send('12345'))
+        self.failIf(queue.try_send('6'))
+        self.failUnless(queue.is_closed())
+        self.failUnless(shutdown_called)
+        self.failIf(queue.try_send('7'))
+        self.assertEqual(0, queue.get_queue_depth())
+        self.assertEqual(2, queue.get_dropped_message_count())
+
+        # No close frame is queued behind the messages.
+        pool.run_tasks()
+        self.assertEqual('', request.connection.written_data())
+        return written_nonblocking
+
+    def test_close_policy_violation(self):
+        written = self._check_close_on_overflow(
+            msgutil.OVERFLOW_CLOSE_POLICY_VIOLATION)
+        self.assertEqual(
+            [stream.create_close_frame(
+                stream.create_closing_handshake_body(
+                    common.STATUS_POLICY_VIOLATION, 'Send queue overflow'))],
+            written)
+
+    def test_close_try_again_later(self):
+        written = self._check_close_on_overflow(
+            msgutil.OVERFLOW_CLOSE_TRY_AGAIN_LATER)
+        self.assertEqual(
+            [stream.create_close_frame(
+                stream.create_closing_handshake_body(
+                    common.STATUS_TRY_AGAIN_LATER, 'Send queue overflow'))],
+            written)
+
+    def test_close_on_overflow_while_send_is_blocked(self):
+        shut_down = threading.Event()
+        send_started = threading.Event()
+
+        class _StalledConn(mock.MockBlockingConn):
+            def shutdown(self):
+                shut_down.set()
+
+        class _StalledStream(object):
+            def send_message(self, message, binary=False):
+                send_started.set()
+                # Blocks until the socket is shut down like a write to a
+                # client which doesn't read.
+                shut_down.wait()
+                raise msgutil.ConnectionTerminatedException('Shut down')
+
+        request = mock.MockRequest(connection=_StalledConn())
+        request.ws_stream = _StalledStream()
+        pool = msgutil.MessageWorkerPool(size=1)
+        try:
+            queue = msgutil.OutboundMessageQueue(
+                request, high_water_mark=10, pool=pool,
+                overflow_policy=msgutil.OVERFLOW_CLOSE_POLICY_VIOLATION)
+
+            self.failUnless(queue.try_send('12345'))
+            send_started.wait(5)
+            self.failUnless(send_started.isSet())
+            # The message being sent is counted.
+            self.assertEqual(5, queue.get_buffered_amount())
+            self.failUnless(queue.try_send('67890'))
+            self.failIf(queue.try_send('a'))
+
+            self.failUnless(shut_down.isSet())
+            self.failUnless(queue.is_closed())
+            self.assertEqual(0, queue.get_queue_depth())
+            self.assertEqual(0, queue.get_buffered_amount())
+        finally:
+            # Returns only after the worker has been released.
+            pool.stop()
+
+    def test_send_timeout(self):
+        shut_down = threading.Event()
+
+        class _StalledConn(mock.MockBlockingConn):
+            def shutdown(self):
+                shut_down.set()
+
+        class _StalledStream(object):
+            def send_message(self, message, binary=False):
+                shut_down.wait()
+                raise msgutil.ConnectionTerminatedException('Shut down')
+
+        request = mock.MockRequest(connection=_StalledConn())
+        request.ws_stream = _StalledStream()
+        pool = msgutil.MessageWorkerPool(size=1)
+        try:
+            # The drop policies abort stalled connections too.
+            queue = msgutil.OutboundMessageQueue(
+                request, pool=pool, send_timeout=0.1,
+                overflow_policy=msgutil.OVERFLOW_DROP_NEWEST)
+
+            self.failUnless(queue.try_send('Hello'))
+            self.failUnless(queue.try_send('World'))
+            shut_down.wait(5)
+            self.failUnless(shut_down.isSet())
+            self.failUnless(queue.is_closed())
+            self.assertEqual(0, queue.get_queue_depth())
+            self.assertEqual(0, queue.get_buffered_amount())
+            self.failIf(queue.try_send('Hello'))
+        finally:
+            pool.stop()
+
+    def test_send_deadline_met(self):
+        request, pool, queue = self._create_queue(send_timeout=10)
+
+        self.failUnless(queue.try_send('Hello'))
+        pool.run_tasks()
+        self.assertEqual(1, len(pool.timers))
+        self.assertEqual(10, pool.timers[0][0])
+
+        # Nothing is being sent. The deadline isn't checked again until the
+        # next message is sent.
+        timers = pool.timers
+        pool.timers = []
+        for unused_delay, callback in timers:
+            callback()
+        self.assertEqual([], pool.timers)
+        self.failIf(queue.is_closed())
+
+        self.failUnless(queue.try_send('World'))
+        pool.run_tasks()
+        self.assertEqual(1, len(pool.timers))
+
+    def test_send_failure(self):
+        request, pool, queue = self._create_queue()
+        request.server_terminated = True
+
+        self.failUnless(queue.try_send('Hello'))
+        self.failUnless(queue.try_send('World'))
+        pool.run_tasks()
+        self.failUnless(queue.is_closed())
+        self.failIf(queue.try_send('Hello'))
+        self.assertEqual(0, queue.get_queue_depth())
+
+    def test_invalid_overflow_policy(self):
+        self.assertRaises(ValueError, msgutil.OutboundMessageQueue,
+                          _create_blocking_request(), overflow_policy='foo')
+
+
 class MessageSenderHixie75Test(unittest.TestCase):
     """Tests the StreamHixie75 class using MessageSender."""
 
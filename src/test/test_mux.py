@@ -45,6 +45,7 @@ import zlib
 import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
 from mod_pywebsocket import common
+from mod_pywebsocket import msgutil
 from mod_pywebsocket import mux
 from mod_pywebsocket._stream_base import ConnectionTerminatedException
 from mod_pywebsocket._stream_base import UnsupportedFrameException
@@ -88,10 +89,12 @@ class _MockMuxConnection(mock.MockBlockingConn):
         self._pending_fragments = []
 
         self.server_close_code = None
+        self.write_count = 0
 
     def write(self, data):
         """Override MockBlockingConn.write."""
 
+        self.write_count += 1
         self._current_data = data
         self._position = 0
 
@@ -104,10 +107,15 @@ class _MockMuxConnection(mock.MockBlockingConn):
             self._position += length
             return data
 
+        # The mux writer may write multiple physical frames at once.
+        while self._position < len(self._current_data):
+            self._process_physical_frame(_receive_bytes)
+
+    def _process_physical_frame(self, receive_bytes):
         # Parse physical frames and assemble a message if the message is
         # fragmented.
         opcode, payload, fin, rsv1, rsv2, rsv3 = (
-            parse_frame(_receive_bytes, unmask_receive=False))
+            parse_frame(receive_bytes, unmask_receive=False))
 
         self._pending_fragments.append(payload)
 
@@ -518,6 +526,210 @@ class MuxTest(unittest.TestCase):
         self.assertEqual('server.example.com', headers['Host'])
         self.assertEqual('http://example.com', headers['Origin'])
 
+    def test_read_control_blocks(self):
+        data = (mux._create_flow_control(2 ** 29 - 1, 2 ** 32) +
+                mux._create_drop_channel(2 ** 14 - 1, 3005, 'Quota') +
+                mux._create_new_channel_slot(200, 2 ** 16) +
+                mux._create_flow_control(2 ** 21 - 1, 126))
+        parser = mux._MuxFramePayloadParser(data)
+        blocks = list(parser.read_control_blocks())
+
+        self.assertEqual(4, len(blocks))
+        self.assertEqual(mux._MUX_OPCODE_FLOW_CONTROL, blocks[0].opcode)
+        self.assertEqual(2 ** 29 - 1, blocks[0].channel_id)
+        self.assertEqual(2 ** 32, blocks[0].send_quota)
+        self.assertEqual(mux._MUX_OPCODE_DROP_CHANNEL, blocks[1].opcode)
+        self.assertEqual(2 ** 14 - 1, blocks[1].channel_id)
+        self.assertEqual(3005, blocks[1].drop_code)
+        self.assertEqual('Quota', blocks[1].drop_message)
+        self.assertEqual(mux._MUX_OPCODE_NEW_CHANNEL_SLOT, blocks[2].opcode)
+        self.assertEqual(200, blocks[2].slots)
+        self.assertEqual(2 ** 16, blocks[2].send_quota)
+        self.assertEqual(2 ** 21 - 1, blocks[3].channel_id)
+        self.assertEqual(126, blocks[3].send_quota)
+
+    def test_read_control_blocks_with_short_channel_ids(self):
+        data = (mux._create_flow_control(1, 125) +
+                mux._create_flow_control(127, 126) +
+                mux._create_flow_control(2, 2 ** 16) +
+                mux._create_new_channel_slot(125, 0xffff))
+        parser = mux._MuxFramePayloadParser(data)
+        blocks = list(parser.read_control_blocks())
+
+        self.assertEqual(4, len(blocks))
+        self.assertEqual(1, blocks[0].channel_id)
+        self.assertEqual(125, blocks[0].send_quota)
+        self.assertEqual(127, blocks[1].channel_id)
+        self.assertEqual(126, blocks[1].send_quota)
+        self.assertEqual(2, blocks[2].channel_id)
+        self.assertEqual(2 ** 16, blocks[2].send_quota)
+        self.assertEqual(125, blocks[3].slots)
+        self.assertEqual(0xffff, blocks[3].send_quota)
+
+    def test_read_control_blocks_invalid_number(self):
+        # Using 3 bytes encoding for 125.
+        parser = mux._MuxFramePayloadParser('\x40\x01\x7e\x00\x7d')
+        self.assertRaises(mux.PhysicalConnectionError,
+                          list, parser.read_control_blocks())
+
+        # The last byte of 3 bytes encoding is missing.
+        parser = mux._MuxFramePayloadParser('\x40\x01\x7e\x01')
+        self.assertRaises(mux.PhysicalConnectionError,
+                          list, parser.read_control_blocks())
+
+        # The channel id is truncated.
+        parser = mux._MuxFramePayloadParser('\x40\xe0\x00')
+        self.assertRaises(mux.PhysicalConnectionError,
+                          list, parser.read_control_blocks())
+
+    def test_read_add_channel_request_contents_are_view(self):
+        data = '\x00\x01\x05Hello\x00\x02\x05World'
+        parser = mux._MuxFramePayloadParser(data)
+        blocks = list(parser.read_control_blocks())
+        self.assertEqual(2, len(blocks))
+        self.assertTrue(isinstance(blocks[0].encoded_handshake, memoryview))
+        self.assertEqual('Hello', blocks[0].encoded_handshake.tobytes())
+        self.assertEqual('World', blocks[1].encoded_handshake.tobytes())
+
+    def test_read_control_blocks_truncated(self):
+        data = mux._create_flow_control(2 ** 29 - 1, 2 ** 32)
+        parser = mux._MuxFramePayloadParser(data[:-1])
+        self.assertRaises(mux.PhysicalConnectionError,
+                          list, parser.read_control_blocks())
+
+    def test_handshake_delta_base(self):
+        base_headers = {'Host': 'server.example.com',
+                        'Origin': 'http://example.com',
+                        'Sec-WebSocket-Extensions': 'permessage-deflate'}
+        delta_base = mux._HandshakeDeltaBase(base_headers)
+
+        delta = {'origin': '', 'sec-websocket-protocol': 'chat'}
+        headers = delta_base.create_headers(delta)
+        self.assertEqual('server.example.com', headers['host'])
+        self.assertEqual(None, headers.get('Origin'))
+        self.assertEqual('chat', headers['Sec-WebSocket-Protocol'])
+        self.assertEqual(3, len(headers))
+
+        # Changes to derived headers don't affect the delta base.
+        headers['Host'] = 'example.org'
+        self.assertEqual('server.example.com',
+                         delta_base.create_headers()['Host'])
+        self.assertEqual('http://example.com',
+                         delta_base.create_headers()['Origin'])
+        self.assertEqual(3, len(base_headers))
+
+    def test_handshake_delta_base_extensions(self):
+        delta_base = mux._HandshakeDeltaBase(
+            {'Sec-WebSocket-Extensions': 'permessage-deflate; '
+                                         'client_max_window_bits'})
+        extensions = delta_base.get_requested_extensions(
+            'permessage-deflate; client_max_window_bits')
+        self.assertEqual(1, len(extensions))
+        self.assertEqual('permessage-deflate', extensions[0].name())
+        self.assertTrue(extensions[0].has_parameter('client_max_window_bits'))
+        # The parse result is reused but each caller gets its own list.
+        another_extensions = delta_base.get_requested_extensions(
+            'permessage-deflate; client_max_window_bits')
+        self.assertTrue(extensions[0] is another_extensions[0])
+        self.assertFalse(extensions is another_extensions)
+
+        self.assertEqual(None, delta_base.get_requested_extensions(
+            'permessage-deflate'))
+        self.assertEqual(None, delta_base.get_requested_extensions(None))
+
+    def test_logical_connection_buffered_amount(self):
+        connection = mux._LogicalConnection(None, 1)
+        connection.set_max_buffered_amount(10)
+
+        self.assertTrue(connection.append_frame(
+            Frame(fin=0, opcode=common.OPCODE_TEXT, payload='Hell')))
+        self.assertTrue(connection.append_frame(
+            Frame(opcode=common.OPCODE_CONTINUATION, payload='o')))
+        self.assertEqual(6, connection.get_buffered_amount())
+        # 4 octets of payload plus one octet for the first frame of a
+        # message exceed the limit.
+        self.assertFalse(connection.append_frame(
+            Frame(opcode=common.OPCODE_TEXT, payload='Worl')))
+        self.assertEqual(6, connection.get_buffered_amount())
+
+        self.assertEqual('Hell', connection.read_frame().payload)
+        self.assertEqual(1, connection.get_buffered_amount())
+        self.assertTrue(connection.append_frame(
+            Frame(opcode=common.OPCODE_TEXT, payload='Worl')))
+        self.assertEqual('o', connection.read_frame().payload)
+        self.assertEqual('Worl', connection.read_frame().payload)
+        self.assertEqual(0, connection.get_buffered_amount())
+
+    def test_logical_connection_pipelined_write(self):
+        class _SendDataRecorder(object):
+            def __init__(self):
+                self.sent = []
+
+            def send_data(self, channel_id, data):
+                self.sent.append((channel_id, data))
+
+        mux_handler = _SendDataRecorder()
+        connection = mux._LogicalConnection(mux_handler, 2)
+
+        # write() returns without waiting for the writer thread.
+        connection.write('Hello')
+        connection.write('World')
+        self.assertEqual([(2, 'Hello'), (2, 'World')], mux_handler.sent)
+        self.assertEqual(10, connection.get_write_buffered_amount())
+
+        connection.on_write_data_done(5)
+        self.assertEqual(5, connection.get_write_buffered_amount())
+        connection.on_writer_done()
+        self.assertEqual(0, connection.get_write_buffered_amount())
+
+    def test_adaptive_receive_window(self):
+        class _ControlDataRecorder(object):
+            def __init__(self):
+                self.replenished_quotas = []
+
+            def send_control_data(self, data):
+                blocks = list(mux._MuxFramePayloadParser(
+                    data).read_control_blocks())
+                self.replenished_quotas.append(blocks[0].send_quota)
+
+        mux_handler = _ControlDataRecorder()
+        connection = mux._LogicalConnection(mux_handler, 2)
+        request = mux._LogicalRequest(2, 'GET', '/echo', 'HTTP/1.1', {},
+                                      connection)
+        budget = mux._ReceiveWindowBudget(30)
+        stream = mux._LogicalStream(request, StreamOptions(), 0, 10, budget)
+        connection.set_max_buffered_amount(10)
+
+        def _receive(payload):
+            frame = Frame(opcode=common.OPCODE_BINARY, payload=payload)
+            self.assertTrue(stream.consume_receive_quota(
+                len(payload) + 1))
+            self.assertTrue(connection.append_frame(frame))
+
+        # The handler keeps up with the client which is running out of
+        # quota. The window is doubled.
+        _receive('a' * 9)
+        stream._receive_frame_as_frame_object()
+        self.assertEqual([20], mux_handler.replenished_quotas)
+        self.assertEqual(20, budget.get_used())
+
+        # Limited by the budget.
+        _receive('a' * 19)
+        stream._receive_frame_as_frame_object()
+        self.assertEqual([20, 30], mux_handler.replenished_quotas)
+        self.assertEqual(30, budget.get_used())
+
+        # The handler lags behind. The window is shrunk.
+        _receive('a' * 9)
+        _receive('a' * 17)
+        stream._receive_frame_as_frame_object()
+        # No quota is replenished.
+        self.assertEqual([20, 30], mux_handler.replenished_quotas)
+        self.assertEqual(20, budget.get_used())
+
+        stream.release_receive_window()
+        self.assertEqual(0, budget.get_used())
+
 
 class MuxHandlerTest(unittest.TestCase):
 
@@ -581,6 +793,152 @@ class MuxHandlerTest(unittest.TestCase):
         #     and 3 'Goodbye's
         self.assertEqual(9, len(control_blocks))
 
+    def test_add_channel_on_worker_pool(self):
+        request = _create_mock_request()
+        dispatcher = _MuxMockDispatcher()
+        pool = msgutil.MessageWorkerPool(2)
+        try:
+            mux_handler = mux._MuxHandler(request, dispatcher,
+                                          worker_pool=pool)
+            mux_handler.start()
+            mux_handler.add_channel_slots(
+                mux._INITIAL_NUMBER_OF_CHANNEL_SLOTS,
+                mux._INITIAL_QUOTA_FOR_CLIENT)
+
+            for channel_id in (2, 3):
+                encoded_handshake = _create_request_header(path='/echo')
+                request.connection.put_bytes(
+                    _create_add_channel_request_frame(
+                        channel_id=channel_id, encoding=0,
+                        encoded_handshake=encoded_handshake))
+                request.connection.put_bytes(_create_flow_control_frame(
+                    channel_id=channel_id, replenished_quota=6))
+
+            # Channel 1 and 2 occupy the pool. Channel 3 is rejected instead
+            # of waiting for them to finish.
+            request.connection.put_bytes(
+                _create_logical_frame(channel_id=3, message='World'))
+            request.connection.put_bytes(
+                _create_logical_frame(channel_id=2, message='Hello'))
+            request.connection.put_bytes(
+                _create_logical_frame(channel_id=1, message='Goodbye'))
+            request.connection.put_bytes(
+                _create_logical_frame(channel_id=2, message='Goodbye'))
+
+            self.assertTrue(mux_handler.wait_until_done(timeout=2))
+            self.assertEqual(2, pool.get_worker_count())
+        finally:
+            pool.stop()
+
+        self.assertEqual(['Hello'], dispatcher.channel_events[2].messages)
+        self.assertEqual(['Hello'], request.connection.get_written_messages(2))
+        self.assertFalse(3 in dispatcher.channel_events)
+        responses = [
+            b for b in request.connection.get_written_control_blocks()
+            if b.opcode == mux._MUX_OPCODE_ADD_CHANNEL_RESPONSE]
+        self.assertEqual([2, 3], [b.channel_id for b in responses])
+        self.assertTrue(responses[0].encoded_handshake.tobytes().startswith(
+            'HTTP/1.1 101 '))
+        self.assertTrue(responses[1].encoded_handshake.tobytes().startswith(
+            'HTTP/1.1 503 '))
+
+    def test_add_channel_on_worker_pool_after_close(self):
+        request = _create_mock_request()
+        dispatcher = _MuxMockDispatcher()
+        pool = msgutil.MessageWorkerPool(2)
+        try:
+            mux_handler = mux._MuxHandler(request, dispatcher,
+                                          worker_pool=pool)
+            mux_handler.start()
+            mux_handler.add_channel_slots(
+                mux._INITIAL_NUMBER_OF_CHANNEL_SLOTS,
+                mux._INITIAL_QUOTA_FOR_CLIENT)
+
+            encoded_handshake = _create_request_header(path='/echo')
+            request.connection.put_bytes(_create_add_channel_request_frame(
+                channel_id=2, encoding=0,
+                encoded_handshake=encoded_handshake))
+            request.connection.put_bytes(
+                _create_logical_frame(channel_id=2, message='Goodbye'))
+            # Wait for the worker of channel 2 to become idle.
+            deadline = time.time() + 2
+            while (2 not in dispatcher.channel_events or
+                   2 in mux_handler._logical_channels or
+                   not pool.try_reserve()):
+                self.failUnless(time.time() < deadline)
+                time.sleep(0.01)
+            pool.cancel_reservation()
+
+            request.connection.put_bytes(_create_add_channel_request_frame(
+                channel_id=3, encoding=0,
+                encoded_handshake=encoded_handshake))
+            request.connection.put_bytes(_create_flow_control_frame(
+                channel_id=3, replenished_quota=6))
+            request.connection.put_bytes(
+                _create_logical_frame(channel_id=3, message='World'))
+            request.connection.put_bytes(
+                _create_logical_frame(channel_id=3, message='Goodbye'))
+            request.connection.put_bytes(
+                _create_logical_frame(channel_id=1, message='Goodbye'))
+
+            self.assertTrue(mux_handler.wait_until_done(timeout=2))
+            self.assertEqual(2, pool.get_worker_count())
+        finally:
+            pool.stop()
+
+        self.assertEqual(['World'], dispatcher.channel_events[3].messages)
+        self.assertEqual(['World'], request.connection.get_written_messages(3))
+
+    def test_write_batching(self):
+        request = _create_mock_request()
+        dispatcher = _MuxMockDispatcher()
+        mux_handler = mux._MuxHandler(request, dispatcher)
+
+        # Queue data before starting the writer thread so that all of them
+        # are written at once.
+        writer = mux._PhysicalConnectionWriter(mux_handler)
+        for i in xrange(10):
+            writer.put_outgoing_data(mux._OutgoingData(
+                channel_id=mux._CONTROL_CHANNEL_ID,
+                data=mux._create_flow_control(i + 2, 1)))
+        writer.start()
+        writer.stop()
+        writer.join(2)
+        self.assertFalse(writer.isAlive())
+
+        # 1 write for the flow controls and 1 write for the close frame.
+        self.assertEqual(2, request.connection.write_count)
+        control_blocks = request.connection.get_written_control_blocks()
+        self.assertEqual(10, len(control_blocks))
+        self.assertEqual(range(2, 12),
+                         [block.channel_id for block in control_blocks])
+
+    def test_writer_scheduling(self):
+        request = _create_mock_request()
+        mux_handler = mux._MuxHandler(request, _MuxMockDispatcher())
+        writer = mux._PhysicalConnectionWriter(mux_handler)
+
+        bulk = 'a' * mux._WRITER_QUANTUM
+        for i in xrange(3):
+            writer.put_outgoing_data(
+                mux._OutgoingData(channel_id=2, data=bulk))
+        writer.put_outgoing_data(mux._OutgoingData(
+            channel_id=mux._CONTROL_CHANNEL_ID, data='drop 2', queue_id=2))
+        writer.put_outgoing_data(mux._OutgoingData(channel_id=3, data='Hi'))
+        writer.put_outgoing_data(mux._OutgoingData(channel_id=3, data='Bye'))
+        writer.put_outgoing_data(mux._OutgoingData(
+            channel_id=mux._CONTROL_CHANNEL_ID, data='flow control'))
+
+        written = []
+        while writer._has_outgoing_data():
+            written.extend([outgoing_data.data
+                            for outgoing_data in writer._pop_batch()])
+        # Control data comes first, the small messages on channel 3 aren't
+        # delayed by the bulk transfer on channel 2, and DropChannel for
+        # channel 2 doesn't overtake its data.
+        self.assertEqual(['flow control', bulk, 'Hi', 'Bye', bulk, bulk,
+                          'drop 2'], written)
+
     def test_physical_connection_write_failure(self):
         # Use _FailOnWriteConnection.
         request = _create_mock_request(connection=_FailOnWriteConnection())
@@ -1468,6 +1826,44 @@ class MuxHandlerTest(unittest.TestCase):
                          drop_channel.drop_code)
         self.assertEqual(1, drop_channel.channel_id)
 
+    def test_flow_controls_in_one_message(self):
+        request = _create_mock_request()
+        dispatcher = _MuxMockDispatcher()
+        mux_handler = mux._MuxHandler(request, dispatcher)
+        mux_handler.start()
+        mux_handler.add_channel_slots(mux._INITIAL_NUMBER_OF_CHANNEL_SLOTS,
+                                      mux._INITIAL_QUOTA_FOR_CLIENT)
+
+        encoded_handshake = _create_request_header(path='/echo')
+        add_channel_request = _create_add_channel_request_frame(
+            channel_id=2, encoding=0,
+            encoded_handshake=encoded_handshake)
+        request.connection.put_bytes(add_channel_request)
+
+        # FlowControls for both channels and for an unknown channel in one
+        # message.
+        payload = (mux._encode_channel_id(mux._CONTROL_CHANNEL_ID) +
+                   mux._create_flow_control(1, 3) +
+                   mux._create_flow_control(2, 3) +
+                   mux._create_flow_control(5, 3) +
+                   mux._create_flow_control(1, 3) +
+                   mux._create_flow_control(2, 3))
+        request.connection.put_bytes(create_binary_frame(payload, mask=True))
+
+        request.connection.put_bytes(
+            _create_logical_frame(channel_id=1, message='Hello'))
+        request.connection.put_bytes(
+            _create_logical_frame(channel_id=2, message='World'))
+        request.connection.put_bytes(
+            _create_logical_frame(channel_id=1, message='Goodbye'))
+        request.connection.put_bytes(
+            _create_logical_frame(channel_id=2, message='Goodbye'))
+
+        self.assertTrue(mux_handler.wait_until_done(timeout=2))
+
+        self.assertEqual(['Hello'], request.connection.get_written_messages(1))
+        self.assertEqual(['World'], request.connection.get_written_messages(2))
+
     def test_two_flow_control(self):
         request = _create_mock_request()
         dispatcher = _MuxMockDispatcher()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Tests for tracing module."""
+
+
+import unittest
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket.extensions import PerMessageDeflateExtensionProcessor
+from mod_pywebsocket import handshake
+from mod_pywebsocket import tracing
+from mod_pywebsocket.stream import Stream
+from mod_pywebsocket.stream import StreamOptions
+from mod_pywebsocket.stream import create_text_frame
+from test import mock
+
+
+class _RecordingTracer(tracing.Tracer):
+    def __init__(self):
+        self.events = []
+        # Requests given to the hooks other than the handshake ones.
+        self.requests = []
+
+    def on_handshake_start(self, request, timestamp):
+        self.events.append(('handshake_start',))
+
+    def on_handshake_end(self, request, timestamp, error):
+        self.events.append(('handshake_end', error))
+
+    def on_extensions_negotiated(self, request, extensions, timestamp):
+        self.events.append(
+            ('extensions_negotiated',
+             [extension.name() for extension in extensions]))
+
+    def on_frame_parsed(self, request, opcode, fin, payload_length,
+                        timestamp):
+        self.requests.append(request)
+        self.events.append(('frame_parsed', opcode, fin, payload_length))
+
+    def on_message_reassembled(self, request, opcode, length, timestamp):
+        self.requests.append(request)
+        self.events.append(('message_reassembled', opcode, length))
+
+    def on_filter_applied(self, request, extension_name, direction,
+                          input_length, output_length, start_timestamp,
+                          end_timestamp):
+        self._check_timestamps(start_timestamp, end_timestamp)
+        self.requests.append(request)
+        self.events.append(
+            ('filter_applied', extension_name, direction, input_length))
+
+    def on_write_completed(self, request, length, start_timestamp,
+                           end_timestamp):
+        self._check_timestamps(start_timestamp, end_timestamp)
+        self.requests.append(request)
+        self.events.append(('write_completed', length))
+
+    def _check_timestamps(self, start_timestamp, end_timestamp):
+        if start_timestamp > end_timestamp:
+            raise AssertionError('%r > %r' % (start_timestamp, end_timestamp))
+
+
+class TracingTest(unittest.TestCase):
+    """A unittest for tracing hooks."""
+
+    def setUp(self):
+        self._tracer = _RecordingTracer()
+        tracing.set_tracer(self._tracer)
+
+    def tearDown(self):
+        tracing.set_tracer(None)
+
+    def test_no_tracer(self):
+        tracing.set_tracer(None)
+        request = mock.MockRequest(connection=mock.MockConn(''))
+        stream = Stream(request, StreamOptions())
+        stream.send_message('Hello')
+        self.assertEqual([], self._tracer.events)
+
+    def test_handshake(self):
+        request = mock.MockRequest(
+            method='GET',
+            uri='/demo',
+            headers_in={'Host': 'server.example.com',
+                        'Upgrade': 'websocket',
+                        'Connection': 'Upgrade',
+                        'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ==',
+                        'Sec-WebSocket-Version': '13',
+                        'Sec-WebSocket-Extensions': 'permessage-deflate',
+                        'Origin': 'http://example.com'},
+            connection=mock.MockConn(''))
+        handshake.do_handshake(request, mock.MockDispatcher())
+
+        self.assertEqual(('handshake_start',), self._tracer.events[0])
+        self.assertEqual(
+            ('extensions_negotiated', ['permessage-deflate']),
+            self._tracer.events[1])
+        self.assertEqual(('handshake_end', None), self._tracer.events[2])
+
+        # The request is given to the hooks of the extension processors.
+        request.ws_stream.send_message('a' * 100, binary=True)
+        self.assertEqual(
+            ('filter_applied', common.PERMESSAGE_DEFLATE_EXTENSION, 'out',
+             100),
+            self._tracer.events[3])
+        self.assertEqual([request, request], self._tracer.requests)
+
+    def test_handshake_failure(self):
+        request = mock.MockRequest(
+            method='GET', uri='/demo', connection=mock.MockConn(''))
+        self.assertRaises(handshake.HandshakeException,
+                          handshake.do_handshake,
+                          request, mock.MockDispatcher())
+
+        self.assertEqual(2, len(self._tracer.events))
+        self.assertEqual('handshake_end', self._tracer.events[1][0])
+        self.failUnless(isinstance(self._tracer.events[1][1],
+                                   handshake.HandshakeException))
+
+    def test_stream(self):
+        request = mock.MockRequest(connection=mock.MockConn(
+            create_text_frame(u'Hello', fin=0) +
+            create_text_frame(u'World', opcode=common.OPCODE_CONTINUATION)))
+        request.ws_version = common.VERSION_HYBI_LATEST
+        options = StreamOptions()
+        options.unmask_receive = False
+        stream = Stream(request, options)
+
+        self.assertEqual(u'HelloWorld', stream.receive_message())
+        stream.send_message('Hi')
+
+        self.assertEqual(
+            [('frame_parsed', common.OPCODE_TEXT, 0, 5),
+             ('frame_parsed', common.OPCODE_CONTINUATION, 1, 5),
+             ('message_reassembled', common.OPCODE_TEXT, 10),
+             ('write_completed', 4)],
+            self._tracer.events)
+        self.assertEqual([request] * 4, self._tracer.requests)
+
+    def test_filter_applied(self):
+        processor = PerMessageDeflateExtensionProcessor(
+            common.ExtensionParameter(common.PERMESSAGE_DEFLATE_EXTENSION))
+        processor.get_extension_response()
+        request = mock.MockRequest(connection=mock.MockConn(''))
+        processor.set_websocket_request(request)
+        options = StreamOptions()
+        processor.setup_stream_options(options)
+        stream = Stream(request, options)
+
+        stream.send_message('a' * 100, binary=True)
+
+        self.assertEqual(
+            ('filter_applied', common.PERMESSAGE_DEFLATE_EXTENSION, 'out',
+             100),
+            self._tracer.events[0])
+        self.assertEqual('write_completed', self._tracer.events[1][0])
+        self.assertEqual([request, request], self._tracer.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vi:sts=4 sw=4 et
@@ -33,6 +33,7 @@
 """Tests for util module."""
 
 
+import logging
 import os
 import random
 import sys
@@ -80,6 +81,43 @@ class UtilTest(unittest.TestCase):
         self.assertEqual('61 7a 41 5a 30 39 20 09 0d 0a 00 ff',
                          util.hexify('azAZ09 \t\r\n\x00\xff'))
 
+    def test_log_level_cache(self):
+        logger = logging.getLogger('mod_pywebsocket.test_log_level_cache')
+        original_level = logger.level
+        try:
+            logger.setLevel(logging.INFO)
+            cache = util.LogLevelCache(logger, logging.DEBUG)
+            self.assertFalse(cache.is_enabled())
+
+            # setLevel is picked up without notification.
+            logger.setLevel(logging.DEBUG)
+            self.assertTrue(cache.is_enabled())
+
+            logging.disable(logging.DEBUG)
+            try:
+                self.assertFalse(cache.is_enabled())
+            finally:
+                logging.disable(logging.NOTSET)
+            self.assertTrue(cache.is_enabled())
+
+            # Other changes are kept until notified.
+            logger.level = logging.INFO
+            self.assertTrue(cache.is_enabled())
+            util.notify_logging_config_changed()
+            self.assertFalse(cache.is_enabled())
+
+            # Levels of ancestors count too.
+            logger.setLevel(logging.NOTSET)
+            parent = logging.getLogger('mod_pywebsocket')
+            original_parent_level = parent.level
+            parent.setLevel(logging.DEBUG)
+            try:
+                self.assertTrue(cache.is_enabled())
+            finally:
+                parent.setLevel(original_parent_level)
+        finally:
+            logger.setLevel(original_level)
+
 
 class RepeatedXorMaskerTest(unittest.TestCase):
     """A unittest for RepeatedXorMasker class."""